@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import multiprocessing
+import random
+import time
+from bus import BrokerBus
+
+# Đo thông lượng giao message qua session bus khi tăng số worker:
+#   python broker.py --port 6380 &
+#   python bench_bus.py --workers 1 2 4 8 --duration 5
+# Mỗi worker giữ một phần user và liên tục gửi kết quả tới user ngẫu nhiên
+# (tra danh bạ rồi giao cục bộ hoặc publish sang worker chủ), giống submit_tests.
+
+
+async def run_worker(index: int, workers: int, users: int, duration: float, url: str, results):
+    worker_id = f"bench:{workers}:{index}"
+    received = 0
+
+    async def handler(message):
+        nonlocal received
+        received += 1
+
+    bus = BrokerBus(url)
+    await bus.start(worker_id, handler)
+    own_users = [f"user-{i}" for i in range(index, users, workers)]
+    for user_id in own_users:
+        await bus.claim(user_id, worker_id)
+    # Đợi các worker khác khai báo xong user của mình
+    await asyncio.sleep(0.5)
+
+    sent = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        user_id = f"user-{random.randrange(users)}"
+        message = {"type": "tests", "user_id": user_id, "tests": ["Công thức máu"]}
+        for owner in await bus.owners(user_id):
+            if owner == worker_id:
+                await handler(message)
+            else:
+                await bus.publish(owner, message)
+        sent += 1
+    await asyncio.sleep(0.5)
+    await bus.close()
+    results.put((sent, received))
+
+
+def worker_process(index, workers, users, duration, url, results):
+    asyncio.run(run_worker(index, workers, users, duration, url, results))
+
+
+def bench(workers: int, users: int, duration: float, url: str) -> dict:
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=worker_process, args=(i, workers, users, duration, url, results))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    totals = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    sent = sum(sent for sent, _ in totals)
+    received = sum(received for _, received in totals)
+    return {"workers": workers, "sent": sent, "received": received, "per_second": sent / duration}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark thông lượng session bus theo số worker")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--url", default="redis://127.0.0.1:6380")
+    args = parser.parse_args()
+
+    baseline = None
+    for workers in args.workers:
+        result = bench(workers, args.users, args.duration, args.url)
+        baseline = baseline or result["per_second"]
+        print(
+            f"{workers} worker: {result['per_second']:.0f} message/s "
+            f"(x{result['per_second'] / baseline:.2f}), gửi {result['sent']}, nhận {result['received']}"
+        )
@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+from context import count_tokens
+from form_schema import form_schema
+from llm import gateway
+from prompts import SYSTEM_PROMPT, FORM_INSTRUCTIONS, TURN_TEMPLATE, NEXT_FIELD_TASK, turn_messages
+
+# So sánh bố cục prompt cũ (lịch sử + form đứng trước hướng dẫn tĩnh) với bố cục mới (tiền tố tĩnh cố định):
+#   python bench_prompt.py --turns 12            # offline: số token prefix dùng lại được giữa hai lượt liên tiếp
+#   python bench_prompt.py --turns 12 --live     # gọi gpt-4o-mini thật: time-to-first-token và cached tokens
+# Provider chỉ cache prompt từ 1024 token, theo bước 128 token, tính từ đầu prompt.
+
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP = 128
+
+
+def conversation(turns: int):
+    # Hội thoại giả: mỗi lượt người dùng trả lời trường tiếp theo của form
+    fields = list(form_schema.fields)[:turns]
+    history = ["Bot: Xin chào! Tôi sẽ giúp bạn điền form đăng ký khám bệnh."]
+    form = {}
+    for index, field in enumerate(fields):
+        message = f"{field.label} của tôi là giá trị {index}"
+        following = fields[index + 1] if index + 1 < len(fields) else field
+        history.append(f"You: {message}")
+        fields_info = {
+            "form_json": json.dumps(form, ensure_ascii=False, separators=(",", ":")),
+            "filled_info": "\n".join(f"- {key}: {value}" for category in form.values() for key, value in category.items()) or "Chưa có thông tin nào được điền.",
+            "task": NEXT_FIELD_TASK.format(missing="...", next_field_label=field.label, next_category=field.category),
+            "message": message,
+        }
+        yield "\n".join(history), fields_info
+        form.setdefault(field.category, {})[field.key] = f"giá trị {index}"
+        history.append(f"Bot: Đã lưu {field.label}. Tiếp theo, cho tôi biết {following.label} nhé?")
+
+
+def legacy_messages(history: str, fields: dict) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": (
+            f"Lịch sử chat:\n{history}\n"
+            f"Người dùng vừa nói: '{fields['message']}'. "
+            f"Dữ liệu hiện tại của form: {fields['form_json']}. "
+            f"Thông tin đã điền: {fields['filled_info']}\n"
+            f"{fields['task']}\n" + FORM_INSTRUCTIONS
+        )}
+    ]
+
+
+def stable_messages(history: str, fields: dict) -> list:
+    return turn_messages(TURN_TEMPLATE.format(history=history, **fields))
+
+
+def serialize(messages: list) -> str:
+    return "".join(f"<{message['role']}>{message['content']}" for message in messages)
+
+
+def cacheable_tokens(previous: str, current: str) -> int:
+    common = os.path.commonprefix([previous, current])
+    tokens = count_tokens(common)
+    return 0 if tokens < CACHE_MIN_TOKENS else tokens // CACHE_STEP * CACHE_STEP
+
+
+def offline(turns: int):
+    for name, build in (("cũ", legacy_messages), ("tiền tố tĩnh", stable_messages)):
+        previous = ""
+        total = reused = 0
+        for history, fields in conversation(turns):
+            current = serialize(build(history, fields))
+            total += count_tokens(current)
+            reused += cacheable_tokens(previous, current)
+            previous = current
+        print(f"{name:>13}: {total} token prompt, {reused} token có thể cache ({reused / total:.0%})")
+
+
+async def live(turns: int):
+    results = {}
+    for name, build in (("cũ", legacy_messages), ("tiền tố tĩnh", stable_messages)):
+        gateway.calls.clear()
+        for history, fields in conversation(turns):
+            async for _ in gateway.stream("gpt-4o-mini", build(history, fields), max_tokens=32):
+                pass
+        calls = list(gateway.calls)
+        prompt = sum(call["prompt_tokens"] for call in calls)
+        cached = sum(call["cached_tokens"] for call in calls)
+        ttft = [call["ttft_ms"] for call in calls if call["ttft_ms"] is not None]
+        results[name] = (statistics.median(ttft), max(ttft), cached / prompt if prompt else 0)
+    await gateway.aclose()
+    for name, (median, worst, ratio) in results.items():
+        print(f"{name:>13}: TTFT median {median:.0f} ms, max {worst:.0f} ms, cached {ratio:.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bố cục prompt thân thiện với prompt caching")
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--live", action="store_true", help="Gọi API thật để đo TTFT và cached tokens")
+    args = parser.parse_args()
+    if args.live:
+        asyncio.run(live(args.turns))
+    else:
+        offline(args.turns)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import json
+import time
+import tracemalloc
+from session import Session, Message, ChatLog
+
+# So sánh chi phí một lượt chat giữa cách cũ (list Message, dict() + json.dumps cả lịch sử
+# mỗi lần gửi/ghi) và Session/ChatLog (serialize mỗi message một lần, ghép mảnh đã cache):
+#   python bench_session.py --sizes 10 100 1000
+
+
+class FakeWebSocket():
+    async def send_text(self, text):
+        pass
+
+
+def history(size: int) -> list:
+    return [
+        Message(message=f"Tin nhắn số {i}: tôi bị đau đầu và sốt nhẹ từ hôm qua", sender="You" if i % 2 else "Bot")
+        for i in range(size)
+    ]
+
+
+def legacy_turn(chat_history: list, form: dict):
+    # Ba lần serialize toàn bộ lịch sử mỗi lượt: broadcast, ghi Mongo, gửi form
+    chat_history.append(Message(message="Tên tôi là Nguyễn Văn A", sender="You"))
+    json.dumps({"user_id": "u", "chat_history": [msg.dict() for msg in chat_history]})
+    [msg.dict() for msg in chat_history]
+    chat_history.append(Message(message="Cảm ơn bạn, tôi đã lưu họ tên.", sender="Bot"))
+    json.dumps({"form": form, "reply": chat_history[-1].message})
+    json.dumps({"user_id": "u", "chat_history": [msg.dict() for msg in chat_history]})
+
+
+def session_turn(session: Session, form: dict):
+    session.add_message("Tên tôi là Nguyễn Văn A", "You")
+    session.history_frame()
+    session.add_message("Cảm ơn bạn, tôi đã lưu họ tên.", "Bot")
+    json.dumps({"form": form, "reply": session.chat_history[-1].message})
+    session.history_frame()
+
+
+def measure(turn, state, form: dict, turns: int) -> dict:
+    start = time.process_time()
+    for _ in range(turns):
+        turn(state, form)
+    cpu = (time.process_time() - start) / turns
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    turn(state, form)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"cpu_ms": cpu * 1000, "peak_bytes": peak - before}
+
+
+def bench(size: int, turns: int) -> tuple:
+    form = {"personal": {"name": "Nguyễn Văn A", "dob": "01/01/1990"}, "medical": {}}
+    legacy = measure(legacy_turn, history(size), form, turns)
+    session = Session(FakeWebSocket())
+    session.chat_history = ChatLog(history(size))
+    compact = measure(session_turn, session, form, turns)
+    return legacy, compact
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark CPU và bộ nhớ mỗi lượt chat theo độ dài lịch sử")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--turns", type=int, default=20)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        legacy, compact = bench(size, args.turns)
+        print(
+            f"{size:>5} message | cũ: {legacy['cpu_ms']:.3f} ms, {legacy['peak_bytes'] / 1024:.1f} KiB"
+            f" | session: {compact['cpu_ms']:.3f} ms, {compact['peak_bytes'] / 1024:.1f} KiB"
+            f" | x{legacy['cpu_ms'] / max(compact['cpu_ms'], 1e-9):.1f} CPU"
+        )
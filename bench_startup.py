@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import websockets
+
+# Đo thời gian khởi động của API:
+#   python bench_startup.py --runs 5
+# - cold import: thời gian `import config` trong một tiến trình Python mới
+# - first socket: từ lúc chạy uvicorn tới khi /api/chat nhận kết nối và trả frame chào đầu tiên
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import config; print(time.perf_counter() - t)"
+
+
+def cold_import() -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+async def first_socket(port: int, timeout: float) -> float:
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "config:app", "--port", str(port), "--log-level", "warning"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                async with websockets.connect(f"ws://127.0.0.1:{port}/api/chat") as socket:
+                    await socket.send(json.dumps({"type": "init"}))
+                    await asyncio.wait_for(socket.recv(), timeout)
+                    return time.perf_counter() - started
+            except (OSError, websockets.InvalidHandshake):
+                await asyncio.sleep(0.02)
+        raise TimeoutError(f"/api/chat chưa sẵn sàng sau {timeout} giây")
+    finally:
+        server.terminate()
+        try:
+            server.wait(5)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thời gian import và khởi động API")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    imports = [cold_import() for _ in range(args.runs)]
+    sockets = [asyncio.run(first_socket(args.port, args.timeout)) for _ in range(args.runs)]
+    print(f"cold import config: median {statistics.median(imports) * 1000:.0f} ms, max {max(imports) * 1000:.0f} ms")
+    print(f"first /api/chat frame: median {statistics.median(sockets) * 1000:.0f} ms, max {max(sockets) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import random
+import time
+import stt
+from stt import STTRouter, percentile
+
+# Mô phỏng độ trễ STT có đuôi dài để so sánh chỉ gọi backend chính với hedged request:
+#   python bench_stt.py --turns 500
+# Thời gian được co lại theo --scale để chạy nhanh; số liệu in ra đã quy về giây thật.
+
+
+def fake_backend(median: float, tail: float, tail_rate: float, scale: float, calls: dict, name: str):
+    async def backend(audio: bytes, filename: str) -> str:
+        calls[name] += 1
+        latency = random.lognormvariate(0, 0.25) * median
+        if random.random() < tail_rate:
+            latency += random.uniform(0, tail)
+        await asyncio.sleep(latency * scale)
+        return "xin chào"
+    return backend
+
+
+async def run(hedge: bool, turns: int, scale: float, concurrency: int) -> dict:
+    calls = {"whisper": 0, "assemblyai": 0}
+    backends = {"whisper": fake_backend(1.2, 8.0, 0.06, scale, calls, "whisper")}
+    if hedge:
+        backends["assemblyai"] = fake_backend(1.8, 6.0, 0.04, scale, calls, "assemblyai")
+    router = STTRouter(backends, primary="whisper", timeout=20 * scale)
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def turn():
+        async with slots:
+            started = time.perf_counter()
+            await router.transcribe(b"", "a.webm")
+            latencies.append((time.perf_counter() - started) / scale)
+
+    await asyncio.gather(*(turn() for _ in range(turns)))
+    return {
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "mean": sum(latencies) / len(latencies),
+        "calls_per_turn": sum(calls.values()) / turns,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hedged STT trên backend giả lập")
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--scale", type=float, default=0.01)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    # Ngưỡng hedge tối thiểu/mặc định cũng phải co theo thời gian mô phỏng
+    stt.STT_HEDGE_DELAY *= args.scale
+    stt.STT_HEDGE_MIN *= args.scale
+    stt.STT_HEDGE_MAX *= args.scale
+    for hedge in (False, True):
+        result = asyncio.run(run(hedge, args.turns, args.scale, args.concurrency))
+        label = "hedged" if hedge else "chỉ Whisper"
+        print(f"{label:>12}: p50 {result['p50']:.2f}s  p99 {result['p99']:.2f}s  "
+              f"trung bình {result['mean']:.2f}s  {result['calls_per_turn']:.2f} lời gọi/lượt")
+
+
+if __name__ == "__main__":
+    main()
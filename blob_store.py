@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import os
+import re
+import time
+import uuid
+
+# Kho file âm thanh sinh ra cho từng câu trả lời, xóa dần bởi janitor theo dung lượng và tuổi
+AUDIO_STORE_DIR = os.getenv("AUDIO_STORE_DIR", os.path.join("data", "audio"))
+AUDIO_STORE_MAX_BYTES = int(os.getenv("AUDIO_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+AUDIO_STORE_MAX_AGE = float(os.getenv("AUDIO_STORE_MAX_AGE", "86400"))
+JANITOR_INTERVAL = float(os.getenv("AUDIO_STORE_JANITOR_INTERVAL", "300"))
+CHUNK_SIZE = 64 * 1024
+
+_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore():
+    """Kho blob theo địa chỉ nội dung trên đĩa.
+
+    Mỗi blob nằm ở `<root>/<2 ký tự đầu>/<key><suffix>`, được ghi nguyên tử
+    (file tạm + os.replace) nên nhiều request ghi song song không đè lên nhau.
+    Đọc một blob sẽ cập nhật mtime, janitor dựa vào đó để xóa blob quá hạn
+    rồi xóa blob ít dùng nhất cho tới khi tổng dung lượng dưới giới hạn.
+    """
+
+    def __init__(self, root=AUDIO_STORE_DIR, max_bytes=AUDIO_STORE_MAX_BYTES,
+                 max_age=AUDIO_STORE_MAX_AGE, suffix=".mp3"):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.suffix = suffix
+        self.stats = {"writes": 0, "reads": 0, "evicted": 0, "expired": 0}
+
+    def path(self, key: str) -> str:
+        # Key luôn là hex sha256: không thể trỏ ra ngoài thư mục kho
+        if not _KEY_PATTERN.match(key):
+            raise ValueError(f"Key không hợp lệ: {key!r}")
+        return os.path.join(self.root, key[:2], key + self.suffix)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def put(self, data: bytes, key: str = None) -> str:
+        key = key or content_key(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.stats["writes"] += 1
+        return key
+
+    def get(self, key: str):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        self.stats["reads"] += 1
+        return data
+
+    def iter_chunks(self, key: str, chunk_size: int = CHUNK_SIZE):
+        path = self.path(key)
+        with open(path, "rb") as f:
+            os.utime(path)
+            self.stats["reads"] += 1
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _entries(self):
+        if not os.path.isdir(self.root):
+            return []
+        entries = []
+        for bucket in os.scandir(self.root):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                if entry.name.endswith(self.suffix):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def sweep(self) -> dict:
+        # Xóa blob quá tuổi, sau đó xóa theo LRU (mtime) tới khi tổng dung lượng dưới giới hạn
+        now = time.time()
+        entries = sorted(self._entries())
+        kept = []
+        for mtime, size, path in entries:
+            if now - mtime > self.max_age:
+                self._remove(path, "expired")
+            else:
+                kept.append((mtime, size, path))
+        total = sum(size for _, size, _ in kept)
+        for _, size, path in kept:
+            if total <= self.max_bytes:
+                break
+            self._remove(path, "evicted")
+            total -= size
+        return {"bytes": total, **self.stats}
+
+    def _remove(self, path: str, reason: str):
+        try:
+            os.remove(path)
+            self.stats[reason] += 1
+        except FileNotFoundError:
+            pass
+
+    async def run_janitor(self, interval: float = JANITOR_INTERVAL):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"Error: janitor không dọn được {self.root}: {e}")
+            await asyncio.sleep(interval)
+
+
+audio_store = BlobStore()
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import os
+from resp import RespError, encode_reply, read_reply
+
+# Broker cục bộ nói giao thức Redis (chỉ các lệnh bus cần: pub/sub và set), dùng thay Redis
+# khi chạy nhiều worker trên một máy:
+#   python broker.py --port 6380
+
+BROKER_HOST = os.getenv("BROKER_HOST", "127.0.0.1")
+BROKER_PORT = int(os.getenv("BROKER_PORT", "6380"))
+
+
+class Broker():
+    def __init__(self):
+        self.channels = {}
+        self.sets = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscriptions = set()
+        try:
+            while True:
+                try:
+                    request = await read_reply(reader)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    break
+                if not isinstance(request, list) or not request:
+                    writer.write(encode_reply(RespError("ERR lệnh không hợp lệ")))
+                    continue
+                name = request[0].decode().upper()
+                args = request[1:]
+                if name == "SUBSCRIBE":
+                    for channel in args:
+                        self.channels.setdefault(channel, set()).add(writer)
+                        subscriptions.add(channel)
+                        writer.write(encode_reply([b"subscribe", channel, len(subscriptions)]))
+                elif name == "UNSUBSCRIBE":
+                    for channel in args or list(subscriptions):
+                        self._unsubscribe(channel, writer)
+                        subscriptions.discard(channel)
+                        writer.write(encode_reply([b"unsubscribe", channel, len(subscriptions)]))
+                else:
+                    writer.write(encode_reply(self.execute(name, args)))
+                await writer.drain()
+        finally:
+            for channel in subscriptions:
+                self._unsubscribe(channel, writer)
+            writer.close()
+
+    def _unsubscribe(self, channel: bytes, writer):
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.channels[channel]
+
+    def execute(self, name: str, args: list):
+        if name == "PING":
+            return "PONG"
+        if name == "PUBLISH":
+            channel, message = args
+            subscribers = list(self.channels.get(channel, ()))
+            frame = encode_reply([b"message", channel, message])
+            for subscriber in subscribers:
+                subscriber.write(frame)
+            return len(subscribers)
+        if name == "SADD":
+            members = self.sets.setdefault(args[0], set())
+            before = len(members)
+            members.update(args[1:])
+            return len(members) - before
+        if name == "SREM":
+            members = self.sets.get(args[0], set())
+            before = len(members)
+            members.difference_update(args[1:])
+            if not members:
+                self.sets.pop(args[0], None)
+            return before - len(members)
+        if name == "SMEMBERS":
+            return list(self.sets.get(args[0], ()))
+        if name == "DEL":
+            return sum(1 for key in args if self.sets.pop(key, None) is not None)
+        return RespError(f"ERR lệnh không hỗ trợ '{name}'")
+
+
+async def serve(host: str = BROKER_HOST, port: int = BROKER_PORT):
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle, host, port)
+    print(f"Broker đang chạy tại {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Broker pub/sub cục bộ tương thích Redis cho session bus")
+    parser.add_argument("--host", default=BROKER_HOST)
+    parser.add_argument("--port", type=int, default=BROKER_PORT)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import os
+import socket
+import uuid
+from urllib.parse import urlparse
+from resp import RespConnection, RespError, encode, read_reply
+
+# Bus giữa các worker: mỗi worker nghe trên kênh riêng, danh bạ user_id -> worker dùng chung.
+#   SESSION_BUS=memory  chỉ một tiến trình (mặc định)
+#   SESSION_BUS=broker  Redis hoặc broker.py, địa chỉ trong SESSION_BUS_URL
+SESSION_BUS = os.getenv("SESSION_BUS", "memory")
+SESSION_BUS_URL = os.getenv("SESSION_BUS_URL", "redis://127.0.0.1:6380")
+RECONNECT_DELAY = float(os.getenv("SESSION_BUS_RECONNECT_DELAY", "1"))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def worker_channel(worker_id: str) -> str:
+    return f"worker:{worker_id}"
+
+
+def session_key(user_id: str) -> str:
+    return f"sessions:{user_id}"
+
+
+class InProcessBus():
+    """Bus trong cùng tiến trình, dùng khi chạy một worker."""
+
+    def __init__(self):
+        self._handlers = {}
+        self._directory = {}
+
+    async def start(self, worker_id: str, handler):
+        self._handlers[worker_id] = handler
+
+    async def publish(self, worker_id: str, message: dict) -> int:
+        handler = self._handlers.get(worker_id)
+        if handler is None:
+            return 0
+        await handler(message)
+        return 1
+
+    async def claim(self, user_id: str, worker_id: str):
+        self._directory.setdefault(user_id, set()).add(worker_id)
+
+    async def release(self, user_id: str, worker_id: str):
+        owners = self._directory.get(user_id)
+        if owners is not None:
+            owners.discard(worker_id)
+            if not owners:
+                del self._directory[user_id]
+
+    async def owners(self, user_id: str) -> set:
+        return set(self._directory.get(user_id, ()))
+
+    async def close(self):
+        self._handlers.clear()
+
+
+class BrokerBus():
+    """Bus qua broker nói giao thức Redis (Redis thật hoặc broker.py).
+
+    Mỗi worker SUBSCRIBE kênh worker:<id> trên một kết nối riêng; danh bạ phiên
+    là các set sessions:<user_id> chứa id các worker đang giữ socket của user.
+    Khi mất kết nối, worker tự nối lại, subscribe lại và khai báo lại các user
+    của mình (broker có thể đã khởi động lại và mất danh bạ).
+    """
+
+    def __init__(self, url: str = SESSION_BUS_URL):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.worker_id = None
+        self.handler = None
+        self._conn = None
+        self._conn_lock = asyncio.Lock()
+        self._listener = None
+        self._claims = set()
+        self._tasks = set()
+
+    async def _connection(self) -> RespConnection:
+        # Lock: nhiều lệnh cùng thấy chưa có kết nối thì chỉ một lệnh mở kết nối mới
+        async with self._conn_lock:
+            if self._conn is None:
+                self._conn = await RespConnection(self.host, self.port).connect()
+            return self._conn
+
+    async def _command(self, *args):
+        # Thử lại một lần trên kết nối mới nếu kết nối cũ đã đứt
+        for attempt in range(2):
+            connection = None
+            try:
+                connection = await self._connection()
+                return await connection.command(*args)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                async with self._conn_lock:
+                    # Lệnh khác có thể đã thay kết nối mới, chỉ bỏ đúng kết nối vừa đứt
+                    if connection is not None and self._conn is connection:
+                        self._conn = None
+                        await connection.close()
+                if attempt:
+                    raise
+
+    async def start(self, worker_id: str, handler):
+        self.worker_id = worker_id
+        self.handler = handler
+        ready = asyncio.get_running_loop().create_future()
+        self._listener = asyncio.create_task(self._listen(ready))
+        await ready
+
+    async def _listen(self, ready):
+        channel = worker_channel(self.worker_id)
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                print(f"Không kết nối được broker {self.host}:{self.port}: {e!r}")
+                if not ready.done():
+                    ready.set_exception(e)
+                    return
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                writer.write(encode("SUBSCRIBE", channel))
+                await writer.drain()
+                await read_reply(reader)
+                if ready.done():
+                    await self._reclaim()
+                else:
+                    ready.set_result(True)
+                while True:
+                    # Một message hỏng chỉ bị bỏ qua, không được làm dừng vòng nghe của worker
+                    try:
+                        reply = await read_reply(reader)
+                    except RespError as e:
+                        print(f"Broker trả lỗi trên kênh subscribe: {e!r}")
+                        continue
+                    if not (isinstance(reply, list) and reply[:1] == [b"message"]):
+                        continue
+                    try:
+                        message = json.loads(reply[2])
+                    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                        print(f"Bỏ qua message không hợp lệ từ bus: {e!r}")
+                        continue
+                    self._dispatch(message)
+            except Exception as e:
+                if not ready.done():
+                    ready.set_exception(e)
+                    return
+                print(f"Mất kết nối subscribe tới broker: {e!r}, đang nối lại...")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                writer.close()
+
+    def _dispatch(self, message: dict):
+        # Không chặn vòng đọc: mỗi message được giao trong task riêng
+        task = asyncio.create_task(self._deliver(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, message: dict):
+        try:
+            await self.handler(message)
+        except Exception as e:
+            print(f"Lỗi khi xử lý message từ bus: {e!r}")
+
+    async def _reclaim(self):
+        for user_id in list(self._claims):
+            await self.claim(user_id, self.worker_id)
+
+    async def publish(self, worker_id: str, message: dict) -> int:
+        # Trả về số worker đã nhận; 0 nghĩa là worker đó không còn sống
+        try:
+            return await self._command("PUBLISH", worker_channel(worker_id), json.dumps(message, ensure_ascii=False))
+        except Exception as e:
+            print(f"Không publish được tới {worker_id}: {e!r}")
+            return 0
+
+    async def claim(self, user_id: str, worker_id: str):
+        if worker_id == self.worker_id:
+            self._claims.add(user_id)
+        try:
+            await self._command("SADD", session_key(user_id), worker_id)
+        except Exception as e:
+            print(f"Không ghi được danh bạ phiên cho {user_id}: {e!r}")
+
+    async def release(self, user_id: str, worker_id: str):
+        if worker_id == self.worker_id:
+            self._claims.discard(user_id)
+        try:
+            await self._command("SREM", session_key(user_id), worker_id)
+        except Exception as e:
+            print(f"Không xóa được danh bạ phiên cho {user_id}: {e!r}")
+
+    async def owners(self, user_id: str) -> set:
+        try:
+            members = await self._command("SMEMBERS", session_key(user_id))
+        except Exception as e:
+            print(f"Không đọc được danh bạ phiên cho {user_id}: {e!r}")
+            return set()
+        return {member.decode("utf-8") for member in members}
+
+    async def close(self):
+        # Trả lại các user của worker này để worker khác không publish vào kênh chết
+        for user_id in list(self._claims):
+            await self.release(user_id, self.worker_id)
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._listener = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+def create_bus(kind: str = SESSION_BUS, url: str = SESSION_BUS_URL):
+    if kind == "broker":
+        return BrokerBus(url)
+    if kind == "memory":
+        return InProcessBus()
+    raise ValueError(f"SESSION_BUS không hợp lệ: {kind}")
+
+
+bus = create_bus()
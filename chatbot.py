@@ -1,7 +1,8 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import openai
 from fastapi.middleware.cors import CORSMiddleware
+from llm import gateway
+from structured import parse_turn, response_format
 
 app = FastAPI()
 
@@ -46,18 +47,18 @@ async def chat(request: ChatRequest):
             "Nếu tất cả các trường đã được điền, hãy trả về thông báo xác nhận. "
             "Trả về kết quả dưới dạng JSON với các trường đã điền nhưng viết tên các trường họ tên là name, tuổi là age, số điện thoại là phone, triệu chứng là symptoms, chuyên khoa là departments, form trả về chỉ gồm các trường đã có thông tin và câu trả lời tự nhiên bằng tiếng Việt."        )
 
-        response = openai.chat.completions.create(
-            model="gpt-4",
-            messages=[
+        # gpt-4 không hỗ trợ response_format nên dùng gpt-4o với chế độ JSON object
+        reply = await gateway.complete(
+            "gpt-4o",
+            [
                 {"role": "system", "content": "Bạn là một chatbot trợ giúp điền form đăng ký khám bệnh tại bệnh viện. Trả về kết quả dưới dạng JSON với hai phần: 'form' chứa dữ liệu điền vào form và 'reply' chứa câu trả lời tự nhiên."},
                 {"role": "user", "content": prompt}
-            ]
+            ],
+            response_format=response_format()
         )
-
-        reply = response.choices[0].message.content
         
-        import json
-        result = json.loads(reply)  
+        # JSON lẫn văn bản hoặc bị cắt được khôi phục, tối đa một lần gọi sửa
+        result = await parse_turn(reply, schema=None)
         sanitized_form = {}
         for key, value in result.get("form", {}).items():
             sanitized_form[key] = "" if value is None else value
@@ -1,27 +1,49 @@
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from pymongo import MongoClient
-import openai
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List, Dict
 import json
+import asyncio
 import uvicorn
 import uuid
-from test import get_search_results
+from test import get_search_results, VECTOR_BACKEND, collection as test_collection
+import vector_index
+from llm import gateway
+from persistence import ChatHistoryWriter
+from sessions import SessionRegistry
+from session import Session, Message
+import protocol
+from protocol import DeltaChannel
+from session_store import SessionStore, issue_resume_token
+from inbox import is_chat, is_form_update, stats as inbox_stats
+from embedding import router as voice_router
+from bus import bus, WORKER_ID
+from form_schema import form_schema, FormState
+from providers import providers
+from structured import TURN_FORMAT, clean_form, parse_turn, updates_to_form
+from prompts import SYSTEM_PROMPT, TURN_PREFIX, TURN_PREFIX_TOKENS, TURN_TEMPLATE, NEXT_FIELD_TASK, CONFIRM_TASK, turn_messages
+from context import count_tokens
+from json_stream import ReplyStreamParser
+from extractors import extract_field, templated_reply, stats as extractor_stats, GREETING, SKIP_FIELD_TEMPLATE, SKIP_ALL_REPLY
+from metrics import metrics
+import reflection
+import structured
+import tts
+from stt import stt_router
+from blob_store import audio_store
+from embedding_cache import embedding_cache
+from search_cache import search_cache
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
-mongo_client = MongoClient(os.getenv("MONGODB_URI"))
-db = mongo_client["Vitalink"]
-collection = db["Chat_history"]
+collection = providers.collection("Chat_history")
+history_writer = ChatHistoryWriter(collection)
+session_store = SessionStore(collection, history_writer)
 
 app = FastAPI()
 
-class Message(BaseModel):
-    message: str
-    sender: str
-
 class ChatRequest(BaseModel):
     message: str
     formData: dict = {}
@@ -33,11 +55,8 @@ class SubmitRequest(BaseModel):
     user_id: str
     symptoms: str
 
-# Danh sách các client WebSocket
-clients: List[WebSocket] = []
-
-# Khởi tạo OpenAI client
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Các client WebSocket đang mở, tra cứu theo user_id
+clients = SessionRegistry()
 
 app.add_middleware(
     CORSMiddleware,
@@ -47,28 +66,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def get_response(question: str) -> str:
+app.include_router(voice_router)
+
+async def get_response(question: str, system: str = SYSTEM_PROMPT, **kwargs) -> str:
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Bạn là một chatbot hỗ trợ điền form đăng ký khám bệnh tại bệnh viện. "
-                        "Mọi phản hồi của bạn phải là một chuỗi JSON hợp lệ với hai trường: "
-                        "'form' (object chứa thông tin form được cập nhật) và 'reply' (chuỗi chứa câu trả lời tự nhiên bằng tiếng Việt). "
-                        "Ví dụ: {\"form\": {\"personal\": {\"name\": \"Nguyễn Văn A\"}}, \"reply\": \"Oke, tôi đã ghi họ tên là Nguyễn Văn A.\"}. "
-                        "Không bao giờ trả về văn bản thông thường ngoài JSON."
-                    )
-                },
-                {"role": "user", "content": question}
-            ]
-        )
-        return response.choices[0].message.content
+        return await gateway.complete("gpt-4o-mini", turn_messages(question, system), **kwargs)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def get_response_stream(session: Session, question: str, system: str = SYSTEM_PROMPT, **kwargs) -> str:
+    # Chuyển tiếp từng đoạn reply ngay khi model sinh ra và gửi form ngay khi danh sách cập nhật đóng
+    parser = ReplyStreamParser(form_key="updates")
+    try:
+        async for chunk in gateway.stream("gpt-4o-mini", turn_messages(question, system), **kwargs):
+            for kind, value in parser.feed(chunk):
+                if kind == "reply":
+                    await session.send_text(json.dumps({"type": "reply_delta", "delta": value}))
+                else:
+                    await session.send_text(json.dumps({"type": "form_patch", "form": clean_form(updates_to_form(value))}))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return parser.text
+
 def get_filled_fields(form_data: dict) -> dict:
     if not isinstance(form_data, dict):
         return {}
@@ -86,661 +105,491 @@ def get_filled_fields(form_data: dict) -> dict:
 @app.websocket("/api/chat")
 async def chat(websocket: WebSocket):
     await websocket.accept()
-    websocket.formData = {
-        "personal": {},
-        "medical": {},
-        "symptom_details": {},
-        "history": {},
-        "family": {}
-    }
-    websocket.chat_history = []
-    websocket.last_asked_field = None
-    websocket.last_asked_category = None
-    websocket.ask_count = 0
-    websocket.last_message = None
-    clients.append(websocket)
+    session = Session(websocket)
+    clients.register(session)
+    worker = asyncio.create_task(process_inbox(session))
     
     try:
         while True:
             message = await websocket.receive_text()
-            if message != websocket.last_message:
-                websocket.last_message = message
-                await handle_message(websocket, message)
+            if message != session.last_message:
+                session.last_message = message
+                await enqueue_message(session, message)
     except WebSocketDisconnect:
-        handle_disconnect(websocket)
-
-async def handle_message(websocket: WebSocket, message: str):
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+        await handle_disconnect(session)
+
+async def enqueue_message(session: Session, message: str):
+    # Vòng nhận không chờ xử lý xong: tin nhắn vào hàng đợi của phiên, lượt chat mới hủy
+    # lời gọi LLM đang chạy của lượt cũ vì câu trả lời đó sẽ không còn đúng ngữ cảnh
     try:
         data = json.loads(message)
-        
-        if data.get("type") == "init" and not hasattr(websocket, "user_id"):
-            user_id = str(uuid.uuid4())
-            websocket.user_id = user_id
+    except json.JSONDecodeError:
+        data = None
+    inbox_stats["received"] += 1
+    if is_form_update(data) and session.user_id is not None:
+        # formUpdate chỉ gộp form và gửi lại, áp dụng ngay thay vì xếp sau một lượt chat chậm;
+        # trước init thì vẫn xếp hàng để không bị trạng thái khôi phục ghi đè
+        inbox_stats["form_updates"] += 1
+        await handle_message(session, message)
+        return
+    if is_chat(data) and session.llm_call is not None and not session.llm_call.done():
+        session.llm_call.cancel()
+        session.llm_call = None
+        inbox_stats["superseded"] += 1
+    if not session.inbox.put_nowait(message, data):
+        inbox_stats["backpressure"] += 1
+        await session.send_text(json.dumps({"type": "busy", "queued": len(session.inbox)}))
+        await session.inbox.put(message, data)
+
+async def process_inbox(session: Session):
+    while True:
+        message, superseded = await session.inbox.get()
+        try:
+            await handle_message(session, message, reply=not superseded)
+        except Exception as e:
+            print(f"Error: {e}")
+
+async def handle_message(session: Session, message: str, reply: bool = True):
+    # Chỉ lỗi parse của chính tin nhắn client mới là "văn bản thường"; lỗi JSON từ output
+    # của model không được rơi vào nhánh này (trước đây làm lượt chat bị xử lý hai lần)
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError:
+        data = None
 
-            filled_fields = get_filled_fields(websocket.formData)
-            if not any(filled_fields.values()):
-                greeting = "Chào bạn! Tôi là chatbot hỗ trợ đăng ký khám bệnh. Bạn cần tôi giúp gì hôm nay?"
-            else:
-                filled_info = ", ".join([f"{key}: {value}" for category in filled_fields for key, value in filled_fields[category].items()])
-                greeting = f"Chào bạn! Tôi thấy bạn đã điền {filled_info}. Bạn muốn tôi giúp gì tiếp theo?"
-            websocket.chat_history.append(Message(message=greeting, sender="Bot"))
-            await websocket.send_text(json.dumps({
-                "user_id": user_id,
-                "chat_history": [msg.dict() for msg in websocket.chat_history]
-            }))
-            collection.update_one(
-                {"user_id": user_id},
-                {"$set": {"chat_history": [msg.dict() for msg in websocket.chat_history]}},
-                upsert=True
-            )
+    try:
+        if not isinstance(data, dict):
+            if session.user_id is None:
+                await set_user_id(session, str(uuid.uuid4()))
+            await handle_chat(session, message, reply)
+
+        elif data.get("type") == "init" and data.get("protocol") == protocol.PROTOCOL_VERSION and session.user_id is None:
+            await handle_init_v2(session, data)
+
+        elif data.get("type") == "init" and session.user_id is None:
+            # Client gửi lại user_id và resume token cũ (mất sóng, tải lại trang): khôi phục form và lịch sử
+            state = await session_store.load(data["user_id"], data.get("resume_token")) if data.get("user_id") else None
+            if state is not None:
+                session.restore(state)
+                session.channel = None
+                session.stream = bool(data.get("stream"))
+                await set_user_id(session, session.user_id)
+                await session.send_text(session.history_frame())
+                await session.send_text(json.dumps({"form": get_filled_fields(session.formData)}))
+                return
+
+            user_id = str(uuid.uuid4())
+            await set_user_id(session, user_id)
+            session.stream = bool(data.get("stream"))
+            resume_token = issue_resume_token(session)
+
+            greeting = session.add_message(greeting_text(session.formData), "Bot")
+            history_writer.append(user_id, [greeting])
+            session_store.save(session)
+            await session.send_text(session.history_frame(resume_token=resume_token))
         
         elif data.get("type") == "formUpdate":
             received_form_data = data.get("data", {})
-            websocket.formData = merge_form_data(websocket.formData, {"form": received_form_data})
-            filled_fields = get_filled_fields(websocket.formData)
-            await websocket.send_text(json.dumps({"form": filled_fields}))
+            session.formData = merge_form_data(session.formData, {"form": received_form_data}, session.form_state)
+            if session.channel is not None:
+                await send_delta(session, form=session.formData)
+            else:
+                filled_fields = get_filled_fields(session.formData)
+                await session.send_text(json.dumps({"form": filled_fields}))
+            session_store.save(session)
         
         elif data.get("type") == "chat" or "type" not in data:
-            websocket.user_id = data.get("user_id")
-            if not hasattr(websocket, "user_id"):
-                user_id = str(uuid.uuid4())
-                websocket.user_id = user_id
-            
-            websocket.chat_history.append(Message(message=data.get("message", message), sender="You"))
-            await broadcast_messages(websocket)
-   
-            prompt = generate_prompt(websocket, data.get("message", message))
-            response = get_response(prompt)
-            print(f"Raw response: {response}")
-            
-            result = json.loads(response)
-            websocket.formData = merge_form_data(websocket.formData, result)
-            
-            # Cập nhật last_asked_field và last_asked_category dựa trên result["form"]
-            if "form" in result and any(result["form"].values()):
-                for category in result["form"]:
-                    for field in result["form"][category]:
-                        websocket.last_asked_field = field
-                        websocket.last_asked_category = category
-            
-            # Kiểm tra nếu form rỗng và đang hỏi lại cùng một trường
-            current_field = websocket.last_asked_field
-            current_category = websocket.last_asked_category
-            next_field = None
-            next_category = None
-
-            if "form" in result and not any(result["form"].values()):  # Kiểm tra nếu form rỗng
-                websocket.ask_count += 1
-                print(f"Ask count: {websocket.ask_count}, Current field: {current_field}")
-                if websocket.ask_count >= 3:
-                    websocket.ask_count = 0
-                    personal_fields = ["name", "dob", "gender", "cccd", "province", "district", "ward", "address", "phone", "symptoms"]
-                    medical_fields = []
-                    symptom_detail_fields = ["site", "onset", "character", "radiation", "alleviating", "timing", "exacerbating", "severity", "previous_check"]
-                    history_fields = ["position", "last", "occasion", "vadap", "cangay", "duration", "spread"]
-                    family_fields = ["ditruyen", "last", "occasion", "vadap"]
-
-                    missing_personal = [field for field in personal_fields if field not in websocket.formData["personal"] or not websocket.formData["personal"].get(field)]
-                    missing_medical = [field for field in medical_fields if field not in websocket.formData["medical"] or not websocket.formData["medical"].get(field)]
-                    missing_symptom_details = [field for field in symptom_detail_fields if field not in websocket.formData["symptom_details"] or not websocket.formData["symptom_details"].get(field)]
-                    missing_history = [field for field in history_fields if field not in websocket.formData["history"] or not websocket.formData["history"].get(field)]
-                    missing_family = [field for field in family_fields if field not in websocket.formData["family"] or not websocket.formData["family"].get(field)]
-
-                    # Đảm bảo hỏi tuần tự trong personal trước khi chuyển category
-                    if missing_personal:
-                        # Tìm trường tiếp theo chưa được hỏi trong personal
-                        for field in personal_fields:
-                            if field in missing_personal:
-                                next_field = field
-                                next_category = "personal"
-                                break
-                    elif missing_medical:
-                        for field in medical_fields:
-                            if field in missing_medical:
-                                next_field = field
-                                next_category = "medical"
-                                break
-                    elif missing_symptom_details and "symptoms" in websocket.formData["personal"] and websocket.formData["personal"]["symptoms"]:
-                        for field in symptom_detail_fields:
-                            if field in missing_symptom_details:
-                                next_field = field
-                                next_category = "symptom_details"
-                                break
-                    elif missing_history:
-                        for field in history_fields:
-                            if field in missing_history:
-                                next_field = field
-                                next_category = "history"
-                                break
-                    elif missing_family:
-                        for field in family_fields:
-                            if field in missing_family:
-                                next_field = field
-                                next_category = "family"
-                                break
-
-                    if next_field:
-                        field_labels = {
-                            "name": "họ tên", "dob": "ngày sinh", "gender": "giới tính", "cccd": "số CCCD",
-                            "province": "tỉnh/thành", "district": "quận/huyện", "ward": "xã/phường", "address": "địa chỉ",
-                            "phone": "số điện thoại", "symptoms": "triệu chứng", "site": "vị trí triệu chứng",
-                            "onset": "thời điểm khởi phát triệu chứng", "character": "tính chất triệu chứng",
-                            "radiation": "triệu chứng lan tỏa hoặc kèm theo", "alleviating": "yếu tố làm giảm triệu chứng",
-                            "timing": "thời gian và tần suất triệu chứng", "exacerbating": "yếu tố làm nặng triệu chứng",
-                            "severity": "mức độ triệu chứng (1-10)", "previous_check": "đã khám ở đâu chưa trước đó với triệu chứng này",
-                            "position": "bệnh lý đã mắc trước đó", "last": "phẫu thuật bao giờ chưa", "occasion": "dị ứng",
-                            "vadap": "tiền sử dịch tễ", "cangay": "tiền sử thai sản, kinh nguyệt", "duration": "rượu bia, chất kích thích",
-                            "spread": "thói quen sinh hoạt, chế độ ăn", "ditruyen": "gia đình có tiền sử bệnh nào có tính di truyền không",
-                            "last": "xung quanh có tiền sử bệnh nào có tính di truyền không", "occasion": "gia đình có ai có bệnh lý nội khoa không",
-                            "vadap": "hàng xóm có ai tiếp xúc mà có triệu chứng tương tự không"
-                        }
-                        if current_category != next_category:
-                            await websocket.send_text(json.dumps({
-                                "type": "next",
-                                "category": next_category
-                            }))
-                        result["reply"] = f"Hmm, có vẻ bạn chưa cung cấp thông tin về {field_labels[current_field]}. Không sao, chúng ta sẽ quay lại sau. Bạn có thể cho tôi biết {field_labels[next_field]} của bạn không?"
-                        websocket.last_asked_field = next_field
-                        websocket.last_asked_category = next_category
-                    else:
-                        result["reply"] = "Hình như bạn chưa cung cấp đủ thông tin, nhưng không sao, chúng ta sẽ quay lại sau. Bạn có muốn tiếp tục không?"
-                        websocket.last_asked_field = None
-                        websocket.last_asked_category = None
-            else:
-                websocket.ask_count = 0
-                personal_fields = ["name", "dob", "gender", "cccd", "province", "district", "ward", "address", "phone", "symptoms"]
-                medical_fields = []
-                symptom_detail_fields = ["site", "onset", "character", "radiation", "alleviating", "timing", "exacerbating", "severity", "previous_check"]
-                history_fields = ["position", "last", "occasion", "vadap", "cangay", "duration", "spread"]
-                family_fields = ["ditruyen", "last", "occasion", "vadap"]
-
-                missing_personal = [field for field in personal_fields if field not in websocket.formData["personal"] or not websocket.formData["personal"].get(field)]
-                missing_medical = [field for field in medical_fields if field not in websocket.formData["medical"] or not websocket.formData["medical"].get(field)]
-                missing_symptom_details = [field for field in symptom_detail_fields if field not in websocket.formData["symptom_details"] or not websocket.formData["symptom_details"].get(field)]
-                missing_history = [field for field in history_fields if field not in websocket.formData["history"] or not websocket.formData["history"].get(field)]
-                missing_family = [field for field in family_fields if field not in websocket.formData["family"] or not websocket.formData["family"].get(field)]
-
-                # Đảm bảo hỏi tuần tự trong personal trước khi chuyển category
-                if missing_personal:
-                    for field in personal_fields:
-                        if field in missing_personal:
-                            next_field = field
-                            next_category = "personal"
-                            break
-                elif missing_medical:
-                    for field in medical_fields:
-                        if field in missing_medical:
-                            next_field = field
-                            next_category = "medical"
-                            break
-                elif missing_symptom_details and "symptoms" in websocket.formData["personal"] and websocket.formData["personal"]["symptoms"]:
-                    for field in symptom_detail_fields:
-                        if field in missing_symptom_details:
-                            next_field = field
-                            next_category = "symptom_details"
-                            break
-                elif missing_history:
-                    for field in history_fields:
-                        if field in missing_history:
-                            next_field = field
-                            next_category = "history"
-                            break
-                elif missing_family:
-                    for field in family_fields:
-                        if field in missing_family:
-                            next_field = field
-                            next_category = "family"
-                            break
+            await set_user_id(session, data.get("user_id") or session.user_id or str(uuid.uuid4()))
 
-                if next_field:
-                    if current_category != next_category:
-                        await websocket.send_text(json.dumps({
-                            "type": "next",
-                            "category": next_category
-                        }))
-                    websocket.last_asked_field = next_field
-                    websocket.last_asked_category = next_category
-
-            websocket.chat_history.append(Message(message=result["reply"], sender="Bot"))
-            await send_final_form(websocket, websocket.formData, result)
-            
-            collection.update_one(
-                {"user_id": websocket.user_id},
-                {"$set": {"chat_history": [msg.dict() for msg in websocket.chat_history]}},
-                upsert=True
-            )
+            await handle_chat(session, data.get("message", message), reply)
+
+    except Exception as e:
+        print(f"Error: {e}")
+        await session.send_text(json.dumps({"reply": "Đã xảy ra lỗi, vui lòng thử lại."}))
+
+def greeting_text(form_data: dict) -> str:
+    filled_fields = get_filled_fields(form_data)
+    if not any(filled_fields.values()):
+        return GREETING
+    filled_info = ", ".join([f"{key}: {value}" for category in filled_fields for key, value in filled_fields[category].items()])
+    return f"Chào bạn! Tôi thấy bạn đã điền {filled_info}. Bạn muốn tôi giúp gì tiếp theo?"
+
+async def handle_init_v2(session: Session, data: dict):
+    # Protocol 2: gửi snapshot một lần, sau đó chỉ gửi delta có seq; client nối lại kèm
+    # user_id, resume_token, session_id và last_seq thì nhận lại đúng các frame còn thiếu
+    compression = protocol.negotiate_compression(
+        data.get("compression"), session.headers.get("sec-websocket-extensions")
+    )
+    state = await session_store.load(data["user_id"], data.get("resume_token")) if data.get("user_id") else None
+    if state is not None:
+        session.restore(state)
+        session.stream = bool(data.get("stream"))
+        await set_user_id(session, session.user_id)
+        if session.channel is not None and session.session_id == data.get("session_id"):
+            session.channel.set_compression(compression)
+            missed = session.channel.replay(int(data.get("last_seq") or 0))
+        else:
+            # Phiên khôi phục từ Mongo hoặc từ kết nối protocol cũ: bắt đầu luồng seq mới
+            session.session_id = session.connection_id
+            session.channel = DeltaChannel(compression)
+            missed = None
+        welcome = {"protocol": protocol.PROTOCOL_VERSION, "user_id": session.user_id,
+                   "session_id": session.session_id, "compression": compression, "resumed": True}
+        if missed is None:
+            await protocol.send(session, session.channel.snapshot(session.chat_history, session.formData, **welcome))
+            return
+        await session.send_text(json.dumps({"type": "welcome", "seq": session.channel.seq, **welcome}))
+        for text in missed:
+            await protocol.send(session, text)
+        return
+
+    user_id = str(uuid.uuid4())
+    await set_user_id(session, user_id)
+    session.session_id = session.connection_id
+    session.stream = bool(data.get("stream"))
+    session.channel = DeltaChannel(compression)
+    resume_token = issue_resume_token(session)
+    history_writer.append(user_id, [session.add_message(greeting_text(session.formData), "Bot")])
+    session_store.save(session)
+    await protocol.send(session, session.channel.snapshot(
+        session.chat_history, session.formData,
+        protocol=protocol.PROTOCOL_VERSION, user_id=user_id, session_id=session.session_id,
+        compression=compression, resumed=False, resume_token=resume_token
+    ))
+
+async def send_delta(session: Session, form: dict = None, **extra):
+    text = session.channel.delta(session.chat_history, form, **extra)
+    if text is not None:
+        await protocol.send(session, text)
+
+async def set_user_id(session: Session, user_id: str):
+    previous = session.registered_user_id
+    session.user_id = user_id
+    clients.bind(session, user_id)
+    if previous != user_id:
+        # Khai báo với các worker khác rằng socket của user_id đang nằm ở worker này
+        await bus.claim(user_id, WORKER_ID)
+        if previous is not None and previous not in clients:
+            await bus.release(previous, WORKER_ID)
+
+async def handle_chat(session: Session, text: str, reply: bool = True):
+    with metrics.turn("chat", user_id=session.user_id):
+        history_writer.append(session.user_id, [session.add_message(text, "You")])
+        await broadcast_messages(session)
+        if not reply:
+            # Đã có tin nhắn mới hơn trong hàng đợi: lượt đó trả lời cả tin này (vẫn có trong lịch sử)
+            return
+
+        result = fast_path_result(session, text)
+        if result is None:
+            prompt = generate_prompt(session, text)
+            response = await call_model(session, prompt)
+            if response is None:
+                # Người dùng đã gửi tin nhắn mới, lượt sau trả lời cả hai (tin nhắn này vẫn có trong lịch sử)
+                if session.stream:
+                    await session.send_text(json.dumps({"type": "reply_cancelled"}))
+                return
+            # Output lệch định dạng (code fence, JSON cụt) được khôi phục hoặc sửa một lần thay vì làm hỏng lượt
+            result = await parse_turn(response)
+
+        session.formData = merge_form_data(session.formData, result, session.form_state)
     
-    except json.JSONDecodeError:
-        if not hasattr(websocket, "user_id"):
-            user_id = str(uuid.uuid4())
-            websocket.user_id = user_id
-        websocket.chat_history.append(Message(message=message, sender="You"))
-        await broadcast_messages(websocket)
-        
-        prompt = generate_prompt(websocket, message)
-        response = get_response(prompt)
-        result = json.loads(response)
-        websocket.formData = merge_form_data(websocket.formData, result)
-        
+        # Cập nhật last_asked_field và last_asked_category dựa trên result["form"]
         if "form" in result and any(result["form"].values()):
             for category in result["form"]:
                 for field in result["form"][category]:
-                    websocket.last_asked_field = field
-                    websocket.last_asked_category = category
-        
-        current_field = websocket.last_asked_field
-        current_category = websocket.last_asked_category
-        next_field = None
-        next_category = None
-
-        if "form" in result and not any(result["form"].values()):
-            websocket.ask_count += 1
-            print(f"Ask count: {websocket.ask_count}, Current field: {current_field}")
-            if websocket.ask_count >= 3:
-                websocket.ask_count = 0
-                personal_fields = ["name", "dob", "gender", "cccd", "province", "district", "ward", "address", "phone", "symptoms"]
-                medical_fields = []
-                symptom_detail_fields = ["site", "onset", "character", "radiation", "alleviating", "timing", "exacerbating", "severity", "previous_check"]
-                history_fields = ["position", "last", "occasion", "vadap", "cangay", "duration", "spread"]
-                family_fields = ["ditruyen", "last", "occasion", "vadap"]
-
-                missing_personal = [field for field in personal_fields if field not in websocket.formData["personal"] or not websocket.formData["personal"].get(field)]
-                missing_medical = [field for field in medical_fields if field not in websocket.formData["medical"] or not websocket.formData["medical"].get(field)]
-                missing_symptom_details = [field for field in symptom_detail_fields if field not in websocket.formData["symptom_details"] or not websocket.formData["symptom_details"].get(field)]
-                missing_history = [field for field in history_fields if field not in websocket.formData["history"] or not websocket.formData["history"].get(field)]
-                missing_family = [field for field in family_fields if field not in websocket.formData["family"] or not websocket.formData["family"].get(field)]
-
-                if missing_personal:
-                    for field in personal_fields:
-                        if field in missing_personal:
-                            next_field = field
-                            next_category = "personal"
-                            break
-                elif missing_medical:
-                    for field in medical_fields:
-                        if field in missing_medical:
-                            next_field = field
-                            next_category = "medical"
-                            break
-                elif missing_symptom_details and "symptoms" in websocket.formData["personal"] and websocket.formData["personal"]["symptoms"]:
-                    for field in symptom_detail_fields:
-                        if field in missing_symptom_details:
-                            next_field = field
-                            next_category = "symptom_details"
-                            break
-                elif missing_history:
-                    for field in history_fields:
-                        if field in missing_history:
-                            next_field = field
-                            next_category = "history"
-                            break
-                elif missing_family:
-                    for field in family_fields:
-                        if field in missing_family:
-                            next_field = field
-                            next_category = "family"
-                            break
-
+                    session.last_asked_field = field
+                    session.last_asked_category = category
+    
+        # Kiểm tra nếu form rỗng và đang hỏi lại cùng một trường
+        current_field = session.last_asked_field
+        current_category = session.last_asked_category
+
+        if "form" in result and not any(result["form"].values()):  # Kiểm tra nếu form rỗng
+            session.ask_count += 1
+            if session.ask_count >= 3:
+                session.ask_count = 0
+                next_field = await advance_to_next_field(session, current_category)
                 if next_field:
-                    field_labels = {
-                        "name": "họ tên", "dob": "ngày sinh", "gender": "giới tính", "cccd": "số CCCD",
-                        "province": "tỉnh/thành", "district": "quận/huyện", "ward": "xã/phường", "address": "địa chỉ",
-                        "phone": "số điện thoại", "symptoms": "triệu chứng", "site": "vị trí triệu chứng",
-                        "onset": "thời điểm khởi phát triệu chứng", "character": "tính chất triệu chứng",
-                        "radiation": "triệu chứng lan tỏa hoặc kèm theo", "alleviating": "yếu tố làm giảm triệu chứng",
-                        "timing": "thời gian và tần suất triệu chứng", "exacerbating": "yếu tố làm nặng triệu chứng",
-                        "severity": "mức độ triệu chứng (1-10)", "previous_check": "đã khám ở đâu chưa trước đó với triệu chứng này",
-                        "position": "bệnh lý đã mắc trước đó", "last": "phẫu thuật bao giờ chưa", "occasion": "dị ứng",
-                        "vadap": "tiền sử dịch tễ", "cangay": "tiền sử thai sản, kinh nguyệt", "duration": "rượu bia, chất kích thích",
-                        "spread": "thói quen sinh hoạt, chế độ ăn", "ditruyen": "gia đình có tiền sử bệnh nào có tính di truyền không",
-                        "last": "xung quanh có tiền sử bệnh nào có tính di truyền không", "occasion": "gia đình có ai có bệnh lý nội khoa không",
-                        "vadap": "hàng xóm có ai tiếp xúc mà có triệu chứng tương tự không"
-                    }
-                    if current_category != next_category:
-                        await websocket.send_text(json.dumps({
-                            "type": "next",
-                            "category": next_category
-                        }))
-                    result["reply"] = f"Hmm, có vẻ bạn chưa cung cấp thông tin về {field_labels[current_field]}. Không sao, chúng ta sẽ quay lại sau. Bạn có thể cho tôi biết {field_labels[next_field]} của bạn không?"
-                    websocket.last_asked_field = next_field
-                    websocket.last_asked_category = next_category
+                    current_label = form_schema.label(current_category, current_field)
+                    result["reply"] = SKIP_FIELD_TEMPLATE.format(current_label=current_label, next_field_label=next_field.label)
                 else:
-                    result["reply"] = "Hình như bạn chưa cung cấp đủ thông tin, nhưng không sao, chúng ta sẽ quay lại sau. Bạn có muốn tiếp tục không?"
-                    websocket.last_asked_field = None
-                    websocket.last_asked_category = None
+                    result["reply"] = SKIP_ALL_REPLY
+                    session.last_asked_field = None
+                    session.last_asked_category = None
         else:
-            websocket.ask_count = 0
-            personal_fields = ["name", "dob", "gender", "cccd", "province", "district", "ward", "address", "phone", "symptoms"]
-            medical_fields = []
-            symptom_detail_fields = ["site", "onset", "character", "radiation", "alleviating", "timing", "exacerbating", "severity", "previous_check"]
-            history_fields = ["position", "last", "occasion", "vadap", "cangay", "duration", "spread"]
-            family_fields = ["ditruyen", "last", "occasion", "vadap"]
-
-            missing_personal = [field for field in personal_fields if field not in websocket.formData["personal"] or not websocket.formData["personal"].get(field)]
-            missing_medical = [field for field in medical_fields if field not in websocket.formData["medical"] or not websocket.formData["medical"].get(field)]
-            missing_symptom_details = [field for field in symptom_detail_fields if field not in websocket.formData["symptom_details"] or not websocket.formData["symptom_details"].get(field)]
-            missing_history = [field for field in history_fields if field not in websocket.formData["history"] or not websocket.formData["history"].get(field)]
-            missing_family = [field for field in family_fields if field not in websocket.formData["family"] or not websocket.formData["family"].get(field)]
-
-            if missing_personal:
-                for field in personal_fields:
-                    if field in missing_personal:
-                        next_field = field
-                        next_category = "personal"
-                        break
-            elif missing_medical:
-                for field in medical_fields:
-                    if field in missing_medical:
-                        next_field = field
-                        next_category = "medical"
-                        break
-            elif missing_symptom_details and "symptoms" in websocket.formData["personal"] and websocket.formData["personal"]["symptoms"]:
-                for field in symptom_detail_fields:
-                    if field in missing_symptom_details:
-                        next_field = field
-                        next_category = "symptom_details"
-                        break
-            elif missing_history:
-                for field in history_fields:
-                    if field in missing_history:
-                        next_field = field
-                        next_category = "history"
-                        break
-            elif missing_family:
-                for field in family_fields:
-                    if field in missing_family:
-                        next_field = field
-                        next_category = "family"
-                        break
-
-            if next_field:
-                if current_category != next_category:
-                    await websocket.send_text(json.dumps({
-                        "type": "next",
-                        "category": next_category
-                    }))
-                websocket.last_asked_field = next_field
-                websocket.last_asked_category = next_category
-
-        websocket.chat_history.append(Message(message=result["reply"], sender="Bot"))
-        await send_final_form(websocket, websocket.formData, result)
-        
-        collection.update_one(
-            {"user_id": websocket.user_id},
-            {"$set": {"chat_history": [msg.dict() for msg in websocket.chat_history]}},
-            upsert=True
-        )
-    except Exception as e:
-        print(f"Error: {e}")
-        await websocket.send_text(json.dumps({"reply": "Đã xảy ra lỗi, vui lòng thử lại."}))
+            session.ask_count = 0
+            await advance_to_next_field(session, current_category)
 
-async def broadcast_messages(websocket: WebSocket):
-    await websocket.send_text(json.dumps({
-        "user_id": websocket.user_id,
-        "chat_history": [message.dict() for message in websocket.chat_history]
-    }))
+        history_writer.append(session.user_id, [session.add_message(result["reply"], "Bot")])
+        session_store.save(session)
+        await send_final_form(session, session.formData, result)
 
-def generate_prompt(websocket: WebSocket, message: str) -> str:
-    personal_fields = ["name", "dob", "gender", "cccd", "province", "district", "ward", "address", "phone", "symptoms"]
-    medical_fields = []
-    symptom_detail_fields = [
-        "site", "onset", "character", "radiation", "alleviating", 
-        "timing", "exacerbating", "severity", "previous_check"
-    ]
-    history_fields = ["position", "last", "occasion", "vadap", "cangay", "duration", "spread"]
-    family_fields = ["ditruyen", "last", "occasion", "vadap"]
-
-    field_labels = {
-        "name": "họ tên",
-        "dob": "ngày sinh",
-        "gender": "giới tính",
-        "cccd": "số CCCD",
-        "province": "tỉnh/thành",
-        "district": "quận/huyện",
-        "ward": "xã/phường",
-        "address": "địa chỉ",
-        "phone": "số điện thoại",
-        "symptoms": "triệu chứng",
-        "site": "vị trí triệu chứng",
-        "onset": "thời điểm khởi phát triệu chứng",
-        "character": "tính chất triệu chứng",
-        "radiation": "triệu chứng lan tỏa hoặc kèm theo",
-        "alleviating": "yếu tố làm giảm triệu chứng",
-        "timing": "thời gian và tần suất triệu chứng",
-        "exacerbating": "yếu tố làm nặng triệu chứng",
-        "severity": "mức độ triệu chứng (1-10)",
-        "previous_check": "đã khám ở đâu chưa trước đó với triệu chứng này",
-        "position": "bệnh lý đã mắc trước đó",
-        "last": "phẫu thuật bao giờ chưa",
-        "occasion": "dị ứng",
-        "vadap": "tiền sử dịch tễ",
-        "cangay": "tiền sử thai sản, kinh nguyệt",
-        "duration": "rượu bia, chất kích thích",
-        "spread": "thói quen sinh hoạt, chế độ ăn",
-        "ditruyen": "gia đình có tiền sử bệnh nào có tính di truyền không",
-        "last": "xung quanh có tiền sử bệnh nào có tính di truyền không",
-        "occasion": "gia đình có ai có bệnh lý nội khoa không",
-        "vadap": "hàng xóm có ai tiếp xúc mà có triệu chứng tương tự không"
+async def call_model(session: Session, prompt: str):
+    # Trả về None nếu lời gọi bị hủy vì có tin nhắn chat mới hơn
+    if session.stream:
+        call = asyncio.ensure_future(get_response_stream(session, prompt, TURN_PREFIX, response_format=TURN_FORMAT))
+    else:
+        call = asyncio.ensure_future(get_response(prompt, TURN_PREFIX, response_format=TURN_FORMAT))
+    session.llm_call = call
+    try:
+        await asyncio.wait({call})
+    finally:
+        session.llm_call = None
+        call.cancel()
+    if call.cancelled():
+        return None
+    return call.result()
+
+def fast_path_result(session: Session, text: str):
+    # Trường có cấu trúc (số điện thoại, CCCD, ngày sinh...) được trích xuất bằng luật, bỏ qua LLM
+    category, key = session.last_asked_category, session.last_asked_field
+    if not key:
+        return None
+    value = extract_field(category, key, text)
+    if value is None:
+        return None
+    field = form_schema.field(category, key)
+    next_field = form_schema.next_field(session.form_state.filled | 1 << field.bit)
+    if next_field is None:
+        # Câu xác nhận toàn bộ form vẫn để LLM soạn
+        return None
+    extractor_stats["avoided_llm_calls"] += 1
+    return {
+        "form": {category: {key: value}},
+        "reply": templated_reply(field.label, value, next_field.label, len(session.chat_history))
     }
 
-    missing_personal = [field for field in personal_fields if field not in websocket.formData["personal"] or not websocket.formData["personal"].get(field)]
-    missing_medical = [field for field in medical_fields if field not in websocket.formData["medical"] or not websocket.formData["medical"].get(field)]
-    missing_symptom_details = [field for field in symptom_detail_fields if field not in websocket.formData["symptom_details"] or not websocket.formData["symptom_details"].get(field)]
-    missing_history = [field for field in history_fields if field not in websocket.formData["history"] or not websocket.formData["history"].get(field)]
-    missing_family = [field for field in family_fields if field not in websocket.formData["family"] or not websocket.formData["family"].get(field)]
-
-    chat_history_str = "\n".join([f"{msg.sender}: {msg.message}" for msg in websocket.chat_history])
-
+async def advance_to_next_field(session: Session, current_category: str):
+    # Đảm bảo hỏi tuần tự theo thứ tự trong schema, báo client khi chuyển category
+    next_field = session.form_state.next_field()
+    if next_field:
+        if current_category != next_field.category:
+            await session.send_text(json.dumps({
+                "type": "next",
+                "category": next_field.category
+            }))
+        session.last_asked_field = next_field.key
+        session.last_asked_category = next_field.category
+    return next_field
+
+async def broadcast_messages(session: Session):
+    if session.channel is not None:
+        await send_delta(session)
+        return
+    await session.send_text(session.history_frame())
+
+def generate_prompt(session: Session, message: str) -> str:
+    form_state = session.form_state
+    # Chỉ đưa các trường đã điền vào prompt, dạng JSON gọn thay vì repr của cả form
+    form_json = json.dumps(get_filled_fields(session.formData), ensure_ascii=False, separators=(",", ":"))
+
+    filled = form_schema.filled_fields(session.formData, form_state.filled)
     filled_info = "\n".join(
-        [f"- {field_labels[field]}: {websocket.formData['personal'][field]}" for field in personal_fields if field in websocket.formData["personal"] and websocket.formData["personal"][field]] +
-        [f"- {field_labels[field]}: {websocket.formData['medical'][field]}" for field in medical_fields if field in websocket.formData["medical"] and websocket.formData["medical"][field]] +
-        [f"- {field_labels[field]}: {websocket.formData['symptom_details'][field]}" for field in symptom_detail_fields if field in websocket.formData["symptom_details"] and websocket.formData["symptom_details"][field]] +
-        [f"- {field_labels[field]}: {websocket.formData['history'][field]}" for field in history_fields if field in websocket.formData["history"] and websocket.formData["history"][field]] +
-        [f"- {field_labels[field]}: {websocket.formData['family'][field]}" for field in family_fields if field in websocket.formData["family"] and websocket.formData["family"][field]]
-    ) if any(
-        field in websocket.formData["personal"] and websocket.formData["personal"][field] for field in personal_fields
-    ) or any(
-        field in websocket.formData["medical"] and websocket.formData["medical"][field] for field in medical_fields
-    ) or any(
-        field in websocket.formData["symptom_details"] and websocket.formData["symptom_details"][field] for field in symptom_detail_fields
-    ) or any(
-        field in websocket.formData["history"] and websocket.formData["history"][field] for field in history_fields
-    ) or any(
-        field in websocket.formData["family"] and websocket.formData["family"][field] for field in family_fields
-    ) else "Chưa có thông tin nào được điền."
-
-    missing_field_labels = (
-        [field_labels[field] for field in missing_personal] +
-        [field_labels[field] for field in missing_medical] +
-        [field_labels[field] for field in missing_symptom_details] +
-        [field_labels[field] for field in missing_history] +
-        [field_labels[field] for field in missing_family]
-    )
+        [f"- {field.label}: {value}" for field, value in filled]
+    ) if filled else "Chưa có thông tin nào được điền."
 
-    next_field = None
-    next_field_label = None
-    next_category = None
-
-    # Đảm bảo hỏi tuần tự trong personal trước khi chuyển category
-    if missing_personal:
-        for field in personal_fields:
-            if field in missing_personal:
-                next_field = field
-                next_field_label = field_labels[next_field]
-                next_category = "personal"
-                break
-    elif missing_medical:
-        for field in medical_fields:
-            if field in missing_medical:
-                next_field = field
-                next_field_label = field_labels[next_field]
-                next_category = "medical"
-                break
-    elif missing_symptom_details and "symptoms" in websocket.formData["personal"] and websocket.formData["personal"]["symptoms"]:
-        for field in symptom_detail_fields:
-            if field in missing_symptom_details:
-                next_field = field
-                next_field_label = field_labels[next_field]
-                next_category = "symptom_details"
-                break
-    elif missing_history:
-        for field in history_fields:
-            if field in missing_history:
-                next_field = field
-                next_field_label = field_labels[next_field]
-                next_category = "history"
-                break
-    elif missing_family:
-        for field in family_fields:
-            if field in missing_family:
-                next_field = field
-                next_field_label = field_labels[next_field]
-                next_category = "family"
-                break
+    missing_field_labels = form_state.missing_labels()
+    next_field = form_state.next_field()
 
     if next_field:
-        return (
-            f"Lịch sử chat:\n{chat_history_str}\n"
-            f"Người dùng vừa nói: '{message}'. "
-            f"Dữ liệu hiện tại của form: {websocket.formData}. "
-            f"Thông tin đã điền: {filled_info}\n"
-            "Form đăng ký khám bệnh bao gồm:\n"
-            "- Thông tin cá nhân: name (họ tên), dob (ngày sinh), gender (giới tính), cccd (số CCCD), province (tỉnh/thành), district (quận/huyện), ward (xã/phường), address (địa chỉ), phone (số điện thoại), symptoms (triệu chứng)\n"
-            "- Thông tin y tế: không có\n"
-            "- Chi tiết triệu chứng: site (vị trí), onset (thời điểm khởi phát), character (tính chất), radiation (lan tỏa/kèm theo), alleviating (yếu tố làm giảm), timing (thời gian/tần suất), exacerbating (yếu tố làm nặng), severity (mức độ 1-10), previous_check (đã từng khám triệu chứng này ở đâu trước đó chưa)\n"
-            "- Tiền sử bệnh: position (bệnh lý đã mắc trước đó), last (phẫu thuật bao giờ chưa), occasion (dị ứng), vadap (tiền sử dịch tễ), cangay (tiền sử thai sản, kinh nguyệt), duration (rượu bia, chất kích thích), spread (thói quen sinh hoạt, chế độ ăn)\n"
-            "- Tiền sử gia đình: ditruyen (gia đình có tiền sử bệnh nào có tính di truyền không), last (xung quanh có tiền sử bệnh nào có tính di truyền không), occasion (gia đình có ai có bệnh lý nội khoa không), vadap (hàng xóm có ai tiếp xúc mà có triệu chứng tương tự không)\n"
-            f"Các trường còn thiếu: {', '.join(missing_field_labels) if missing_field_labels else 'không còn'}. "
-            f"Nhiệm vụ: Phân tích câu của người dùng và trích xuất thông tin để điền vào trường '{next_field_label}' (thuộc '{next_category}'). "
-            "Nếu không có thông tin cho '{next_field_label}', trả lời tự nhiên bằng tiếng Việt để yêu cầu người dùng cung cấp. "
-            "Nếu có thông tin, xác nhận thông tin đã ghi nhận một cách tự nhiên và hỏi câu hỏi tiếp theo. "
-            "Dưới đây là các mẫu câu để xác nhận thông tin đã ghi nhận (chọn ngẫu nhiên hoặc phù hợp với ngữ cảnh, tránh lặp lại liên tục):\n"
-            "- 'Oke, tôi đã ghi nhận {field_label} là {value}.'\n"
-            "- 'Cảm ơn bạn, tôi đã lưu {field_label} là {value}.'\n"
-            "- 'Được rồi, tôi đã cập nhật {field_label} là {value}.'\n"
-            "- 'Thông tin {field_label} là {value} đã được lưu, cảm ơn bạn!'\n"
-            "- 'Tôi đã ghi lại {field_label} là {value}, cảm ơn nhé!'\n"
-            "Dưới đây là các mẫu câu để hỏi câu hỏi tiếp theo (chọn ngẫu nhiên hoặc phù hợp với ngữ cảnh, tránh lặp lại liên tục):\n"
-            "- 'Tiếp theo, bạn có thể cho tôi biết {next_field_label} của bạn không?'\n"
-            "- 'Bạn cho tôi biết thêm về {next_field_label} được không?'\n"
-            "- 'Cho tôi biết {next_field_label} của bạn nhé?'\n"
-            "- 'Bạn có thể chia sẻ thêm về {next_field_label} không?'\n"
-            "- 'Tiếp theo, bạn có thể nói thêm về {next_field_label} không?'\n"
-            "Hãy sử dụng các mẫu câu trên một cách linh hoạt, đảm bảo câu trả lời tự nhiên, thân thiện, và phù hợp với ngữ cảnh y tế. "
-            "Tránh lặp lại cùng một mẫu câu liên tục, dựa vào lịch sử chat để thay đổi cách diễn đạt nếu cần. "
-            "Trả về kết quả dạng JSON với: "
-            "'form' chứa các trường đã điền (chỉ cập nhật trường liên quan trong đúng category) và 'reply' chứa câu trả lời tự nhiên bằng tiếng Việt.\n"
-            "Ví dụ:\n"
-            "1. Tin nhắn: 'Tên tôi là Nguyễn Văn A' -> {\"form\": {\"personal\": {\"name\": \"Nguyễn Văn A\"}}, \"reply\": \"Cảm ơn bạn, tôi đã lưu họ tên là Nguyễn Văn A. Bạn cho tôi biết thêm về ngày sinh được không?\"}\n"
-            "2. Tin nhắn: 'Đau ở trán' -> {\"form\": {\"symptom_details\": {\"site\": \"trán\"}}, \"reply\": \"Được rồi, tôi đã cập nhật vị trí triệu chứng là trán. Tiếp theo, bạn có thể nói thêm về thời điểm khởi phát triệu chứng không?\"}\n"
-            "3. Tin nhắn: 'Tôi không biết' -> {\"form\": {}, \"reply\": \"Không sao đâu, bạn có thể chia sẻ thêm về {next_field_label} không?\"}"
+        task = NEXT_FIELD_TASK.format(
+            missing=", ".join(missing_field_labels) if missing_field_labels else "không còn",
+            next_field_label=next_field.label,
+            next_category=next_field.category
         )
     else:
         confirmation_message = (
             "Hình như mọi thông tin cần thiết đã được điền đầy đủ rồi! Đây là những gì tôi có:\n"
-            f"- Họ tên: {websocket.formData['personal'].get('name', '')}\n"
-            f"- Ngày sinh: {websocket.formData['personal'].get('dob', '')}\n"
-            f"- Giới tính: {websocket.formData['personal'].get('gender', '')}\n"
-            f"- Số CCCD: {websocket.formData['personal'].get('cccd', '')}\n"
-            f"- Tỉnh/thành: {websocket.formData['personal'].get('province', '')}\n"
-            f"- Quận/huyện: {websocket.formData['personal'].get('district', '')}\n"
-            f"- Xã/phường: {websocket.formData['personal'].get('ward', '')}\n"
-            f"- Địa chỉ: {websocket.formData['personal'].get('address', '')}\n"
-            f"- Số điện thoại: {websocket.formData['personal'].get('phone', '')}\n"
-            f"- Triệu chứng: {websocket.formData['personal'].get('symptoms', '')}\n"
-            f"- Vị trí triệu chứng: {websocket.formData['symptom_details'].get('site', '')}\n"
-            f"- Thời điểm khởi phát: {websocket.formData['symptom_details'].get('onset', '')}\n"
-            f"- Tính chất: {websocket.formData['symptom_details'].get('character', '')}\n"
-            f"- Lan tỏa/kèm theo: {websocket.formData['symptom_details'].get('radiation', '')}\n"
-            f"- Yếu tố làm giảm: {websocket.formData['symptom_details'].get('alleviating', '')}\n"
-            f"- Thời gian/tần suất: {websocket.formData['symptom_details'].get('timing', '')}\n"
-            f"- Yếu tố làm nặng: {websocket.formData['symptom_details'].get('exacerbating', '')}\n"
-            f"- Mức độ (1-10): {websocket.formData['symptom_details'].get('severity', '')}\n"
-            f"- Đã từng khám triệu chứng này ở đâu chưa: {websocket.formData['symptom_details'].get('previous_check', '')}\n"
-            f"- Bệnh lý đã mắc trước đó: {websocket.formData['history'].get('position', '')}\n"
-            f"- Phẫu thuật bao giờ chưa: {websocket.formData['history'].get('last', '')}\n"
-            f"- Dị ứng: {websocket.formData['history'].get('occasion', '')}\n"
-            f"- Tiền sử dịch tễ: {websocket.formData['history'].get('vadap', '')}\n"
-            f"- Tiền sử thai sản, kinh nguyệt: {websocket.formData['history'].get('cangay', '')}\n"
-            f"- Rượu bia, chất kích thích: {websocket.formData['history'].get('duration', '')}\n"
-            f"- Thói quen sinh hoạt, chế độ ăn: {websocket.formData['history'].get('spread', '')}\n"
-            f"- Gia đình có tiền sử bệnh nào có tính di truyền không: {websocket.formData['family'].get('ditruyen', '')}\n"
-            f"- Xung quanh có tiền sử bệnh nào có tính di truyền không: {websocket.formData['family'].get('last', '')}\n"
-            f"- Gia đình có ai có bệnh lý nội khoa không: {websocket.formData['family'].get('occasion', '')}\n"
-            f"- Hàng xóm có ai tiếp xúc mà có triệu chứng tương tự không: {websocket.formData['family'].get('vadap', '')}\n"
+            + "".join(
+                f"- {field.summary_label}: {session.formData[field.category].get(field.key, '')}\n"
+                for field in form_schema.fields
+            ) +
             "Bạn kiểm tra lại xem đúng hết chưa nhé? Nếu đúng thì nói 'có', còn nếu cần sửa thì cứ bảo tôi!"
         )
-        return (
-            f"Lịch sử chat:\n{chat_history_str}\n"
-            f"Người dùng vừa nói: '{message}'. "
-            f"Dữ liệu hiện tại của form: {websocket.formData}. "
-            f"Thông tin đã điền: {filled_info}\n"
-            "Tất cả các trường đã được điền.\n"
-            f"Hãy trả về JSON với 'form' chứa dữ liệu hiện tại và 'reply' là: '{confirmation_message}'."
-        )
-
-def merge_form_data(form_data: dict, result: dict) -> dict:
+        task = CONFIRM_TASK.format(confirmation_message=confirmation_message)
+
+    # Hướng dẫn tĩnh nằm ở system prompt (TURN_PREFIX, giống nhau mọi lượt để provider cache được);
+    # prompt của lượt chỉ gồm lịch sử, trạng thái form và câu vừa nói
+    fields = {"form_json": form_json, "filled_info": filled_info, "task": task, "message": message}
+    reserved = TURN_PREFIX_TOKENS + count_tokens(TURN_TEMPLATE.format(history="", **fields))
+    # Lịch sử chat được cắt theo ngân sách token còn lại sau phần hướng dẫn
+    chat_history_str = session.context.build(session.chat_history, reserved)
+    report = session.context.last_report
+    metrics.inc("context_tokens", report["used_tokens"])
+    metrics.inc("context_tokens_saved", report["saved_tokens"])
+    return TURN_TEMPLATE.format(history=chat_history_str, **fields)
+
+def merge_form_data(form_data: dict, result: dict, form_state: FormState = None) -> dict:
     new_form = result.get("form", {})
     updated_form = form_data.copy()
     
-    for category in ["personal", "medical", "symptom_details", "history", "family"]:
+    for category in form_schema.categories:
         if category in new_form:
             if not isinstance(new_form[category], dict):
                 continue
             if category not in updated_form:
                 updated_form[category] = {}
-            updated_form[category].update({
+            values = {
                 key: "" if value is None else value
                 for key, value in new_form[category].items()
-            })
+            }
+            updated_form[category].update(values)
+            # Cập nhật bitmap các trường đã điền theo từng giá trị thay đổi
+            if form_state is not None:
+                for key, value in values.items():
+                    form_state.update(category, key, value)
     
     return updated_form
 
-async def send_final_form(websocket: WebSocket, final_form: dict, result: dict):
-    await websocket.send_text(json.dumps({
+async def send_final_form(session: Session, final_form: dict, result: dict):
+    if session.channel is not None:
+        # Câu trả lời đã nằm trong message mới của delta
+        await send_delta(session, form=final_form)
+        return
+    await session.send_text(json.dumps({
         "form": final_form,
         "reply": result.get("reply", "Đã xử lý câu hỏi của bạn.")
     }))
 
-def handle_disconnect(websocket: WebSocket):
-    print(f"WebSocket disconnected: {websocket.client}")
-    clients.remove(websocket)
+async def handle_disconnect(session: Session):
+    print(f"WebSocket disconnected: {session.client}")
+    user_id = session.registered_user_id
+    clients.unregister(session)
+    session_store.park(session)
+    if user_id is not None and user_id not in clients:
+        await bus.release(user_id, WORKER_ID)
 
 @app.get("/api/history/{user_id}")
 async def get_chat_history(user_id: str):
+    # Chờ có giới hạn: Mongo lỗi thì trả phần đã ghi được thay vì treo request
+    await history_writer.flush()
     chat_doc = collection.find_one({"user_id": user_id})
     if chat_doc and "chat_history" in chat_doc:
         return {"user_id": user_id, "chat_history": chat_doc["chat_history"]}
     else:
         raise HTTPException(status_code=404, detail="Không tìm thấy lịch sử chat cho user_id này.")
 
+async def deliver_local(message: dict) -> int:
+    # Giao message từ bus (hoặc từ chính worker này) tới các socket cục bộ của user
+    user_id = message["user_id"]
+    sockets = clients.sockets(user_id)
+    frames = []
+    if message["type"] == "tests":
+        bot_message = Message(**message["message"])
+        for client in sockets:
+            client.chat_history.append(bot_message)
+            if client.channel is not None:
+                text = client.channel.delta(client.chat_history, tests=message["tests"])
+                frames.append((client, text))
+                continue
+            frames.append((client, client.history_frame(tests=message["tests"])))
+    elif message["type"] == "frame":
+        text = json.dumps(message["frame"])
+        frames = [(client, text) for client in sockets]
+    return await clients.send_many(frames)
+
+async def send_to_user(user_id: str, message: dict) -> int:
+    # Gửi tới socket cục bộ và publish tới các worker khác đang giữ socket của user
+    delivered = await deliver_local(message) if user_id in clients else 0
+    for worker_id in await bus.owners(user_id):
+        if worker_id == WORKER_ID:
+            continue
+        if await bus.publish(worker_id, message):
+            delivered += 1
+        else:
+            # Worker đã chết mà chưa kịp trả lại user: dọn khỏi danh bạ
+            await bus.release(user_id, worker_id)
+    return delivered
+
+async def standalone_symptoms(user_id: str, symptoms: str) -> str:
+    # Câu triệu chứng nối tiếp ("nó đau hơn khi ăn") được viết lại theo lịch sử chat của phiên
+    # trước khi tìm vector; câu đã đủ nghĩa thì Reflection trả nguyên, không gọi LLM
+    sessions = clients.sockets(user_id)
+    if not sessions:
+        return symptoms
+    session = max(sessions, key=lambda item: len(item.chat_history))
+    try:
+        return await session.context.reflection(session.chat_history, question=symptoms)
+    except Exception as e:
+        print(f"Error: không viết lại được câu triệu chứng: {e}")
+        return symptoms
+
 @app.post("/api/submit_tests")
 async def submit_tests(request: SubmitRequest):
     user_id = request.user_id
     symptoms = request.symptoms
 
-    test_list = get_search_results(symptoms)
-    test_list_array = [test.strip() for test in test_list.split("\n") if test.strip()]  
-
-    for client in clients:
-        if hasattr(client, "user_id") and client.user_id == user_id:
-            reply = f"Dựa trên triệu chứng '{symptoms}', tôi đề xuất các xét nghiệm sau:\n" + "\n".join([f"- {test}" for test in test_list_array]) + "\nBạn muốn tôi giải thích thêm về xét nghiệm nào không?"
-            client.chat_history.append(Message(message=reply, sender="Bot"))
-            await client.send_text(json.dumps({
-                "user_id": user_id,
-                "chat_history": [msg.dict() for msg in client.chat_history],
-                "tests": test_list_array  
-            }))
-            collection.update_one(
-                {"user_id": user_id},
-                {"$set": {"chat_history": [msg.dict() for msg in client.chat_history]}},
-                upsert=True
-            )
-            break
-    else:
+    # Kiểm tra kết nối trước để không tốn lời gọi GPT-4 cho user_id không còn online ở worker nào
+    if user_id not in clients and not await bus.owners(user_id):
         raise HTTPException(status_code=404, detail="Không tìm thấy kết nối WebSocket cho user_id này.")
 
-    return {"user_id": user_id, "tests": test_list_array}
+    with metrics.turn("submit_tests", user_id=user_id):
+        test_list = await get_search_results(await standalone_symptoms(user_id, symptoms))
+        test_list_array = [test.strip() for test in test_list.split("\n") if test.strip()]  
+
+        reply = f"Dựa trên triệu chứng '{symptoms}', tôi đề xuất các xét nghiệm sau:\n" + "\n".join([f"- {test}" for test in test_list_array]) + "\nBạn muốn tôi giải thích thêm về xét nghiệm nào không?"
+        bot_message = Message(message=reply, sender="Bot").dict()
+        # Mọi socket (tab, kiosk) của user đều nhận kết quả, dù nằm ở worker nào
+        delivered = await send_to_user(user_id, {
+            "type": "tests",
+            "user_id": user_id,
+            "message": bot_message,
+            "tests": test_list_array
+        })
+        if not delivered:
+            raise HTTPException(status_code=404, detail="Không tìm thấy kết nối WebSocket cho user_id này.")
+        history_writer.append(user_id, [bot_message])
+
+        return {"user_id": user_id, "tests": test_list_array}
+
+# Các bộ đếm sẵn có của từng module được xuất chung qua /metrics
+metrics.register_stats("extractor", extractor_stats)
+metrics.register_stats("inbox", inbox_stats)
+metrics.register_stats("reflection", reflection.stats, hits=("skipped", "memo_hits"), misses=("llm_calls",))
+metrics.register_stats("structured_output", structured.stats)
+metrics.register_stats("tts_cache", tts.stats, hits=("hits",), misses=("misses",))
+metrics.register_stats("tts_cache_store", tts.tts_cache.stats)
+metrics.register_stats("audio_store", audio_store.stats)
+metrics.register_stats("stt", stt_router.stats)
+metrics.register_stats("embedding_cache", embedding_cache.stats, hits=("memory_hits", "disk_hits"), misses=("misses",))
+metrics.register_stats("search_cache", search_cache.stats, hits=("exact_hits", "semantic_hits"), misses=("misses",))
+metrics.register_stats("history_writer", history_writer.stats)
+metrics.gauge("history_writer_dead_letter_messages", history_writer.pending_messages)
+metrics.register_stats("session_store", session_store.stats, hits=("memory_hits", "mongo_hits"), misses=("misses",))
+metrics.gauge("open_sockets", lambda: len(clients))
+metrics.gauge("online_users", lambda: len(clients.users()))
+metrics.gauge("queued_messages", lambda: sum(len(session.inbox) for session in clients))
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/traces")
+async def turn_traces(limit: int = 50, user_id: str = None):
+    # Trace các lượt gần nhất: mỗi lượt có turn_id và thời gian từng stage
+    traces = [trace for trace in metrics.traces if user_id is None or trace.get("user_id") == user_id]
+    return traces[-limit:]
+
+@app.on_event("startup")
+async def startup():
+    # Tạo sẵn các client dịch vụ ngoài (và import SDK của chúng) trước khi nhận kết nối đầu tiên
+    print(f"Providers sẵn sàng (ms): {await providers.warm()}")
+    # Nạp index vector cục bộ ngay khi khởi động để lượt submit_tests đầu tiên không phải chờ
+    if VECTOR_BACKEND == "local":
+        await asyncio.to_thread(vector_index.get_index, test_collection)
+    await bus.start(WORKER_ID, deliver_local)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await bus.close()
+    await history_writer.close()
+    await gateway.aclose()
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=5001)
\ No newline at end of file
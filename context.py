@@ -0,0 +1,136 @@
+import asyncio
+import contextvars
+import os
+from reflection import Reflection
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Số lượt (một câu người dùng + một câu bot) giữ nguyên văn trong prompt
+KEEP_TURNS = int(os.getenv("CONTEXT_KEEP_TURNS", "6"))
+# Ngân sách token cho toàn bộ prompt của một lượt
+TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Chỉ gọi tóm tắt khi đã dồn đủ số message cũ, tránh một lời gọi LLM mỗi lượt
+SUMMARY_BATCH = int(os.getenv("CONTEXT_SUMMARY_BATCH", "6"))
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    # Ước lượng thô khi không có tiktoken: tiếng Việt có dấu khoảng 3 byte UTF-8 mỗi token
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+class ContextBuilder():
+    """Dựng phần lịch sử chat cho prompt của một phiên trong giới hạn token.
+
+    Các message được render một lần khi được thêm vào và cache lại cùng số
+    token của chúng. Prompt chỉ giữ nguyên văn các lượt gần nhất; các lượt cũ
+    hơn được gộp dần vào một bản tóm tắt cuốn chiếu do `Reflection` tạo ở nền.
+    """
+
+    def __init__(self, reflection: Reflection = None, keep_turns=KEEP_TURNS,
+                 token_budget=TOKEN_BUDGET, summary_batch=SUMMARY_BATCH):
+        self.reflection = reflection or Reflection()
+        self.keep_messages = keep_turns * 2
+        self.token_budget = token_budget
+        self.summary_batch = summary_batch
+        self.summary = ""
+        self.summary_tokens = 0
+        self._summarized_upto = 0
+        self._summary_task = None
+        self._lines = []
+        self._line_tokens = []
+        self._total_tokens = 0
+        self._rendered = (0, 0, "")
+        self.last_report = None
+
+    def _sync(self, chat_history):
+        # Chỉ render các message mới thêm từ lần gọi trước
+        for msg in chat_history[len(self._lines):]:
+            line = f"{msg.sender}: {msg.message}"
+            tokens = count_tokens(line) + 1
+            self._lines.append(line)
+            self._line_tokens.append(tokens)
+            self._total_tokens += tokens
+
+    def _render(self, first: int, count: int) -> str:
+        # Khi cửa sổ chỉ dài thêm ở cuối thì nối tiếp chuỗi đã render thay vì join lại
+        cached_first, cached_count, rendered = self._rendered
+        if cached_first == first and first < cached_count <= count:
+            if cached_count < count:
+                rendered = rendered + "\n" + "\n".join(self._lines[cached_count:count])
+        else:
+            rendered = "\n".join(self._lines[first:count])
+        self._rendered = (first, count, rendered)
+        return rendered
+
+    def _schedule_summary(self, chat_history, fold_end: int):
+        if self._summary_task is not None and not self._summary_task.done():
+            return
+        if fold_end - self._summarized_upto < self.summary_batch:
+            return
+        start = self._summarized_upto
+        # Tóm tắt chạy nền, tách khỏi trace của lượt hiện tại (context rỗng)
+        self._summary_task = asyncio.get_running_loop().create_task(
+            self._summarize(chat_history[start:fold_end], fold_end),
+            context=contextvars.Context()
+        )
+
+    async def _summarize(self, messages, fold_end: int):
+        try:
+            summary = await self.reflection.summarize(messages, self.summary)
+        except Exception as e:
+            print(f"Error: không tóm tắt được lịch sử chat: {e}")
+            return
+        self.summary = summary.strip()
+        self.summary_tokens = count_tokens(self.summary)
+        self._summarized_upto = fold_end
+
+    @property
+    def summarized_upto(self) -> int:
+        return self._summarized_upto
+
+    def restore_summary(self, summary: str, summarized_upto: int):
+        # Dùng lại bản tóm tắt đã lưu khi khôi phục phiên, khỏi tóm tắt lại từ đầu
+        if summary and summarized_upto > 0:
+            self.summary = summary
+            self.summary_tokens = count_tokens(summary)
+            self._summarized_upto = summarized_upto
+
+    def build(self, chat_history, reserved_tokens: int = 0) -> str:
+        self._sync(chat_history)
+        count = len(self._lines)
+        fold_end = max(count - self.keep_messages, 0)
+        self._schedule_summary(chat_history, fold_end)
+
+        budget = self.token_budget - reserved_tokens
+        used = self.summary_tokens if self._summarized_upto > 0 else 0
+        # Lấy ngược từ message mới nhất cho tới khi hết ngân sách (luôn giữ message cuối);
+        # các message cũ chưa kịp tóm tắt cũng được giữ nếu còn chỗ
+        first = count
+        for index in range(count - 1, self._summarized_upto - 1, -1):
+            tokens = self._line_tokens[index]
+            if used + tokens > budget and first < count:
+                break
+            used += tokens
+            first = index
+        history = self._render(first, count)
+        if self._summarized_upto > 0:
+            history = f"Tóm tắt hội thoại trước đó: {self.summary}\n{history}"
+
+        self.last_report = {
+            "messages": count,
+            "verbatim_messages": count - first,
+            "full_tokens": self._total_tokens,
+            "used_tokens": used,
+            "saved_tokens": max(self._total_tokens - used, 0),
+        }
+        return history
@@ -1,49 +1,138 @@
-app.mount("/static", StaticFiles(directory=r"D:\Workspace\Temps\tech\EchoAds\Chatbot\static"), name="static")
-
-class SpeechRequest(BaseModel):
-    text: str
-@app.post("/voice-query/")
-async def voice_query(audio: UploadFile = File(...)):
-    # Lưu file tạm thời
-    temp_audio_path = f"temp_{audio.filename}"
-    with open(temp_audio_path, "wb") as buffer:
-        buffer.write(await audio.read())
-
-    # Chuyển đổi giọng nói thành văn bản
-    text_query = transcribe_audio(temp_audio_path)
-    os.remove(temp_audio_path)  # Xóa file sau khi xử lý
-    print("Transcribed text:", text_query)
-
-    # Thêm câu hỏi vào lịch sử hội thoại
-    messages.append(Message(message=text_query, sender="You"))
-
-    # Nhận phản hồi từ chatbot (giữ ngữ cảnh)
-    response = get_response(text_query)
-    
-    print(str(response))
-    # Thêm phản hồi từ bot vào lịch sử chat
-    messages.append(Message(message=response, sender="Bot"))
-
-    # Cập nhật WebSocket clients với tin nhắn mới
-    for client in clients:
-        await client.send_text(json.dumps([msg.dict() for msg in messages]))
-
-    # Tạo file âm thanh từ phản hồi chatbot
-    audio_file_path = generate_text_to_speech(str(response))
-    timestamp = int(datetime.now().timestamp())
-
-    response_data = {
-        "transcribed_text": text_query,
-        "response": str(response),
-        "audio_file": f"static/speech.mp3?{timestamp}" if audio_file_path else None  
-    }
-    
-    return Response(
-        content=json.dumps(response_data),
-        media_type="application/json",
-        headers={
-            "X-Content-Type-Options": "nosniff",
-            "Content-Security-Policy": "default-src 'self'",
-            "Access-Control-Allow-Origin": "*"
+import asyncio
+import json
+import logging
+from urllib.parse import quote
+from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi.responses import Response, StreamingResponse
+from blob_store import audio_store
+from tts import generate_text_to_speech, tts_cache
+from stt import stt_router
+from json_stream import ReplyStreamParser
+from structured import normalize_turn, recover_json
+from llm import gateway
+import voice_pipeline
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Endpoint hỏi đáp bằng giọng nói, được gắn vào app trong config.py
+router = APIRouter()
+
+AUDIO_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "Content-Security-Policy": "default-src 'self'",
+    "Access-Control-Allow-Origin": "*"
+}
+
+async def pipelined_audio(text_query: str, system_prompt: str, publish_turn, turn=None):
+    # Chế độ stream: model sinh tới đâu cắt câu tới đó, mỗi câu được TTS song song và
+    # gửi ngay theo thứ tự; văn bản đầy đủ chỉ có ở cuối nên được gửi qua socket của user.
+    # Lượt voice (đã tách khỏi handler) chỉ được chốt khi phát xong câu cuối
+    if turn is not None:
+        with metrics.resume(turn):
+            async for audio in pipelined_audio(text_query, system_prompt, publish_turn):
+                yield audio
+        return
+    parser = ReplyStreamParser()
+    chunks = gateway.stream(
+        "gpt-4o-mini",
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": text_query}
+        ]
+    )
+    stats = {}
+    parts = []
+    try:
+        async for audio in voice_pipeline.speak(voice_pipeline.reply_sentences(chunks, parser), stats=stats):
+            parts.append(audio)
+            yield audio
+    except Exception as e:
+        logger.error("Lượt voice dừng giữa chừng: %r", e)
+        metrics.inc("voice_stream_errors")
+    if "first_audio_ms" in stats:
+        metrics.observe("voice_first_audio", stats["first_audio_ms"] / 1000)
+    metrics.inc("voice_sentences", len(parts))
+    audio_key = await asyncio.to_thread(audio_store.put, b"".join(parts)) if parts else None
+    await publish_turn(parser.reply, audio_key)
+
+def reply_text(response: str) -> str:
+    # Model trả JSON {"form", "reply"} (có thể bọc code fence hoặc bị cắt); chỉ đọc phần reply
+    result = normalize_turn(recover_json(response))
+    return result["reply"] if result is not None and result["reply"] else response
+
+@router.post("/voice-query/")
+async def voice_query(audio: UploadFile = File(...), user_id: str = Form(None), stream: bool = False):
+    # Import muộn: config import module này
+    from config import get_response, history_writer, send_to_user, Message, SYSTEM_PROMPT
+
+    with metrics.turn("voice", user_id=user_id) as turn:
+        # Đọc file upload vào bộ nhớ một lần: khi hedge, cả hai backend STT cùng gửi đi một nội dung
+        await audio.seek(0)
+        text_query = await stt_router.transcribe(await audio.read(), audio.filename or "audio.webm")
+        if not text_query:
+            raise HTTPException(status_code=502, detail="Không nhận dạng được giọng nói.")
+
+        async def publish_turn(response, audio_key):
+            if not user_id:
+                return
+            # Lưu lượt hỏi đáp và báo cho các socket đang mở của đúng user này
+            history_writer.append(user_id, [
+                Message(message=text_query, sender="You").dict(),
+                Message(message=response, sender="Bot").dict()
+            ])
+            await send_to_user(user_id, {"type": "frame", "user_id": user_id, "frame": {
+                "type": "voice",
+                "transcribed_text": text_query,
+                "response": response,
+                "audio_file": f"/voice-audio/{audio_key}" if audio_key else None
+            }})
+
+        if stream:
+            turn.detach()
+            return StreamingResponse(
+                pipelined_audio(text_query, SYSTEM_PROMPT, publish_turn, turn),
+                media_type="audio/mpeg",
+                headers={**AUDIO_HEADERS, "X-Transcribed-Text": quote(text_query)}
+            )
+
+        # Nhận phản hồi từ chatbot
+        response = reply_text(await get_response(text_query))
+
+        # Mỗi câu trả lời một artifact riêng theo hash nội dung, các phiên song song không đè nhau
+        audio_data = await generate_text_to_speech(str(response))
+        audio_key = await asyncio.to_thread(audio_store.put, audio_data) if audio_data else None
+
+        await publish_turn(response, audio_key)
+
+        response_data = {
+            "transcribed_text": text_query,
+            "response": str(response),
+            "audio_file": f"/voice-audio/{audio_key}" if audio_key else None
         }
+
+        return Response(
+            content=json.dumps(response_data),
+            media_type="application/json",
+            headers=AUDIO_HEADERS
+        )
+
+@router.get("/voice-audio/{audio_key}")
+async def voice_audio(audio_key: str):
+    try:
+        exists = audio_store.exists(audio_key)
+    except ValueError:
+        exists = False
+    if not exists:
+        raise HTTPException(status_code=404, detail="Không tìm thấy file âm thanh.")
+    # Nội dung theo hash nên không bao giờ đổi: client được phép cache vĩnh viễn
+    return StreamingResponse(
+        audio_store.iter_chunks(audio_key),
+        media_type="audio/mpeg",
+        headers={**AUDIO_HEADERS, "Cache-Control": "public, max-age=31536000, immutable"}
     )
+
+@router.on_event("startup")
+async def start_audio_janitors():
+    asyncio.get_running_loop().create_task(audio_store.run_janitor())
+    asyncio.get_running_loop().create_task(tts_cache.run_janitor())
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join("data", "embedding_cache.sqlite3"))
+MEMORY_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "2048"))
+MEMORY_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+DISK_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_DISK_ENTRIES", "100000"))
+DISK_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+
+
+def cache_key(model: str, task_type: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{task_type}\0{text.strip()}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache():
+    """Cache embedding hai tầng: LRU trong bộ nhớ phía trước SQLite trên đĩa.
+
+    Khóa là hash nội dung của (model, task_type, text). Cả hai tầng đều bị giới
+    hạn theo số entry và tổng dung lượng, entry ít dùng nhất bị loại trước.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, memory_entries=MEMORY_MAX_ENTRIES,
+                 memory_bytes=MEMORY_MAX_BYTES, disk_entries=DISK_MAX_ENTRIES, disk_bytes=DISK_MAX_BYTES):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.memory_bytes = memory_bytes
+        self.disk_entries = disk_entries
+        self.disk_bytes = disk_bytes
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_count = 0
+        self._disk_size = 0
+
+    def _connect(self):
+        if self._db is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embeddings").fetchone()
+            self._disk_count, self._disk_size = count, size
+        return self._db
+
+    def _remember(self, key: str, vector: np.ndarray):
+        # Tầng bộ nhớ giữ mảng float32 nên dung lượng tính theo nbytes là dung lượng thật
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = vector
+        self._memory_size += vector.nbytes
+        while self._memory and (len(self._memory) > self.memory_entries or self._memory_size > self.memory_bytes):
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= evicted.nbytes
+
+    def get(self, model: str, task_type: str, text: str):
+        key = cache_key(model, task_type, text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                # Trả về list mới, người gọi sửa kết quả cũng không làm hỏng cache
+                return vector.tolist()
+            db = self._connect()
+            row = db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            db.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+            db.commit()
+            vector = np.frombuffer(row[0], dtype=np.float32).copy()
+            self._remember(key, vector)
+            self.stats["disk_hits"] += 1
+            return vector.tolist()
+
+    def put(self, model: str, task_type: str, text: str, vector):
+        key = cache_key(model, task_type, text)
+        vector = np.array(vector, dtype=np.float32)
+        blob = vector.tobytes()
+        with self._lock:
+            self._remember(key, vector)
+            db = self._connect()
+            existing = db.execute("SELECT size FROM embeddings WHERE key = ?", (key,)).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), time.time())
+            )
+            if existing:
+                self._disk_size += len(blob) - existing[0]
+            else:
+                self._disk_count += 1
+                self._disk_size += len(blob)
+            self._evict_disk(db)
+            db.commit()
+
+    def _evict_disk(self, db):
+        while self._disk_count > self.disk_entries or self._disk_size > self.disk_bytes:
+            # Xóa theo lô các entry lâu không dùng nhất
+            excess = max(self._disk_count - self.disk_entries, 1)
+            rows = db.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_used LIMIT ?", (max(excess, 64),)
+            ).fetchall()
+            if not rows:
+                break
+            removed = 0
+            for key, size in rows:
+                if self._disk_count <= self.disk_entries and self._disk_size <= self.disk_bytes:
+                    break
+                db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self._disk_count -= 1
+                self._disk_size -= size
+                removed += 1
+            self.stats["evictions"] += removed
+
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+embedding_cache = EmbeddingCache()
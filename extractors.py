@@ -0,0 +1,185 @@
+import re
+import unicodedata
+from datetime import date
+
+# Bộ trích xuất theo luật cho các trường có cấu trúc, chạy trước LLM.
+# Mỗi hàm nhận câu trả lời của người dùng và trả về giá trị đã chuẩn hóa,
+# hoặc None khi không đủ chắc chắn (khi đó lượt chat đi qua LLM như bình thường).
+
+MAX_ANSWER_LENGTH = 80
+
+stats = {"attempted": 0, "avoided_llm_calls": 0}
+
+CONFIRM_TEMPLATES = [
+    "Oke, tôi đã ghi nhận {field_label} là {value}.",
+    "Cảm ơn bạn, tôi đã lưu {field_label} là {value}.",
+    "Được rồi, tôi đã cập nhật {field_label} là {value}.",
+    "Thông tin {field_label} là {value} đã được lưu, cảm ơn bạn!",
+    "Tôi đã ghi lại {field_label} là {value}, cảm ơn nhé!",
+]
+
+ASK_TEMPLATES = [
+    "Tiếp theo, bạn có thể cho tôi biết {next_field_label} của bạn không?",
+    "Bạn cho tôi biết thêm về {next_field_label} được không?",
+    "Cho tôi biết {next_field_label} của bạn nhé?",
+    "Bạn có thể chia sẻ thêm về {next_field_label} không?",
+    "Tiếp theo, bạn có thể nói thêm về {next_field_label} không?",
+]
+
+# Các câu cố định của bot
+GREETING = "Chào bạn! Tôi là chatbot hỗ trợ đăng ký khám bệnh. Bạn cần tôi giúp gì hôm nay?"
+SKIP_FIELD_TEMPLATE = "Hmm, có vẻ bạn chưa cung cấp thông tin về {current_label}. Không sao, chúng ta sẽ quay lại sau. Bạn có thể cho tôi biết {next_field_label} của bạn không?"
+SKIP_ALL_REPLY = "Hình như bạn chưa cung cấp đủ thông tin, nhưng không sao, chúng ta sẽ quay lại sau. Bạn có muốn tiếp tục không?"
+
+# Đầu số di động Việt Nam sau khi chuyển số 11 số cũ
+MOBILE_PREFIXES = ("03", "05", "07", "08", "09")
+
+GENDER_SYNONYMS = {
+    "nam": "Nam", "trai": "Nam", "dan ong": "Nam", "male": "Nam",
+    "nu": "Nữ", "gai": "Nữ", "dan ba": "Nữ", "phu nu": "Nữ", "female": "Nữ",
+}
+# "không phải nam", "chưa ..." : câu có phủ định thì để LLM hiểu, không đoán
+GENDER_NEGATIONS = {"khong", "ko", "chang", "chua"}
+
+# Từ đệm/lịch sự có thể đứng quanh câu trả lời ngắn
+FILLER_WORDS = {"da", "vang", "a", "ah", "nhe", "nha", "ak", "toi", "em", "minh", "la", "thi", "gioi", "tinh"}
+
+NEGATIVE_ANSWERS = {
+    "khong", "ko", "k", "khong co", "chua", "chua bao gio", "chua tung", "khong bao gio", "khong ai", "khong co ai", "no",
+}
+POSITIVE_ANSWERS = {"co", "co roi", "roi", "da tung", "yes"}
+
+
+def _fold(text: str) -> str:
+    # Bỏ dấu tiếng Việt để so khớp từ đồng nghĩa
+    text = unicodedata.normalize("NFD", text.lower()).replace("đ", "d")
+    text = "".join(char for char in text if unicodedata.category(char) != "Mn")
+    return re.sub(r"[^a-z0-9 ]+", " ", text).strip()
+
+
+def _strip_fillers(folded: str) -> str:
+    return " ".join(word for word in folded.split() if word not in FILLER_WORDS)
+
+
+def extract_phone(text: str):
+    candidates = re.findall(r"(?:\+?84|0)[\d .\-]{8,13}\d", text)
+    numbers = {re.sub(r"\D", "", candidate) for candidate in candidates}
+    if len(numbers) != 1:
+        return None
+    number = numbers.pop()
+    if number.startswith("84") and len(number) == 11:
+        number = "0" + number[2:]
+    if len(number) == 10 and number.startswith(MOBILE_PREFIXES):
+        return number
+    # Số cố định: 02x + 8 chữ số
+    if len(number) == 11 and number.startswith("02"):
+        return number
+    return None
+
+
+def extract_cccd(text: str):
+    numbers = re.findall(r"(?<!\d)\d{12}(?!\d)", re.sub(r"(?<=\d)[ .](?=\d)", "", text))
+    if len(numbers) != 1:
+        return None
+    number = numbers[0]
+    # 3 số đầu là mã tỉnh nơi đăng ký khai sinh (001-096), số thứ 4 là mã giới tính/thế kỷ
+    if not 1 <= int(number[:3]) <= 96:
+        return None
+    return number
+
+
+def extract_dob(text: str):
+    folded = _fold(text)
+    match = re.fullmatch(
+        r"(?:.*?\b)?(?:ngay\s+)?(\d{1,2})\s*(?:thang\s+|\s)(\d{1,2})\s*(?:nam\s+|\s)(\d{4})\b.*",
+        folded,
+    )
+    if not match:
+        return None
+    if len(re.findall(r"\d{4}", folded)) != 1:
+        return None
+    day, month, year = (int(part) for part in match.groups())
+    try:
+        value = date(year, month, day)
+    except ValueError:
+        return None
+    if value.year < 1900 or value > date.today():
+        return None
+    return value.strftime("%d/%m/%Y")
+
+
+def extract_gender(text: str):
+    words = _strip_fillers(_fold(text))
+    if GENDER_NEGATIONS.intersection(words.split()):
+        return None
+    if words in GENDER_SYNONYMS:
+        return GENDER_SYNONYMS[words]
+    genders = {GENDER_SYNONYMS[word] for word in words.split() if word in GENDER_SYNONYMS}
+    if len(genders) == 1 and len(words.split()) <= 3:
+        return genders.pop()
+    return None
+
+
+def extract_severity(text: str):
+    folded = _fold(text)
+    numbers = re.findall(r"\d+", folded)
+    if not numbers or len(numbers) > 2:
+        return None
+    # Cho phép dạng "7/10" hoặc "7 tren 10"
+    if len(numbers) == 2 and numbers[1] != "10":
+        return None
+    remainder = _strip_fillers(re.sub(r"\b(?:\d+|tren|muc|do|diem|khoang|tam|chung)\b", " ", folded))
+    if remainder:
+        return None
+    value = int(numbers[0])
+    if 1 <= value <= 10:
+        return str(value)
+    return None
+
+
+def extract_yes_no(text: str):
+    answer = _strip_fillers(_fold(text))
+    if answer in NEGATIVE_ANSWERS:
+        return "Không"
+    if answer in POSITIVE_ANSWERS:
+        return "Có"
+    return None
+
+
+def extract_negative(text: str):
+    # Với câu hỏi mở, chỉ câu trả lời phủ định là đủ thông tin; "có" cần LLM hỏi chi tiết
+    value = extract_yes_no(text)
+    return value if value == "Không" else None
+
+
+EXTRACTORS = {
+    "personal.phone": extract_phone,
+    "personal.cccd": extract_cccd,
+    "personal.dob": extract_dob,
+    "personal.gender": extract_gender,
+    "symptom_details.severity": extract_severity,
+    "history.position": extract_negative,
+    "history.last": extract_yes_no,
+    "history.occasion": extract_negative,
+    "history.vadap": extract_negative,
+    "history.cangay": extract_negative,
+    "history.duration": extract_negative,
+    "family.ditruyen": extract_yes_no,
+    "family.last": extract_yes_no,
+    "family.occasion": extract_yes_no,
+    "family.vadap": extract_yes_no,
+}
+
+
+def extract_field(category: str, key: str, text: str):
+    extractor = EXTRACTORS.get(f"{category}.{key}")
+    if extractor is None or not text or len(text) > MAX_ANSWER_LENGTH:
+        return None
+    stats["attempted"] += 1
+    return extractor(text)
+
+
+def templated_reply(field_label: str, value: str, next_field_label: str, turn: int) -> str:
+    confirm = CONFIRM_TEMPLATES[turn % len(CONFIRM_TEMPLATES)]
+    ask = ASK_TEMPLATES[turn % len(ASK_TEMPLATES)]
+    return confirm.format(field_label=field_label, value=value) + " " + ask.format(next_field_label=next_field_label)
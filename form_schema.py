@@ -0,0 +1,154 @@
+from typing import NamedTuple, Optional
+
+MISSING_LABELS_CACHE_SIZE = 4096
+
+
+class FormField(NamedTuple):
+    id: str
+    category: str
+    key: str
+    label: str
+    summary_label: str
+    bit: int
+
+
+# Khai báo form theo đúng thứ tự hỏi: category trước, rồi tới từng trường trong category.
+# Mỗi trường gồm (key, nhãn dùng khi hỏi, nhãn dùng trong bản tóm tắt xác nhận).
+FORM_DEFINITION = [
+    ("personal", [
+        ("name", "họ tên", "Họ tên"),
+        ("dob", "ngày sinh", "Ngày sinh"),
+        ("gender", "giới tính", "Giới tính"),
+        ("cccd", "số CCCD", "Số CCCD"),
+        ("province", "tỉnh/thành", "Tỉnh/thành"),
+        ("district", "quận/huyện", "Quận/huyện"),
+        ("ward", "xã/phường", "Xã/phường"),
+        ("address", "địa chỉ", "Địa chỉ"),
+        ("phone", "số điện thoại", "Số điện thoại"),
+        ("symptoms", "triệu chứng", "Triệu chứng"),
+    ]),
+    ("medical", []),
+    ("symptom_details", [
+        ("site", "vị trí triệu chứng", "Vị trí triệu chứng"),
+        ("onset", "thời điểm khởi phát triệu chứng", "Thời điểm khởi phát"),
+        ("character", "tính chất triệu chứng", "Tính chất"),
+        ("radiation", "triệu chứng lan tỏa hoặc kèm theo", "Lan tỏa/kèm theo"),
+        ("alleviating", "yếu tố làm giảm triệu chứng", "Yếu tố làm giảm"),
+        ("timing", "thời gian và tần suất triệu chứng", "Thời gian/tần suất"),
+        ("exacerbating", "yếu tố làm nặng triệu chứng", "Yếu tố làm nặng"),
+        ("severity", "mức độ triệu chứng (1-10)", "Mức độ (1-10)"),
+        ("previous_check", "đã khám ở đâu chưa trước đó với triệu chứng này", "Đã từng khám triệu chứng này ở đâu chưa"),
+    ]),
+    ("history", [
+        ("position", "bệnh lý đã mắc trước đó", "Bệnh lý đã mắc trước đó"),
+        ("last", "phẫu thuật bao giờ chưa", "Phẫu thuật bao giờ chưa"),
+        ("occasion", "dị ứng", "Dị ứng"),
+        ("vadap", "tiền sử dịch tễ", "Tiền sử dịch tễ"),
+        ("cangay", "tiền sử thai sản, kinh nguyệt", "Tiền sử thai sản, kinh nguyệt"),
+        ("duration", "rượu bia, chất kích thích", "Rượu bia, chất kích thích"),
+        ("spread", "thói quen sinh hoạt, chế độ ăn", "Thói quen sinh hoạt, chế độ ăn"),
+    ]),
+    ("family", [
+        ("ditruyen", "gia đình có tiền sử bệnh nào có tính di truyền không", "Gia đình có tiền sử bệnh nào có tính di truyền không"),
+        ("last", "xung quanh có tiền sử bệnh nào có tính di truyền không", "Xung quanh có tiền sử bệnh nào có tính di truyền không"),
+        ("occasion", "gia đình có ai có bệnh lý nội khoa không", "Gia đình có ai có bệnh lý nội khoa không"),
+        ("vadap", "hàng xóm có ai tiếp xúc mà có triệu chứng tương tự không", "Hàng xóm có ai tiếp xúc mà có triệu chứng tương tự không"),
+    ]),
+]
+
+
+class FormSchema():
+    """Schema form được biên dịch một lần: mỗi trường có id dạng `category.key`
+    và một bit riêng, theo đúng thứ tự hỏi.
+
+    Trạng thái "đã điền" của một phiên là một bitmap, nên việc tìm trường tiếp
+    theo cần hỏi chỉ là lấy bit thấp nhất còn thiếu, còn danh sách nhãn còn
+    thiếu được cache theo bitmap.
+    """
+
+    def __init__(self, definition, gate=("symptom_details", "personal", "symptoms")):
+        self.categories = tuple(category for category, _ in definition)
+        fields = []
+        for category, entries in definition:
+            for key, label, summary_label in entries:
+                fields.append(FormField(f"{category}.{key}", category, key, label, summary_label, len(fields)))
+        self.fields = tuple(fields)
+        self.by_id = {field.id: field for field in self.fields}
+        self.labels = {field.id: field.label for field in self.fields}
+        self.category_masks = {category: 0 for category in self.categories}
+        for field in self.fields:
+            self.category_masks[field.category] |= 1 << field.bit
+        self.all_mask = (1 << len(self.fields)) - 1
+
+        # Chi tiết triệu chứng chỉ được hỏi khi đã có triệu chứng
+        gated_category, gate_category, gate_key = gate
+        self.gate_bit = 1 << self.by_id[f"{gate_category}.{gate_key}"].bit
+        self.gated_mask = self.all_mask & ~self.category_masks[gated_category]
+        self._missing_labels = {}
+
+    def field(self, category: str, key: str) -> Optional[FormField]:
+        return self.by_id.get(f"{category}.{key}")
+
+    def label(self, category: str, key: str) -> str:
+        field = self.field(category, key)
+        return field.label if field else key
+
+    def filled_mask(self, form_data: dict) -> int:
+        mask = 0
+        for field in self.fields:
+            if form_data.get(field.category, {}).get(field.key):
+                mask |= 1 << field.bit
+        return mask
+
+    def next_field(self, filled: int) -> Optional[FormField]:
+        eligible = self.all_mask if filled & self.gate_bit else self.gated_mask
+        missing = eligible & ~filled
+        if not missing:
+            return None
+        return self.fields[(missing & -missing).bit_length() - 1]
+
+    def missing_labels(self, filled: int) -> tuple:
+        labels = self._missing_labels.get(filled)
+        if labels is None:
+            if len(self._missing_labels) >= MISSING_LABELS_CACHE_SIZE:
+                self._missing_labels.clear()
+            labels = tuple(field.label for field in self.fields if not filled >> field.bit & 1)
+            self._missing_labels[filled] = labels
+        return labels
+
+    def filled_fields(self, form_data: dict, filled: int) -> list:
+        return [
+            (field, form_data[field.category][field.key])
+            for field in self.fields if filled >> field.bit & 1
+        ]
+
+    def empty_form(self) -> dict:
+        return {category: {} for category in self.categories}
+
+
+class FormState():
+    """Bitmap các trường đã điền của một phiên, cập nhật dần theo từng thay đổi."""
+
+    __slots__ = ("schema", "filled")
+
+    def __init__(self, schema: FormSchema, form_data: dict = None):
+        self.schema = schema
+        self.filled = schema.filled_mask(form_data) if form_data else 0
+
+    def update(self, category: str, key: str, value):
+        field = self.schema.field(category, key)
+        if field is None:
+            return
+        if value:
+            self.filled |= 1 << field.bit
+        else:
+            self.filled &= ~(1 << field.bit)
+
+    def next_field(self) -> Optional[FormField]:
+        return self.schema.next_field(self.filled)
+
+    def missing_labels(self) -> tuple:
+        return self.schema.missing_labels(self.filled)
+
+
+form_schema = FormSchema(FORM_DEFINITION)
@@ -0,0 +1,68 @@
+import asyncio
+import os
+from collections import deque
+
+# Số tin nhắn chờ xử lý tối đa của một phiên trước khi báo client chậm lại
+INBOX_SIZE = int(os.getenv("WS_INBOX_SIZE", "16"))
+
+stats = {"received": 0, "form_updates": 0, "superseded": 0, "backpressure": 0}
+
+
+class Inbox():
+    """Hàng đợi tin nhắn chat đến của một phiên, có giới hạn.
+
+    Tin nhắn chat mới làm các tin chat còn xếp hàng trước nó bị thay thế: chúng
+    vẫn được ghi vào lịch sử theo đúng thứ tự nhưng không tốn lời gọi LLM, vì câu
+    trả lời cho chúng sẽ không còn đúng ngữ cảnh. formUpdate không vào hàng đợi
+    (vòng nhận áp dụng ngay). Khi hàng đợi đầy, `put_nowait` trả về False để vòng
+    nhận báo back-pressure rồi chờ chỗ trống thay vì đệm vô hạn.
+    """
+
+    def __init__(self, maxsize=INBOX_SIZE):
+        self.maxsize = maxsize
+        # Mỗi phần tử: [tin nhắn, đã bị thay thế]
+        self._items = deque()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+
+    def _supersede(self):
+        for item in self._items:
+            if not item[1]:
+                item[1] = True
+                stats["superseded"] += 1
+
+    def put_nowait(self, message: str, data) -> bool:
+        if len(self._items) >= self.maxsize:
+            self._space.clear()
+            return False
+        if is_chat(data):
+            self._supersede()
+        self._items.append([message, False])
+        self._ready.set()
+        return True
+
+    async def put(self, message: str, data):
+        while not self.put_nowait(message, data):
+            await self._space.wait()
+
+    async def get(self) -> tuple:
+        # (tin nhắn, đã bị thay thế): tin đã bị thay thế chỉ cần ghi vào lịch sử
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        message, superseded = self._items.popleft()
+        self._space.set()
+        return message, superseded
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+def is_form_update(data) -> bool:
+    return isinstance(data, dict) and data.get("type") == "formUpdate"
+
+
+def is_chat(data) -> bool:
+    # Cùng điều kiện với nhánh chat của handle_message; tin nhắn không phải JSON cũng là chat
+    return data is None or (isinstance(data, dict) and (data.get("type") == "chat" or "type" not in data))
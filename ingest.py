@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+from google.api_core import exceptions
+from google.genai import types
+from pymongo import UpdateOne
+from embedding_cache import embedding_cache
+from vector_index import VectorIndex, INDEX_PATH
+
+# Nạp danh mục xét nghiệm từ CSV vào collection vector:
+#   python ingest.py test.csv --snapshot
+# Tiến độ được lưu sau mỗi chunk nên chạy lại lệnh sẽ tiếp tục từ chỗ đã dừng.
+# Collection được đồng bộ theo CSV: dòng mới/đổi được ghi, dòng không còn trong CSV bị xóa.
+
+CHECKPOINT_PATH = os.path.join("data", "ingest_checkpoint.json")
+# Đổi khi định dạng checkpoint đổi: checkpoint cũ bị bỏ qua, lần chạy bắt đầu lại từ đầu
+CHECKPOINT_VERSION = 2
+KEY_COLUMN = "Test_Name"
+TEXT_TEMPLATE = "{Symptoms}"
+
+
+def content_hash(text: str, model: str, task_type: str) -> str:
+    return hashlib.sha256(f"{model}\0{task_type}\0{text}".encode("utf-8")).hexdigest()
+
+
+def row_hash(row: dict) -> str:
+    # Hash toàn bộ các cột của dòng: đổi metadata (tên, chống chỉ định...) cũng phải ghi lại
+    return hashlib.sha256(json.dumps(row, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return isinstance(error, exceptions.ResourceExhausted) or getattr(error, "code", None) == 429
+
+
+class RateLimiter():
+    """Giãn cách lời gọi theo số request/phút; khi bị 429 thì giảm tốc, thành công thì tăng dần lại."""
+
+    def __init__(self, requests_per_minute: float):
+        self.base_interval = 60 / requests_per_minute
+        self.interval = self.base_interval
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next = max(self._next, loop.time()) + self.interval
+
+    def throttle(self):
+        self.interval = min(self.interval * 2, 60)
+
+    def recover(self):
+        self.interval = max(self.interval * 0.9, self.base_interval)
+
+
+class Ingestor():
+    def __init__(self, client, collection, model, task_type, batch_size=50, concurrency=4,
+                 requests_per_minute=60, retries=6, checkpoint_path=CHECKPOINT_PATH):
+        self.client = client
+        self.collection = collection
+        self.model = model
+        self.task_type = task_type
+        self.batch_size = batch_size
+        self.retries = retries
+        self.checkpoint_path = checkpoint_path
+        self.limiter = RateLimiter(requests_per_minute)
+        self._slots = asyncio.Semaphore(concurrency)
+        self.stats = {"rows": 0, "unchanged": 0, "cached": 0, "embedded": 0, "api_calls": 0, "upserted": 0, "deleted": 0}
+
+    def load_checkpoint(self, source: str) -> dict:
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if (checkpoint.get("source") == source and checkpoint.get("model") == self.model
+                    and checkpoint.get("version") == CHECKPOINT_VERSION):
+                return checkpoint
+        return {"source": source, "model": self.model, "version": CHECKPOINT_VERSION, "offset": 0, "hashes": {}}
+
+    def save_checkpoint(self, checkpoint: dict):
+        os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def existing_hashes(self) -> dict:
+        # KEY_COLUMN -> [hash nội dung embedding, hash cả dòng]
+        if self.collection is None:
+            return {}
+        return {
+            doc[KEY_COLUMN]: [doc.get("content_hash"), doc.get("row_hash")]
+            for doc in self.collection.find({}, {KEY_COLUMN: 1, "content_hash": 1, "row_hash": 1})
+            if KEY_COLUMN in doc
+        }
+
+    def delete_missing(self, keys: list):
+        result = self.collection.delete_many({KEY_COLUMN: {"$in": keys}})
+        return result.deleted_count
+
+    def bump_version(self):
+        self.collection.database["catalog_meta"].update_one(
+            {"_id": self.collection.name},
+            {"$set": {"version": uuid.uuid4().hex, "updated_at": time.time()}},
+            upsert=True
+        )
+
+    async def embed_batch(self, texts: list) -> list:
+        async with self._slots:
+            for attempt in range(self.retries):
+                await self.limiter.wait()
+                try:
+                    self.stats["api_calls"] += 1
+                    result = await self.client.aio.models.embed_content(
+                        model=self.model,
+                        contents=texts,
+                        config=types.EmbedContentConfig(task_type=self.task_type)
+                    )
+                    self.limiter.recover()
+                    return [embedding.values for embedding in result.embeddings]
+                except Exception as e:
+                    if not is_rate_limited(e) or attempt == self.retries - 1:
+                        raise
+                    self.limiter.throttle()
+                    delay = 2 ** attempt + random.random()
+                    print(f"Quota vượt quá, thử lại sau {delay:.1f} giây...")
+                    await asyncio.sleep(delay)
+
+    async def embed_texts(self, texts: list) -> list:
+        # Ưu tiên embedding đã có trong cache, phần còn lại gọi Gemini theo lô và song song
+        vectors = [embedding_cache.get(self.model, self.task_type, text) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        self.stats["cached"] += len(texts) - len(missing)
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        results = await asyncio.gather(*(self.embed_batch([texts[i] for i in batch]) for batch in batches))
+        for batch, embeddings in zip(batches, results):
+            for i, embedding in zip(batch, embeddings):
+                vectors[i] = embedding
+                embedding_cache.put(self.model, self.task_type, texts[i], embedding)
+        self.stats["embedded"] += len(missing)
+        return vectors
+
+    async def process_chunk(self, rows: list, known_hashes: dict, checkpoint: dict) -> list:
+        # Dòng chỉ đổi metadata được ghi lại mà không gọi embedding; chỉ dòng đổi nội dung
+        # embedding (TEXT_TEMPLATE) mới phải embed lại
+        documents = []
+        changed = []
+        for row in rows:
+            text = TEXT_TEMPLATE.format(**row)
+            digest = content_hash(text, self.model, self.task_type)
+            full_digest = row_hash(row)
+            known_digest, known_full = known_hashes.get(row[KEY_COLUMN]) or (None, None)
+            if known_full == full_digest and known_digest == digest:
+                self.stats["unchanged"] += 1
+                continue
+            doc = {**row, "content_hash": digest, "row_hash": full_digest}
+            if known_digest == digest:
+                documents.append(doc)
+            else:
+                changed.append((doc, text))
+
+        if changed:
+            vectors = await self.embed_texts([text for _, text in changed])
+            for (doc, _), vector in zip(changed, vectors):
+                documents.append({**doc, "embeddings": list(vector)})
+
+        if documents and self.collection is not None:
+            operations = [
+                UpdateOne({KEY_COLUMN: doc[KEY_COLUMN]}, {"$set": doc}, upsert=True)
+                for doc in documents
+            ]
+            await asyncio.to_thread(self.collection.bulk_write, operations, ordered=False)
+            self.stats["upserted"] += len(operations)
+
+        for doc in documents:
+            hashes = [doc["content_hash"], doc["row_hash"]]
+            checkpoint["hashes"][doc[KEY_COLUMN]] = hashes
+            known_hashes[doc[KEY_COLUMN]] = hashes
+        return documents
+
+    async def run(self, source: str, chunk_size: int = 200, snapshot_path: str = None):
+        import pandas as pd
+
+        checkpoint = self.load_checkpoint(source)
+        existing = self.existing_hashes()
+        known_hashes = {**existing, **checkpoint["hashes"]}
+        # Khóa của mọi dòng trong CSV, kể cả chunk đã xử lý ở lần chạy trước (vẫn được đọc lại)
+        seen = set()
+        offset = checkpoint["offset"]
+        if offset:
+            print(f"Tiếp tục từ dòng {offset}")
+
+        snapshot_documents = []
+        position = 0
+        for chunk in pd.read_csv(source, chunksize=chunk_size, dtype=str, keep_default_na=False):
+            rows = chunk.to_dict("records")
+            seen.update(row[KEY_COLUMN] for row in rows)
+            if position + len(rows) <= offset and snapshot_path is None:
+                position += len(rows)
+                continue
+            # Dòng đã xử lý ở lần chạy trước chỉ còn được đọc lại để dựng snapshot
+            skip = max(offset - position, 0)
+            pending = rows[skip:]
+            position += len(rows)
+            self.stats["rows"] += len(pending)
+            await self.process_chunk(pending, known_hashes, checkpoint)
+            checkpoint["offset"] = max(offset, position)
+            self.save_checkpoint(checkpoint)
+            if snapshot_path is not None and self.collection is None:
+                snapshot_documents.extend(rows)
+
+        missing = [key for key in existing if key not in seen]
+        if missing and self.collection is not None:
+            if seen:
+                self.stats["deleted"] = await asyncio.to_thread(self.delete_missing, missing)
+            else:
+                # Nguồn rỗng (đọc nhầm file?): không xóa cả danh mục
+                print(f"Nguồn {source} không có dòng nào, bỏ qua việc xóa {len(missing)} dòng cũ")
+
+        if snapshot_path is not None:
+            if self.collection is not None:
+                index = VectorIndex.from_collection(self.collection)
+            else:
+                # Không có Mongo: lấy embedding của mọi dòng từ cache (vừa được ghi ở trên)
+                texts = [TEXT_TEMPLATE.format(**row) for row in snapshot_documents]
+                vectors = await self.embed_texts(texts)
+                index = VectorIndex.from_documents(
+                    {**row, "_id": row[KEY_COLUMN], "embeddings": vector}
+                    for row, vector in zip(snapshot_documents, vectors)
+                )
+            index.save(snapshot_path)
+            print(f"Đã ghi snapshot index {len(index.records)} dòng tại {snapshot_path}")
+
+        if (self.stats["upserted"] or self.stats["deleted"]) and self.collection is not None:
+            # Báo cho các API worker biết danh mục đã đổi để xóa cache kết quả tìm kiếm
+            await asyncio.to_thread(self.bump_version)
+
+        # Hoàn tất: xóa checkpoint, lần chạy sau so hash trực tiếp với Mongo
+        # (chưa chunk nào được ghi, ví dụ nguồn rỗng, thì không có file checkpoint)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return self.stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Nạp danh mục xét nghiệm và embedding vào collection vector")
+    parser.add_argument("source", nargs="?", default="test.csv")
+    parser.add_argument("--chunk-size", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rpm", type=float, default=60, help="Số request embedding tối đa mỗi phút")
+    parser.add_argument("--snapshot", nargs="?", const=INDEX_PATH, default=None,
+                        help="Ghi thêm snapshot index cục bộ (thư mục phiên bản matrix.npy/records.json)")
+    parser.add_argument("--skip-mongo", action="store_true", help="Không ghi Mongo, chỉ dựng snapshot")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    args = parser.parse_args()
+
+    from test import collection, EMBEDDING_MODEL, EMBEDDING_TASK_TYPE
+    from providers import providers
+
+    ingestor = Ingestor(
+        providers.get("gemini"),
+        None if args.skip_mongo else collection,
+        EMBEDDING_MODEL,
+        EMBEDDING_TASK_TYPE,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        checkpoint_path=args.checkpoint,
+    )
+    stats = await ingestor.run(args.source, chunk_size=args.chunk_size, snapshot_path=args.snapshot)
+    print(f"Hoàn tất: {stats}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+import json
+
+
+class ReplyStreamParser():
+    """Parser JSON tăng dần cho output dạng {"form": {...}, "reply": "..."} của model.
+
+    Mỗi lần `feed` một đoạn token, parser trả về danh sách sự kiện:
+    ("reply", đoạn chữ mới của trường reply) ngay khi ký tự tới, và
+    ("form", dict) ngay khi object form đã đóng ngoặc đầy đủ.
+    """
+
+    def __init__(self, reply_key="reply", form_key="form"):
+        self.reply_key = reply_key
+        self.form_key = form_key
+        self.text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = ""
+        self._expect_key = False
+        self._key_start = None
+        self._last_key = None
+        self._current_key = None
+        self._in_reply = False
+        self._pending_surrogate = ""
+        self._form_start = None
+        self.form = None
+        self.reply = ""
+
+    def feed(self, chunk: str) -> list:
+        self.text += chunk
+        events = []
+        reply_delta = []
+        text = self.text
+        while self._pos < len(text):
+            char = text[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape += char
+                    if not self._escape_complete():
+                        self._pos += 1
+                        continue
+                    if self._in_reply:
+                        decoded = self._decode_escape(self._escape)
+                        if decoded:
+                            reply_delta.append(decoded)
+                    self._escape = ""
+                elif char == "\\":
+                    self._escape = char
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._last_key = json.loads(text[self._key_start:self._pos + 1])
+                        self._key_start = None
+                    self._in_reply = False
+                elif self._in_reply:
+                    reply_delta.append(char)
+            elif char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._key_start = self._pos
+                    self._expect_key = False
+                elif self._depth == 1 and self._current_key == self.reply_key:
+                    self._in_reply = True
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect_key = True
+                elif self._depth == 2 and self._current_key == self.form_key:
+                    self._form_start = self._pos
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._form_start is not None:
+                    try:
+                        self.form = json.loads(text[self._form_start:self._pos + 1])
+                        self._flush_reply(reply_delta, events)
+                        events.append(("form", self.form))
+                    except ValueError:
+                        pass
+                    self._form_start = None
+            elif self._depth == 1:
+                if char == ":":
+                    self._current_key = self._last_key
+                elif char == ",":
+                    self._expect_key = True
+                    self._current_key = None
+            self._pos += 1
+
+        self._flush_reply(reply_delta, events)
+        return events
+
+    def _flush_reply(self, reply_delta: list, events: list):
+        if reply_delta:
+            delta = "".join(reply_delta)
+            reply_delta.clear()
+            self.reply += delta
+            events.append(("reply", delta))
+
+    def _escape_complete(self) -> bool:
+        if len(self._escape) < 2:
+            return False
+        if self._escape[1] == "u":
+            return len(self._escape) == 6
+        return True
+
+    def _decode_escape(self, escape: str) -> str:
+        decoded = json.loads(f'"{escape}"') if not escape.startswith("\\u") else chr(int(escape[2:], 16))
+        # Ghép cặp surrogate UTF-16 (ví dụ emoji) thành một ký tự
+        if "\ud800" <= decoded <= "\udbff":
+            self._pending_surrogate = decoded
+            return ""
+        if self._pending_surrogate and "\udc00" <= decoded <= "\udfff":
+            high = self._pending_surrogate
+            self._pending_surrogate = ""
+            return (high + decoded).encode("utf-16", "surrogatepass").decode("utf-16")
+        return decoded
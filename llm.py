@@ -0,0 +1,176 @@
+import asyncio
+import os
+import time
+from collections import deque
+import dotenv
+from metrics import metrics
+dotenv.load_dotenv()
+
+# Cấu hình mặc định cho gateway, có thể ghi đè bằng biến môi trường
+DEFAULT_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+MODEL_CONCURRENCY = {
+    "gpt-4": int(os.getenv("LLM_GPT4_CONCURRENCY", "8")),
+    "gpt-4o-mini": int(os.getenv("LLM_GPT4O_MINI_CONCURRENCY", "24")),
+}
+DEFAULT_MODEL_CONCURRENCY = int(os.getenv("LLM_MODEL_CONCURRENCY", "16"))
+# Số lời gọi gần nhất giữ lại chi tiết (token prompt, token được cache, độ trễ)
+USAGE_LOG_SIZE = int(os.getenv("LLM_USAGE_LOG_SIZE", "256"))
+
+
+class LLMGateway():
+    """Gateway async dùng chung cho mọi lời gọi OpenAI chat completion.
+
+    Giữ một pool kết nối HTTP, giới hạn số lời gọi đồng thời (toàn cục và theo
+    model) và áp deadline cho từng lời gọi, tính cả thời gian chờ trong hàng đợi.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, model_concurrency=None,
+                 default_timeout=DEFAULT_TIMEOUT, max_connections=MAX_CONNECTIONS):
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = dict(MODEL_CONCURRENCY if model_concurrency is None else model_concurrency)
+        self.default_timeout = default_timeout
+        self.max_connections = max_connections
+        self._client = None
+        self._global_limit = None
+        self._model_limits = {}
+        self.usage = {}
+        self.calls = deque(maxlen=USAGE_LOG_SIZE)
+
+    @property
+    def client(self) -> "openai.AsyncOpenAI":
+        if self._client is None:
+            # SDK OpenAI chỉ được import khi cần client lần đầu (hoặc khi startup hook warm)
+            import httpx
+            import openai
+            http_client = openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                )
+            )
+            self._client = openai.AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                http_client=http_client,
+            )
+        return self._client
+
+    def _limits_for(self, model: str):
+        # Semaphore được tạo lười để gắn với event loop đang chạy
+        if self._global_limit is None:
+            self._global_limit = asyncio.Semaphore(self.max_concurrency)
+        if model not in self._model_limits:
+            self._model_limits[model] = asyncio.Semaphore(
+                self.model_concurrency.get(model, DEFAULT_MODEL_CONCURRENCY)
+            )
+        return self._global_limit, self._model_limits[model]
+
+    def _record(self, model: str, usage, started: float, first_token: float = None):
+        # Token được provider cache nằm trong usage.prompt_tokens_details.cached_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        elapsed = time.perf_counter() - started
+        call = {
+            "model": model,
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "latency_ms": round(elapsed * 1000),
+            "ttft_ms": None if first_token is None else round((first_token - started) * 1000),
+        }
+        self.calls.append(call)
+        metrics.observe("llm", elapsed, model=model)
+        if first_token is not None:
+            metrics.observe("llm_first_token", first_token - started, model=model)
+        for kind in ("prompt", "cached", "completion"):
+            metrics.inc("llm_tokens", call[f"{kind}_tokens"], model=model, kind=kind)
+        totals = self.usage.setdefault(model, {
+            "calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "latency_ms": 0
+        })
+        totals["calls"] += 1
+        for key in ("prompt_tokens", "cached_tokens", "completion_tokens", "latency_ms"):
+            totals[key] += call[key]
+        return call
+
+    def cache_report(self) -> dict:
+        return {
+            model: {
+                **totals,
+                "cached_ratio": round(totals["cached_tokens"] / totals["prompt_tokens"], 3) if totals["prompt_tokens"] else 0.0,
+            }
+            for model, totals in self.usage.items()
+        }
+
+    async def _create(self, model: str, messages: list, **kwargs):
+        global_limit, model_limit = self._limits_for(model)
+        async with global_limit, model_limit:
+            started = time.perf_counter()
+            response = await self.client.chat.completions.create(
+                model=model, messages=messages, **kwargs
+            )
+            self._record(model, getattr(response, "usage", None), started)
+            return response
+
+    async def create(self, model: str, messages: list, timeout: float = None, **kwargs):
+        # Deadline bao gồm cả thời gian chờ semaphore
+        deadline = self.default_timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(self._create(model, messages, **kwargs), deadline)
+        except Exception as e:
+            metrics.inc("llm_errors", model=model, error=type(e).__name__)
+            raise
+
+    async def complete(self, model: str, messages: list, timeout: float = None, **kwargs) -> str:
+        response = await self.create(model, messages, timeout=timeout, **kwargs)
+        return response.choices[0].message.content
+
+    async def stream(self, model: str, messages: list, timeout: float = None, **kwargs):
+        # Trả về từng đoạn nội dung; deadline áp cho toàn bộ lời gọi, kể cả thời gian chờ
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self.default_timeout if timeout is None else timeout)
+        global_limit, model_limit = self._limits_for(model)
+
+        async def remaining(awaitable):
+            return await asyncio.wait_for(awaitable, max(deadline - loop.time(), 0))
+
+        await remaining(global_limit.acquire())
+        try:
+            await remaining(model_limit.acquire())
+            response = None
+            # Chunk cuối (không có choices) mang usage của cả lời gọi
+            kwargs.setdefault("stream_options", {"include_usage": True})
+            started = time.perf_counter()
+            first_token = None
+            usage = None
+            try:
+                response = await remaining(self.client.chat.completions.create(
+                    model=model, messages=messages, stream=True, **kwargs
+                ))
+                iterator = response.__aiter__()
+                while True:
+                    try:
+                        chunk = await remaining(iterator.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        yield chunk.choices[0].delta.content
+                self._record(model, usage, started, first_token)
+            finally:
+                model_limit.release()
+                # Đóng stream HTTP khi hết deadline hoặc bên gọi dừng giữa chừng
+                if response is not None and hasattr(response, "close"):
+                    await response.close()
+        finally:
+            global_limit.release()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+gateway = LLMGateway()
@@ -0,0 +1,254 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+# Tiền tố tên metric Prometheus và các ngưỡng bucket (giây) dùng chung cho mọi stage
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "vitalink")
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Số mẫu gần nhất mỗi stage để tính p50/p95/p99, số trace lượt gần nhất giữ lại
+QUANTILE_WINDOW = int(os.getenv("METRICS_QUANTILE_WINDOW", "1024"))
+TRACE_BUFFER = int(os.getenv("METRICS_TRACE_BUFFER", "200"))
+# In mỗi trace lượt thành một dòng JSON
+TRACE_LOG = os.getenv("METRICS_TRACE_LOG", "0") == "1"
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current_turn = contextvars.ContextVar("turn", default=None)
+
+
+class Histogram():
+    """Histogram theo bucket cố định kèm cửa sổ mẫu gần nhất để tính percentile.
+
+    observe() chỉ là một bisect và vài phép cộng dưới lock, đủ rẻ để bật thường trực.
+    """
+
+    __slots__ = ("counts", "sum", "count", "recent", "_lock")
+
+    def __init__(self, window=QUANTILE_WINDOW):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+            self.sum += value
+            self.count += 1
+            self.recent.append(value)
+
+    def quantiles(self) -> dict:
+        with self._lock:
+            ordered = sorted(self.recent)
+        if not ordered:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+
+class Turn():
+    """Trace của một lượt (chat, submit_tests, voice): các span được gắn vào lượt đang chạy qua contextvar."""
+
+    __slots__ = ("turn_id", "kind", "fields", "started", "spans", "detached")
+
+    def __init__(self, kind: str, **fields):
+        self.turn_id = uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.spans = []
+        self.detached = False
+
+    def detach(self):
+        # Lượt còn chạy tiếp sau khi handler trả về (StreamingResponse): scope hiện tại không
+        # chốt lượt, phần sinh dữ liệu phải mở lại bằng metrics.resume(turn) để chốt khi xong
+        self.detached = True
+
+    def record(self) -> dict:
+        return {
+            "turn_id": self.turn_id,
+            "kind": self.kind,
+            **self.fields,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "spans": self.spans,
+        }
+
+
+class Metrics():
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.traces = deque(maxlen=TRACE_BUFFER)
+
+    def _histogram(self, stage: str, labels: tuple) -> Histogram:
+        key = (stage, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, stage: str, seconds: float, **labels):
+        self._histogram(stage, tuple(sorted(labels.items())) if labels else ()).observe(seconds)
+        turn = _current_turn.get()
+        if turn is not None:
+            turn.spans.append({"stage": stage, **labels, "ms": round(seconds * 1000, 1)})
+
+    def span(self, stage: str, **labels):
+        return _Span(self, stage, labels)
+
+    def turn(self, kind: str, **fields):
+        return _TurnScope(self, Turn(kind, **fields))
+
+    def resume(self, turn: Turn):
+        turn.detached = False
+        return _TurnScope(self, turn)
+
+    def current_turn_id(self):
+        turn = _current_turn.get()
+        return turn.turn_id if turn is not None else None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, read):
+        # Gauge được đọc lúc scrape (số socket đang mở, số user...), không tốn gì trên đường xử lý
+        self._gauges[name] = read
+
+    def register_stats(self, group: str, stats, hits=(), misses=()):
+        # Gom các dict stats sẵn có của từng module (cache, inbox, extractor...) vào /metrics;
+        # `stats` là dict hoặc hàm trả về dict, hits/misses dùng để tính tỉ lệ hit
+        self._stats[group] = (stats, hits, misses)
+
+    def _finish(self, turn: Turn):
+        record = turn.record()
+        self.traces.append(record)
+        self.observe_turn(turn.kind, record["duration_ms"] / 1000)
+        if TRACE_LOG:
+            print(json.dumps({"trace": record}, ensure_ascii=False))
+
+    def observe_turn(self, kind: str, seconds: float):
+        self._histogram("turn", (("kind", kind),)).observe(seconds)
+
+    def render(self) -> str:
+        """Toàn bộ metric theo định dạng text của Prometheus (version 0.0.4)."""
+        prefix = self.prefix
+        lines = [
+            f"# HELP {prefix}_stage_seconds Thời gian của từng stage (LLM, Mongo, embedding, vector search, STT, TTS...)",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        quantile_lines = [f"# TYPE {prefix}_stage_seconds_recent gauge"]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for (stage, labels), histogram in histograms:
+            base = {"stage": stage, **dict(labels)}
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{prefix}_stage_seconds_bucket{_labels({**base, 'le': le})} {cumulative}")
+            lines.append(f"{prefix}_stage_seconds_sum{_labels(base)} {histogram.sum:.6f}")
+            lines.append(f"{prefix}_stage_seconds_count{_labels(base)} {histogram.count}")
+            for q, value in histogram.quantiles().items():
+                quantile_lines.append(f"{prefix}_stage_seconds_recent{_labels({**base, 'quantile': q})} {value:.6f}")
+        lines += quantile_lines
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total{_labels(dict(labels))} {value}")
+
+        for group, (stats, hits, misses) in sorted(self._stats.items()):
+            values = stats() if callable(stats) else stats
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"{prefix}_{group}_{key}_total {value}")
+            if hits:
+                hit = sum(values.get(key, 0) for key in hits)
+                total = hit + sum(values.get(key, 0) for key in misses)
+                lines.append(f"# TYPE {prefix}_{group}_hit_ratio gauge")
+                lines.append(f"{prefix}_{group}_hit_ratio {hit / total if total else 0:.4f}")
+
+        for name, read in sorted(self._gauges.items()):
+            try:
+                value = read()
+            except Exception as e:
+                print(f"Error: không đọc được gauge {name}: {e}")
+                continue
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            if isinstance(value, dict):
+                # Gauge có nhãn, ví dụ token theo model: {(("model", "gpt-4o-mini"),): 123}
+                for labels, item in value.items():
+                    lines.append(f"{prefix}_{name}{_labels(dict(labels))} {item}")
+            else:
+                lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    body = ",".join(
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for key, value in labels.items()
+    )
+    return "{" + body + "}"
+
+
+class _Span():
+    __slots__ = ("metrics", "stage", "labels", "started")
+
+    def __init__(self, metrics: Metrics, stage: str, labels: dict):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = self.labels if exc_type is None else {**self.labels, "error": exc_type.__name__}
+        self.metrics.observe(self.stage, time.perf_counter() - self.started, **labels)
+        return False
+
+
+class _TurnScope():
+    __slots__ = ("metrics", "turn", "token")
+
+    def __init__(self, metrics: Metrics, turn: Turn):
+        self.metrics = metrics
+        self.turn = turn
+
+    def __enter__(self) -> Turn:
+        self.token = _current_turn.set(self.turn)
+        return self.turn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            _current_turn.reset(self.token)
+        except ValueError:
+            # Generator bị đóng từ context khác (client ngắt stream): không còn gì để khôi phục
+            pass
+        if exc_type is not None:
+            self.turn.fields["error"] = exc_type.__name__
+        elif self.turn.detached:
+            return False
+        self.metrics._finish(self.turn)
+        return False
+
+
+metrics = Metrics()
@@ -0,0 +1,165 @@
+import asyncio
+import contextvars
+from metrics import metrics
+
+# Số thao tác tối đa gom vào một lần bulk_write và thời gian chờ gom thêm
+BATCH_SIZE = 256
+FLUSH_INTERVAL = 0.05
+MAX_BACKOFF = 5
+# Số lần thử mỗi lô; hết lượt thì lô vào hàng chờ ghi lại (dead letter) thay vì chặn worker mãi
+MAX_ATTEMPTS = 5
+# Giới hạn số message nằm trong dead letter khi Mongo mất lâu; vượt quá thì bỏ phiên cũ nhất
+DEAD_LETTER_MESSAGES = 50000
+# Khi còn dead letter mà không có gì mới, sau khoảng này worker tự thử ghi lại
+RETRY_INTERVAL = 5
+# Thời gian tối đa một lời gọi flush() chờ worker
+FLUSH_TIMEOUT = 2
+
+
+class ChatHistoryWriter():
+    """Ghi lịch sử chat theo kiểu write-behind, chỉ append message mới.
+
+    Các message được đưa vào một hàng đợi async; một worker nền gom message
+    của nhiều phiên lại và ghi bằng một lệnh bulk_write gồm các `$push`, nên
+    lượng dữ liệu ghi mỗi lượt không phụ thuộc độ dài hội thoại và lượt chat
+    không phải chờ Mongo. Lô ghi lỗi quá MAX_ATTEMPTS lần được giữ lại và gộp
+    vào trước lô kế tiếp (giữ đúng thứ tự message), worker không bao giờ bị
+    treo vì Mongo mất kết nối.
+    """
+
+    def __init__(self, collection, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._worker = None
+        self._closing = False
+        self._failed = {}
+        self._failed_states = {}
+        self.stats = {"written_messages": 0, "failed_batches": 0, "dropped_messages": 0}
+
+    def _ensure_worker(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            # Context rỗng: worker sống lâu hơn lượt đã khởi tạo nó, không được mang theo trace của lượt đó
+            self._worker = asyncio.get_running_loop().create_task(self._run(), context=contextvars.Context())
+
+    def append(self, user_id: str, messages: list):
+        if not messages:
+            return
+        self._ensure_worker()
+        self._queue.put_nowait((user_id, list(messages), None))
+
+    def snapshot(self, user_id: str, state: dict):
+        # Ảnh chụp trạng thái phiên (form, con trỏ hội thoại) ghi kèm cùng document lịch sử;
+        # nhiều ảnh chụp của cùng user trong một lô chỉ ghi bản mới nhất
+        self._ensure_worker()
+        self._queue.put_nowait((user_id, [], state))
+
+    def pending_messages(self) -> int:
+        return sum(len(messages) for messages in self._failed.values())
+
+    async def flush(self, timeout=FLUSH_TIMEOUT) -> bool:
+        # Chờ tới khi mọi message đã đưa vào hàng đợi trước lời gọi này được xử lý; False nếu
+        # quá hạn hoặc còn message nằm trong dead letter (Mongo lỗi), người gọi đọc dữ liệu có thể cũ
+        if self._queue is None:
+            return True
+        self._ensure_worker()
+        done = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((None, done, None))
+        try:
+            await asyncio.wait_for(done, timeout)
+        except asyncio.TimeoutError:
+            return False
+        return not self._failed
+
+    async def close(self):
+        # Khi tắt server chỉ thử ghi lại vài lần để không treo quá trình shutdown
+        self._closing = True
+        await self.flush(timeout=None)
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def _next_batch(self):
+        if self._failed:
+            try:
+                first = await asyncio.wait_for(self._queue.get(), RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                return []
+        else:
+            first = await self._queue.get()
+        batch = [first]
+        if self.flush_interval:
+            await asyncio.sleep(self.flush_interval)
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            # Lô lỗi trước đó đi trước để message của mỗi phiên vẫn đúng thứ tự
+            pending = {user_id: list(messages) for user_id, messages in self._failed.items()}
+            states = dict(self._failed_states)
+            waiters = []
+            for user_id, item, state in batch:
+                if user_id is None:
+                    waiters.append(item)
+                    continue
+                pending.setdefault(user_id, []).extend(item)
+                if state is not None:
+                    states[user_id] = state
+            if pending:
+                if await self._write(pending, states):
+                    self._failed, self._failed_states = {}, {}
+                else:
+                    self._keep_failed(pending, states)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def _write(self, pending: dict, states: dict = None):
+        # Mỗi phiên một UpdateOne duy nhất, giữ nguyên thứ tự message trong phiên
+        from pymongo import UpdateOne
+
+        states = states or {}
+        operations = []
+        for user_id, messages in pending.items():
+            update = {}
+            if messages:
+                update["$push"] = {"chat_history": {"$each": messages}}
+            if user_id in states:
+                update["$set"] = {"session": states[user_id]}
+            operations.append(UpdateOne({"user_id": user_id}, update, upsert=True))
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                with metrics.span("mongo_write"):
+                    await asyncio.to_thread(self.collection.bulk_write, operations, ordered=False)
+                written = sum(len(messages) for messages in pending.values())
+                self.stats["written_messages"] += written
+                metrics.inc("mongo_written_messages", written)
+                return True
+            except Exception as e:
+                if attempt == MAX_ATTEMPTS or (self._closing and attempt >= 3):
+                    self.stats["failed_batches"] += 1
+                    print(f"Error: không ghi được {sum(len(m) for m in pending.values())} message sau {attempt} lần: {e}")
+                    return False
+                delay = min(2 ** attempt * 0.1, MAX_BACKOFF)
+                print(f"Ghi lịch sử chat thất bại, thử lại sau {delay} giây: {e}")
+                await asyncio.sleep(delay)
+        return False
+
+    def _keep_failed(self, pending: dict, states: dict):
+        # Giữ lô lỗi để gộp vào lần ghi sau; quá giới hạn thì bỏ các phiên cũ nhất
+        self._failed = pending
+        self._failed_states = states
+        while self._failed and self.pending_messages() > DEAD_LETTER_MESSAGES:
+            user_id = next(iter(self._failed))
+            self.stats["dropped_messages"] += len(self._failed.pop(user_id))
+            self._failed_states.pop(user_id, None)
@@ -0,0 +1,131 @@
+import os
+import zlib
+from collections import deque
+from session import frame
+
+# Protocol 2 của /api/chat: client gửi {"type": "init", "protocol": 2} để nhận delta thay vì
+# toàn bộ lịch sử và form sau mỗi lượt. Client cũ không gửi "protocol" vẫn nhận frame như trước.
+# Nối lại: client phải gửi lại đủ user_id, resume_token (cấp trong snapshot đầu tiên), session_id
+# và last_seq. Phiên được tìm theo user_id (SessionStore) và chỉ khôi phục khi token khớp; thiếu
+# user_id hoặc token sai thì server coi là phiên mới.
+PROTOCOL_VERSION = 2
+# Số frame gần nhất giữ lại để phát lại khi client nối lại
+REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "256"))
+# Frame ngắn hơn ngưỡng này gửi dạng text, nén không đáng
+COMPRESS_MIN_BYTES = int(os.getenv("WS_COMPRESS_MIN_BYTES", "512"))
+
+
+def _escape(token: str) -> str:
+    return token.replace("~", "~0").replace("/", "~1")
+
+
+def diff_form(old: dict, new: dict) -> list:
+    # Diff hai form hai tầng (category -> key -> value) thành các thao tác kiểu JSON Patch
+    ops = []
+    for category, values in new.items():
+        before = old.get(category)
+        if not isinstance(values, dict) or not isinstance(before, dict):
+            if values != before:
+                ops.append({"op": "replace" if category in old else "add", "path": f"/{_escape(category)}", "value": values})
+            continue
+        for key, value in values.items():
+            if key not in before:
+                ops.append({"op": "add", "path": f"/{_escape(category)}/{_escape(key)}", "value": value})
+            elif before[key] != value:
+                ops.append({"op": "replace", "path": f"/{_escape(category)}/{_escape(key)}", "value": value})
+        for key in before.keys() - values.keys():
+            ops.append({"op": "remove", "path": f"/{_escape(category)}/{_escape(key)}"})
+    for category in old.keys() - new.keys():
+        ops.append({"op": "remove", "path": f"/{_escape(category)}"})
+    return ops
+
+
+def copy_form(form: dict) -> dict:
+    return {category: dict(values) if isinstance(values, dict) else values for category, values in form.items()}
+
+
+def negotiate_compression(requested, extensions: str):
+    # Nếu handshake đã có permessage-deflate thì tầng transport nén rồi, không nén lần nữa
+    if requested not in ("deflate", "permessage-deflate"):
+        return None
+    if "permessage-deflate" in (extensions or ""):
+        return "permessage-deflate"
+    return "deflate"
+
+
+class DeltaChannel():
+    """Luồng frame protocol 2 của một phiên.
+
+    Mỗi frame thay đổi trạng thái được đánh seq tăng dần và giữ trong một
+    buffer vòng; client nối lại gửi seq cuối đã thấy và chỉ nhận phần còn
+    thiếu. Channel nhớ số message và bản form đã gửi nên chỉ gửi phần thêm
+    mới của lịch sử và diff của form.
+    """
+
+    def __init__(self, compression=None, buffer_size=REPLAY_BUFFER):
+        self.seq = 0
+        self.sent_messages = 0
+        self.sent_form = {}
+        self._log = deque(maxlen=buffer_size)
+        self.set_compression(compression)
+
+    def set_compression(self, compression):
+        # Gọi lại mỗi khi gắn vào kết nối mới: bộ giải nén phía client cũng là bộ mới
+        self.compression = compression
+        self._compressor = None
+        if compression == "deflate":
+            self._compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+
+    def delta(self, chat_history, form: dict = None, **extra):
+        # Frame gồm các message mới, diff form và các trường thêm (vd. tests); None nếu không có gì mới
+        event = {"type": "delta"}
+        raw = {}
+        if len(chat_history) > self.sent_messages:
+            raw["messages"] = chat_history.json(self.sent_messages)
+            self.sent_messages = len(chat_history)
+        if form is not None:
+            ops = diff_form(self.sent_form, form)
+            if ops:
+                event["patch"] = ops
+                self.sent_form = copy_form(form)
+        event.update(extra)
+        if len(event) == 1 and not raw:
+            return None
+        self.seq += 1
+        event["seq"] = self.seq
+        text = frame(event, **raw)
+        self._log.append((self.seq, text))
+        return text
+
+    def snapshot(self, chat_history, form: dict, **extra) -> str:
+        # Trạng thái đầy đủ tại seq hiện tại: lúc init, hoặc khi client đã lỡ quá nhiều để phát lại
+        self.sent_messages = len(chat_history)
+        self.sent_form = copy_form(form)
+        return frame(
+            {"type": "snapshot", "seq": self.seq, "form": form, **extra},
+            chat_history=chat_history.json()
+        )
+
+    def replay(self, last_seq: int):
+        # Danh sách frame sau last_seq, hoặc None nếu buffer không còn đủ để phát lại
+        if last_seq >= self.seq:
+            return []
+        if not self._log or self._log[0][0] > last_seq + 1:
+            return None
+        return [text for seq, text in self._log if seq > last_seq]
+
+    def encode(self, text: str):
+        if self._compressor is None or len(text) < COMPRESS_MIN_BYTES:
+            return text
+        data = text.encode("utf-8")
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+async def send(websocket, text: str):
+    # Frame lớn của phiên bật nén được gửi dạng binary (raw deflate, dùng chung context cả kết nối)
+    channel = getattr(websocket, "channel", None)
+    payload = channel.encode(text) if channel is not None else text
+    if isinstance(payload, bytes):
+        await websocket.send_bytes(payload)
+    else:
+        await websocket.send_text(payload)
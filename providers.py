@@ -0,0 +1,110 @@
+import asyncio
+import os
+import threading
+import time
+import dotenv
+dotenv.load_dotenv()
+
+MONGO_DB = os.getenv("MONGODB_DB", "Vitalink")
+# Client được khởi động sẵn trong startup hook của API
+WARM_PROVIDERS = [name for name in os.getenv("WARM_PROVIDERS", "mongo,gemini,openai,assemblyai").split(",") if name]
+
+
+class Providers():
+    """Danh bạ các client dịch vụ ngoài (Mongo, Gemini, OpenAI, AssemblyAI).
+
+    Mỗi client chỉ được tạo (kèm import SDK nặng của nó) ở lần dùng đầu tiên
+    hoặc khi startup hook gọi warm(), nên import module và reload không còn
+    chậm hay hỏng khi không có mạng.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+        self.timings = {}
+
+    def register(self, name: str, factory):
+        self._factories[name] = factory
+
+    def get(self, name: str):
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        # Có thể được gọi từ thread (asyncio.to_thread): chỉ tạo một client cho mỗi tên
+        with self._lock:
+            if name not in self._instances:
+                started = time.perf_counter()
+                self._instances[name] = self._factories[name]()
+                self.timings[name] = round((time.perf_counter() - started) * 1000)
+            return self._instances[name]
+
+    def collection(self, name: str, database: str = MONGO_DB):
+        return LazyCollection(self, database, name)
+
+    async def warm(self, names=None) -> dict:
+        # Lỗi của một client không chặn server khởi động, lần dùng đầu sẽ thử lại
+        for name in names or WARM_PROVIDERS:
+            try:
+                await asyncio.to_thread(self.get, name)
+            except Exception as e:
+                print(f"Error: không khởi tạo được client {name}: {e}")
+        return dict(self.timings)
+
+    def reset(self, name: str = None):
+        with self._lock:
+            if name is None:
+                self._instances.clear()
+            else:
+                self._instances.pop(name, None)
+
+
+class LazyCollection():
+    """Collection Mongo chỉ được resolve (tạo MongoClient) khi có thao tác đầu tiên."""
+
+    __slots__ = ("_providers", "_database", "_name", "_collection")
+
+    def __init__(self, providers: Providers, database: str, name: str):
+        self._providers = providers
+        self._database = database
+        self._name = name
+        self._collection = None
+
+    def resolve(self):
+        if self._collection is None:
+            self._collection = self._providers.get("mongo")[self._database][self._name]
+        return self._collection
+
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+
+    def __repr__(self):
+        return f"LazyCollection({self._database}.{self._name})"
+
+
+def _mongo():
+    from pymongo import MongoClient
+    return MongoClient(os.getenv("MONGODB_URI"))
+
+
+def _gemini():
+    from google import genai
+    return genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+
+
+def _openai():
+    from llm import gateway
+    return gateway.client
+
+
+def _assemblyai():
+    import assemblyai as aai
+    aai.settings.api_key = os.getenv("ASSEMBLY_API_KEY")
+    return aai.Transcriber()
+
+
+providers = Providers()
+providers.register("mongo", _mongo)
+providers.register("gemini", _gemini)
+providers.register("openai", _openai)
+providers.register("assemblyai", _assemblyai)
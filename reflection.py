@@ -1,13 +1,56 @@
 from typing import List
-import openai
 import os
+import re
+import unicodedata
+from collections import OrderedDict
 import dotenv
+from llm import gateway
 dotenv.load_dotenv()
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# Số message cuối dùng làm khóa memo: cùng câu hỏi trên cùng đoạn hội thoại gần nhất thì dùng lại kết quả
+REFLECTION_TAIL = int(os.getenv("REFLECTION_TAIL", "6"))
+REFLECTION_MEMO_SIZE = int(os.getenv("REFLECTION_MEMO_SIZE", "64"))
+
+# Đại từ, từ chỉ định và cách nói tắt cho thấy câu hỏi dựa vào ngữ cảnh trước đó
+REFERENCE_PATTERN = re.compile(
+    r"\b(nó|chúng nó|họ(?! (và )?tên)|cái (đó|này|kia|ấy)|(điều|việc|chuyện|chỗ|bệnh|triệu chứng|xét nghiệm|thuốc) (đó|này|ấy|kia|trên)"
+    r"|như (trên|vậy|thế)|ở trên|kể trên|nói trên|vừa (rồi|nói)|thì sao|còn gì|cũng vậy|cũng thế"
+    r"|it|that|this|those|them|the same|above)\b"
+)
+# Câu bắt đầu bằng "còn", "và", "thế còn"... thường là câu hỏi nối tiếp
+FOLLOW_UP_START = re.compile(r"^(còn|và|thế còn|vậy còn|also|and|what about)\b")
+MIN_STANDALONE_WORDS = 3
+
+stats = {"calls": 0, "skipped": 0, "memo_hits": 0, "llm_calls": 0}
+
+
+def needs_reformulation(question: str) -> bool:
+    # Heuristic cục bộ: chỉ tốn một lời gọi LLM khi câu hỏi có vẻ phụ thuộc vào ngữ cảnh
+    text = unicodedata.normalize("NFC", question.lower()).strip()
+    if not text:
+        return False
+    if "..." in text or "…" in text:
+        return True
+    # Câu hỏi cụt ("tại sao?") cần ngữ cảnh; câu ngắn khẳng định ("sốt") thì đã đủ để tìm kiếm
+    if len(text.split()) < MIN_STANDALONE_WORDS and text.endswith("?"):
+        return True
+    return bool(FOLLOW_UP_START.match(text) or REFERENCE_PATTERN.search(text))
+
+
 class Reflection():
-    def __init__(self, llm):
-        self.llm = llm
+    """Viết lại câu hỏi mới nhất thành câu độc lập, dựa vào lịch sử chat.
+
+    Lịch sử được render một lần khi message được thêm (buffer nối tiếp, không
+    ghép lại mỗi lượt). Câu hỏi đã tự đủ nghĩa thì trả nguyên, không gọi LLM;
+    kết quả được nhớ theo (đoạn cuối lịch sử, câu hỏi).
+    """
+
+    def __init__(self, llm=None, memo_size=REFLECTION_MEMO_SIZE):
+        self.llm = llm or gateway
+        self.memo_size = memo_size
+        self._text = ""
+        self._offsets = []
+        self._memo = OrderedDict()
 
     def _concat_and_format_texts(self, data):
         concatenated_texts = []
@@ -17,27 +60,74 @@ class Reflection():
             concatenated_texts.append(f"{role}: {message} \n")
         return ''.join(concatenated_texts)
 
-    
-    def __call__(self, chat_history, last_items_considered=100):
-        
-        if len(chat_history) >= last_items_considered:
-            chat_history = chat_history[len(chat_history) - last_items_considered:]
+    def _sync(self, chat_history):
+        # Chỉ render các message mới; lịch sử bị thay (khôi phục phiên) thì render lại từ đầu
+        if len(chat_history) < len(self._offsets):
+            self._text, self._offsets = "", []
+        new = chat_history[len(self._offsets):]
+        for entry in new:
+            self._offsets.append(len(self._text))
+            self._text += f"{entry.sender}: {entry.message} \n"
 
-        history_string = self._concat_and_format_texts(chat_history)
+    def _tail(self, count: int) -> str:
+        if not self._offsets:
+            return ""
+        return self._text[self._offsets[max(len(self._offsets) - count, 0)]:]
 
-        higher_level_summaries_prompt = """Given a chat history and the latest user question which might reference context in the chat history, formulate a standalone question in Vietnamese which can be understood without the chat history. Do NOT answer the question, just reformulate it if needed and otherwise return it as is. {history_string}
-        """.format(history_string=history_string)
+    async def __call__(self, chat_history, last_items_considered=100, question=None):
+        stats["calls"] += 1
+        self._sync(chat_history)
+        if question is None:
+            question = chat_history[-1].message if len(chat_history) else ""
+
+        if len(self._offsets) < 2 or not needs_reformulation(question):
+            stats["skipped"] += 1
+            return question
+
+        key = (hash(self._tail(REFLECTION_TAIL)), question)
+        if key in self._memo:
+            stats["memo_hits"] += 1
+            self._memo.move_to_end(key)
+            return self._memo[key]
 
-        print(higher_level_summaries_prompt)
+        history_string = self._tail(last_items_considered)
 
-        completion = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
+        higher_level_summaries_prompt = """Given a chat history and the latest user question which might reference context in the chat history, formulate a standalone question in Vietnamese which can be understood without the chat history. Do NOT answer the question, just reformulate it if needed and otherwise return it as is. {history_string}
+Latest user question: {question}
+        """.format(history_string=history_string, question=question)
+
+        stats["llm_calls"] += 1
+        standalone = (await self.llm.complete(
+            "gpt-4o-mini",
+            [
                 {
                     "role": "user",
                     "content": higher_level_summaries_prompt
                 }
             ]
+        )).strip() or question
+
+        self._memo[key] = standalone
+        if len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+        return standalone
+
+    async def summarize(self, chat_history, previous_summary=""):
+        # Gộp các lượt chat cũ vào bản tóm tắt cuốn chiếu, giữ lại mọi thông tin bệnh nhân đã cung cấp
+        history_string = self._concat_and_format_texts(chat_history)
+
+        summary_prompt = """Below is a running summary of an earlier part of a hospital registration chat, followed by newer messages. Update the summary in Vietnamese so it stays short but keeps every fact the patient has given, every question that is still unanswered and the current topic. Return only the updated summary.
+Summary so far: {previous_summary}
+New messages:
+{history_string}
+        """.format(previous_summary=previous_summary or "(none)", history_string=history_string)
+
+        return await self.llm.complete(
+            "gpt-4o-mini",
+            [
+                {
+                    "role": "user",
+                    "content": summary_prompt
+                }
+            ]
         )
-    
-        return completion.choices[0].message.content
@@ -0,0 +1,134 @@
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+SEARCH_CACHE_ENTRIES = int(os.getenv("SEARCH_CACHE_ENTRIES", "512"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "21600"))
+# Cosine tối thiểu giữa hai câu triệu chứng để coi là trùng nghĩa (kèm điều kiện cùng tập từ)
+SEARCH_CACHE_SIMILARITY = float(os.getenv("SEARCH_CACHE_SIMILARITY", "0.97"))
+VERSION_CHECK_INTERVAL = float(os.getenv("SEARCH_CACHE_VERSION_CHECK_INTERVAL", "30"))
+
+
+def normalize_symptoms(symptoms: str) -> str:
+    # "Sốt, đau đầu" và "đau đầu và sốt" cho cùng một khóa; không tách theo dấu chấm vì làm hỏng "37.5 độ"
+    text = unicodedata.normalize("NFC", symptoms.lower())
+    parts = re.split(r"[,;\n]|\s+và\s+|\s+with\s+", text)
+    items = sorted({" ".join(part.split()) for part in parts if part.strip()})
+    return ", ".join(items)
+
+
+def symptom_tokens(key: str) -> frozenset:
+    # Số thập phân (37.5) là một từ, dấu câu bị bỏ
+    return frozenset(re.findall(r"\d+(?:\.\d+)?|\w+", key))
+
+
+class SearchResultCache():
+    """Cache kết quả gợi ý xét nghiệm theo triệu chứng đã chuẩn hóa.
+
+    Trùng khóa thì trả thẳng; nếu không, so embedding của câu hỏi với các
+    entry có cùng tập từ (chỉ khác thứ tự, cách ngắt câu) và dùng entry gần
+    nhất khi cosine vượt ngưỡng. Chỉ dựa vào cosine thì "đau ngực, không sốt"
+    và "đau ngực, sốt" có thể bị coi là một, trả sai gợi ý xét nghiệm. Entry hết hạn
+    theo TTL, bị loại theo LRU, và toàn bộ cache bị xóa khi phiên bản danh mục
+    thay đổi (sau mỗi lần nạp lại catalog).
+    """
+
+    def __init__(self, max_entries=SEARCH_CACHE_ENTRIES, ttl=SEARCH_CACHE_TTL,
+                 similarity=SEARCH_CACHE_SIMILARITY, version_check_interval=VERSION_CHECK_INTERVAL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.version_check_interval = version_check_interval
+        self.version = None
+        self._version_checked = False
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "invalidations": 0}
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._keys = []
+        self._last_version_check = 0
+        self._lock = threading.Lock()
+
+    def _expired(self, entry, now) -> bool:
+        return entry["expires"] < now
+
+    def get(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry, now):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.stats["exact_hits"] += 1
+            return entry["result"]
+
+    def get_similar(self, key: str, embedding):
+        now = time.monotonic()
+        tokens = symptom_tokens(key)
+        with self._lock:
+            if not self._entries:
+                self.stats["misses"] += 1
+                return None
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.stack([self._entries[key]["embedding"] for key in self._keys])
+            query = np.asarray(embedding, dtype=np.float32)
+            query = query / (np.linalg.norm(query) or 1)
+            scores = self._matrix @ query
+            for index in np.argsort(scores)[::-1]:
+                if scores[index] < self.similarity:
+                    break
+                candidate = self._keys[index]
+                entry = self._entries.get(candidate)
+                if entry is None or self._expired(entry, now) or entry["tokens"] != tokens:
+                    continue
+                self._entries.move_to_end(candidate)
+                self.stats["semantic_hits"] += 1
+                return entry["result"]
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key: str, embedding, result):
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1)
+        with self._lock:
+            self._entries[key] = {
+                "embedding": vector, "tokens": symptom_tokens(key), "result": result,
+                "expires": time.monotonic() + self.ttl,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def _remove(self, key: str):
+        self._entries.pop(key, None)
+        self._matrix = None
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self.stats["invalidations"] += 1
+
+    def version_due(self) -> bool:
+        return time.monotonic() - self._last_version_check >= self.version_check_interval
+
+    def check_version(self, version):
+        # Phiên bản danh mục đổi nghĩa là catalog vừa được nạp lại: kết quả cũ không còn đúng
+        self._last_version_check = time.monotonic()
+        changed = self._version_checked and version != self.version
+        if changed:
+            self.invalidate()
+        self.version = version
+        self._version_checked = True
+        return changed
+
+
+search_cache = SearchResultCache()
@@ -0,0 +1,149 @@
+import json
+from pydantic import BaseModel
+from form_schema import form_schema, FormState
+from context import ContextBuilder
+from inbox import Inbox
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class Message(BaseModel):
+    message: str
+    sender: str
+
+
+class ChatLog():
+    """Lịch sử chat của một phiên, mỗi message được serialize đúng một lần khi append.
+
+    Dùng như một list `Message` (len, index, slice, duyệt) cho ContextBuilder
+    và Reflection; các frame gửi đi được ghép từ các mảnh JSON đã cache nên
+    chi phí mỗi lượt không còn là dict() + dumps của cả lịch sử.
+    """
+
+    __slots__ = ("_messages", "_records", "_fragments")
+
+    def __init__(self, messages=()):
+        self._messages = []
+        self._records = []
+        self._fragments = []
+        for message in messages:
+            self.append(message)
+
+    def append(self, message: Message) -> dict:
+        # Trả về dict của message để ghi Mongo mà không phải gọi .dict() lần nữa
+        record = message.dict()
+        self._messages.append(message)
+        self._records.append(record)
+        self._fragments.append(dumps(record))
+        return record
+
+    def records(self, start: int = 0) -> list:
+        return self._records[start:]
+
+    def json(self, start: int = 0) -> bytes:
+        # Mảng JSON các message từ vị trí start, ghép từ mảnh đã cache
+        return b"[" + b",".join(self._fragments[start:]) + b"]"
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __getitem__(self, index):
+        return self._messages[index]
+
+    def __iter__(self):
+        return iter(self._messages)
+
+
+def frame(fields: dict, **raw) -> str:
+    # Ghép object JSON từ các trường thường và các trường đã là JSON bytes (vd. ChatLog.json())
+    body = dumps(fields)
+    if raw:
+        parts = [body[:-1]]
+        for index, (key, value) in enumerate(raw.items()):
+            separator = b"," if fields or index else b""
+            parts.append(separator + dumps(key) + b":" + value)
+        parts.append(b"}")
+        body = b"".join(parts)
+    return body.decode("utf-8")
+
+
+class Session():
+    """Trạng thái một kết nối /api/chat, tách khỏi object WebSocket.
+
+    Registry, bus và protocol gửi frame qua session như qua websocket
+    (send_text/send_bytes), nên session đứng thay websocket ở mọi nơi.
+    """
+
+    __slots__ = (
+        "websocket", "connection_id", "registered_user_id", "user_id", "session_id",
+        "formData", "form_state", "chat_history", "context", "last_asked_field",
+        "last_asked_category", "ask_count", "last_message", "stream", "channel",
+        "inbox", "llm_call", "version", "resume_hash"
+    )
+
+    # Các trường được giữ lại khi socket ngắt để khôi phục phiên (SessionStore)
+    STATE = (
+        "user_id", "session_id", "formData", "form_state", "chat_history", "context",
+        "last_asked_field", "last_asked_category", "ask_count", "stream", "channel",
+        "version", "resume_hash"
+    )
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.connection_id = None
+        self.registered_user_id = None
+        self.user_id = None
+        self.session_id = None
+        self.formData = form_schema.empty_form()
+        self.form_state = FormState(form_schema)
+        self.chat_history = ChatLog()
+        self.context = ContextBuilder()
+        self.last_asked_field = None
+        self.last_asked_category = None
+        self.ask_count = 0
+        self.last_message = None
+        self.stream = False
+        self.channel = None
+        self.inbox = Inbox()
+        self.llm_call = None
+        # Số lần ảnh chụp đã được ghi, tăng dần qua mọi worker; dùng để nhận ra bản trong bộ nhớ đã cũ
+        self.version = 0
+        # Hash của resume token cấp lúc init, chỉ ai giữ token mới khôi phục được phiên
+        self.resume_hash = None
+
+    @property
+    def client(self):
+        return self.websocket.client
+
+    @property
+    def headers(self):
+        return self.websocket.headers
+
+    def add_message(self, text: str, sender: str) -> dict:
+        return self.chat_history.append(Message(message=text, sender=sender))
+
+    def state(self) -> dict:
+        return {name: getattr(self, name) for name in self.STATE}
+
+    def restore(self, state: dict):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def history_frame(self, **fields) -> str:
+        # {"user_id": ..., "chat_history": [...], ...} của protocol cũ, không serialize lại lịch sử
+        return frame({"user_id": self.user_id, **fields}, chat_history=self.chat_history.json())
+
+    async def send_text(self, text: str):
+        await self.websocket.send_text(text)
+
+    async def send_bytes(self, data: bytes):
+        await self.websocket.send_bytes(data)
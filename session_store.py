@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from collections import OrderedDict
+from form_schema import form_schema, FormState
+from session import ChatLog, Message
+from context import ContextBuilder
+from metrics import metrics
+
+# Số phiên đã ngắt giữ nguyên trong bộ nhớ (LRU); phiên bị đẩy ra vẫn khôi phục được từ Mongo
+SESSION_CACHE_ENTRIES = int(os.getenv("SESSION_CACHE_ENTRIES", "2000"))
+# Phiên ngắt quá lâu trong bộ nhớ coi như hết hạn, lần sau đọc lại từ Mongo
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "1800"))
+
+
+def snapshot(session) -> dict:
+    # Phần trạng thái cần để dựng lại phiên; lịch sử chat đã được ghi riêng bằng $push
+    return {
+        "form": session.formData,
+        "last_asked_field": session.last_asked_field,
+        "last_asked_category": session.last_asked_category,
+        "ask_count": session.ask_count,
+        "summary": session.context.summary,
+        "summarized_upto": session.context.summarized_upto,
+        "version": session.version,
+        "resume_hash": session.resume_hash,
+        "updated_at": time.time(),
+    }
+
+
+def resume_hash(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def issue_resume_token(session) -> str:
+    # Cấp một lần lúc init phiên mới; server chỉ giữ hash, client phải gửi lại token khi nối lại
+    token = secrets.token_urlsafe(24)
+    session.resume_hash = resume_hash(token)
+    return token
+
+
+def _token_matches(expected, token) -> bool:
+    if not expected or not token:
+        return False
+    return hmac.compare_digest(expected, resume_hash(str(token)))
+
+
+class SessionStore():
+    """Kho phiên hai tầng: LRU trong bộ nhớ trước Mongo.
+
+    Khi socket ngắt, các object sống của phiên (form, ChatLog, FormState,
+    ContextBuilder, channel) được giữ nguyên trong LRU nên lần `init` kèm
+    user_id và resume token kế tiếp khôi phục gần như tức thì. Sau mỗi lượt,
+    một ảnh chụp nhỏ (form, con trỏ hội thoại, tóm tắt, version) được ghi kiểu
+    write-behind vào document lịch sử chat; khi không có trong bộ nhớ (đã bị
+    đẩy ra, khởi động lại) hoặc bản trong bộ nhớ cũ hơn bản trên Mongo (phiên
+    đã chạy tiếp ở worker khác) thì phiên được dựng lại từ document đó.
+    """
+
+    def __init__(self, collection, writer, max_entries=SESSION_CACHE_ENTRIES, ttl=SESSION_CACHE_TTL):
+        self.collection = collection
+        self.writer = writer
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = {"memory_hits": 0, "mongo_hits": 0, "misses": 0, "stale": 0, "rejected": 0}
+        self._sessions = OrderedDict()
+
+    def save(self, session):
+        if session.user_id is not None:
+            session.version += 1
+            self.writer.snapshot(session.user_id, snapshot(session))
+
+    def park(self, session):
+        # Gọi khi socket ngắt: giữ object sống trong bộ nhớ và ghi ảnh chụp cuối cùng
+        if session.user_id is None:
+            return
+        self.save(session)
+        self._sessions.pop(session.user_id, None)
+        self._sessions[session.user_id] = (time.monotonic() + self.ttl, session.state())
+        while len(self._sessions) > self.max_entries:
+            self._sessions.popitem(last=False)
+
+    def _take_memory(self, user_id: str, token):
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return None
+        expires, state = entry
+        if not _token_matches(state["resume_hash"], token):
+            # Không bỏ entry: người gửi sai token không được đẩy phiên thật ra khỏi bộ nhớ
+            return None
+        del self._sessions[user_id]
+        return state if expires >= time.monotonic() else None
+
+    async def _stored_version(self, user_id: str) -> int:
+        with metrics.span("mongo_read"):
+            doc = await asyncio.to_thread(
+                self.collection.find_one, {"user_id": user_id}, {"session.version": 1}
+            )
+        return ((doc or {}).get("session") or {}).get("version", 0)
+
+    async def load(self, user_id: str, token=None):
+        # Trạng thái để Session.restore(), hoặc None nếu user_id chưa từng có phiên
+        # hoặc token không khớp (khi đó người gọi tạo phiên mới)
+        state = self._take_memory(user_id, token)
+        if state is not None:
+            # Phiên có thể đã được khôi phục và chạy tiếp ở worker khác: chỉ dùng bản trong
+            # bộ nhớ khi không cũ hơn ảnh chụp trên Mongo, nếu không lượt save() sau sẽ ghi đè bản mới
+            if await self._stored_version(user_id) <= state["version"]:
+                self.stats["memory_hits"] += 1
+                return state
+            self.stats["stale"] += 1
+        # flush() có timeout: Mongo chậm/lỗi thì đọc bản đang có, không chặn lượt nối lại
+        await self.writer.flush()
+        with metrics.span("mongo_read"):
+            doc = await asyncio.to_thread(self.collection.find_one, {"user_id": user_id})
+        if not doc:
+            self.stats["misses"] += 1
+            return None
+        if not _token_matches((doc.get("session") or {}).get("resume_hash"), token):
+            self.stats["rejected"] += 1
+            return None
+        self.stats["mongo_hits"] += 1
+        return self._from_document(user_id, doc)
+
+    def _from_document(self, user_id: str, doc: dict) -> dict:
+        saved = doc.get("session") or {}
+        form_data = form_schema.empty_form()
+        for category, values in (saved.get("form") or {}).items():
+            if isinstance(values, dict):
+                form_data.setdefault(category, {}).update(values)
+        context = ContextBuilder()
+        context.restore_summary(saved.get("summary", ""), saved.get("summarized_upto", 0))
+        return {
+            "user_id": user_id,
+            "formData": form_data,
+            "form_state": FormState(form_schema, form_data),
+            "chat_history": ChatLog(Message(**message) for message in doc.get("chat_history", [])),
+            "last_asked_field": saved.get("last_asked_field"),
+            "last_asked_category": saved.get("last_asked_category"),
+            "ask_count": saved.get("ask_count", 0),
+            "context": context,
+            "session_id": None,
+            "channel": None,
+            "version": saved.get("version", 0),
+            "resume_hash": saved.get("resume_hash"),
+        }
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import uuid
+import protocol
+
+# Thời gian tối đa chờ gửi một frame tới một socket khi fan-out
+SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+
+
+class SessionRegistry():
+    """Danh bạ các kết nối WebSocket đang mở, đánh chỉ mục theo user_id và theo kết nối.
+
+    Đăng ký, tra cứu và hủy đăng ký đều O(1); một user có thể có nhiều socket
+    cùng lúc (nhiều tab, nhiều kiosk).
+    """
+
+    def __init__(self, send_timeout=SEND_TIMEOUT):
+        self.send_timeout = send_timeout
+        self._by_connection = {}
+        self._by_user = {}
+
+    def register(self, websocket, user_id: str = None) -> str:
+        websocket.connection_id = uuid.uuid4().hex
+        self._by_connection[websocket.connection_id] = websocket
+        if user_id:
+            self.bind(websocket, user_id)
+        return websocket.connection_id
+
+    def bind(self, websocket, user_id: str):
+        # Gắn (hoặc chuyển) socket sang user_id mới
+        previous = getattr(websocket, "registered_user_id", None)
+        if previous == user_id:
+            return
+        if previous is not None:
+            self._discard(previous, websocket.connection_id)
+        self._by_user.setdefault(user_id, {})[websocket.connection_id] = websocket
+        websocket.registered_user_id = user_id
+
+    def unregister(self, websocket):
+        connection_id = getattr(websocket, "connection_id", None)
+        if self._by_connection.pop(connection_id, None) is None:
+            return
+        user_id = getattr(websocket, "registered_user_id", None)
+        if user_id is not None:
+            self._discard(user_id, connection_id)
+            websocket.registered_user_id = None
+
+    def _discard(self, user_id: str, connection_id: str):
+        sockets = self._by_user.get(user_id)
+        if sockets is None:
+            return
+        sockets.pop(connection_id, None)
+        if not sockets:
+            del self._by_user[user_id]
+
+    def get(self, connection_id: str):
+        return self._by_connection.get(connection_id)
+
+    def sockets(self, user_id: str) -> list:
+        return list(self._by_user.get(user_id, {}).values())
+
+    def users(self):
+        return self._by_user.keys()
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._by_user
+
+    def __len__(self) -> int:
+        return len(self._by_connection)
+
+    def __iter__(self):
+        return iter(list(self._by_connection.values()))
+
+    async def _send(self, websocket, text: str) -> bool:
+        try:
+            await asyncio.wait_for(protocol.send(websocket, text), self.send_timeout)
+            return True
+        except Exception as e:
+            print(f"Không gửi được tới {getattr(websocket, 'client', None)}: {e!r}")
+            return False
+
+    async def send_many(self, frames) -> int:
+        # frames: danh sách (websocket, text); gửi song song, socket chậm bị bỏ qua sau timeout
+        frames = list(frames)
+        if not frames:
+            return 0
+        results = await asyncio.gather(*(self._send(websocket, text) for websocket, text in frames))
+        return sum(results)
+
+    async def broadcast(self, text: str, sockets=None) -> int:
+        sockets = list(self) if sockets is None else sockets
+        return await self.send_many((websocket, text) for websocket in sockets)
@@ -0,0 +1,203 @@
+import json
+import os
+import re
+from form_schema import form_schema
+from llm import gateway
+
+# Một lần sửa output hỏng duy nhất, giới hạn thời gian và độ dài để không nhân đôi độ trễ của lượt
+REPAIR_TIMEOUT = float(os.getenv("REPAIR_TIMEOUT", "8"))
+REPAIR_MAX_TOKENS = int(os.getenv("REPAIR_MAX_TOKENS", "600"))
+
+FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL | re.IGNORECASE)
+
+stats = {"turns": 0, "parsed": 0, "recovered": 0, "repaired": 0, "prose": 0, "parse_failures": 0, "wasted_calls": 0, "failed": 0}
+
+
+def turn_schema(schema=form_schema) -> dict:
+    # Chỉ liệt kê các trường có thông tin mới dưới dạng danh sách cập nhật: schema strict vẫn
+    # ràng buộc category/key, nhưng model không phải viết ra mọi trường của form (phần lớn null) ở mỗi lượt
+    keys = list(dict.fromkeys(field.key for field in schema.fields))
+    # reply đứng trước updates: output strict sinh theo thứ tự khai báo, nên chữ của reply được
+    # stream ngay (ReplyStreamParser) thay vì chờ model viết xong danh sách cập nhật
+    return {
+        "type": "object",
+        "properties": {
+            "reply": {"type": "string"},
+            "updates": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "category": {"type": "string", "enum": list(schema.categories)},
+                        "key": {"type": "string", "enum": keys},
+                        "value": {"type": "string"},
+                    },
+                    "required": ["category", "key", "value"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["reply", "updates"],
+        "additionalProperties": False,
+    }
+
+
+def response_format(schema: dict = None, name: str = "form_turn") -> dict:
+    if schema is None:
+        return {"type": "json_object"}
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+TURN_SCHEMA = turn_schema()
+TURN_FORMAT = response_format(TURN_SCHEMA)
+
+
+def _has_value(value) -> bool:
+    return value is not None and not (isinstance(value, str) and not value.strip())
+
+
+def clean_form(form, schema=form_schema) -> dict:
+    # Bỏ các trường null hoặc chuỗi rỗng (model không có thông tin) để không ghi đè giá trị đã điền
+    # và để form không có gì mới vẫn được coi là rỗng (đếm ask_count); cặp category/key không có
+    # trong form (enum của TURN_SCHEMA không ràng buộc cặp) cũng bị bỏ
+    if not isinstance(form, dict):
+        return {}
+    cleaned = {}
+    for category, values in form.items():
+        if isinstance(values, dict):
+            values = {
+                key: value for key, value in values.items()
+                if _has_value(value) and schema.field(category, key) is not None
+            }
+            if values:
+                cleaned[category] = values
+        elif _has_value(values):
+            # Form phẳng (chatbot.py): giữ nguyên trường có giá trị
+            cleaned[category] = values
+    return cleaned
+
+
+def updates_to_form(updates) -> dict:
+    # [{"category", "key", "value"}] -> form hai tầng, clean_form kiểm tra lại từng cặp
+    form = {}
+    for update in updates if isinstance(updates, list) else ():
+        if isinstance(update, dict) and isinstance(update.get("category"), str) and isinstance(update.get("key"), str):
+            form.setdefault(update["category"], {})[update["key"]] = update.get("value")
+    return form
+
+
+def _close_partial(text: str):
+    # JSON bị cắt giữa chừng: đóng chuỗi và các ngoặc còn mở
+    stack = []
+    in_string = False
+    escape = False
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if escape:
+        text = text[:-1]
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(",")
+    if text.endswith(":"):
+        text += "null"
+    try:
+        return json.loads(text + "".join(reversed(stack)))
+    except json.JSONDecodeError:
+        return None
+
+
+def recover_json(text: str):
+    """Lấy object JSON từ output của model: bọc trong ```json, lẫn văn bản, hoặc bị cắt cụt."""
+    text = (text or "").strip()
+    fenced = FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    if start < 0:
+        return None
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text, start)
+        return value
+    except json.JSONDecodeError:
+        return _close_partial(text[start:])
+
+
+def normalize_turn(value):
+    # Nhận cả output theo TURN_SCHEMA ("updates") lẫn dạng {"form": {...}} của các prompt tự do
+    if not isinstance(value, dict) or not isinstance(value.get("reply"), str):
+        return None
+    form = updates_to_form(value["updates"]) if "updates" in value else value.get("form")
+    return {"reply": value["reply"], "form": clean_form(form)}
+
+
+async def repair(text: str, schema: dict = None, llm=None):
+    shape = "'form' và 'reply'" if schema is None else "'reply' và 'updates' (mỗi phần tử gồm category, key, value)"
+    output = await (llm or gateway).complete(
+        "gpt-4o-mini",
+        [
+            {"role": "system", "content": (
+                f"Chuyển nội dung dưới đây thành đúng một object JSON hợp lệ có {shape}. "
+                "Giữ nguyên thông tin và câu trả lời, không thêm nội dung mới."
+            )},
+            {"role": "user", "content": text}
+        ],
+        timeout=REPAIR_TIMEOUT,
+        max_tokens=REPAIR_MAX_TOKENS,
+        response_format=response_format(schema)
+    )
+    return normalize_turn(recover_json(output))
+
+
+async def parse_turn(text: str, schema: dict = TURN_SCHEMA, llm=None) -> dict:
+    """Đọc {"form", "reply"} từ output của model (TURN_SCHEMA hoặc dạng form tự do), không để một output lệch định dạng làm hỏng lượt.
+
+    Thứ tự: json.loads trực tiếp, rồi khôi phục (code fence, văn bản bao quanh,
+    JSON cụt), rồi tối đa một lời gọi sửa. Output chỉ là văn bản thường được
+    dùng làm reply với form rỗng. Raise ValueError khi mọi cách đều thất bại.
+    """
+    stats["turns"] += 1
+    try:
+        result = normalize_turn(json.loads(text))
+    except (json.JSONDecodeError, TypeError):
+        result = None
+    if result is not None:
+        stats["parsed"] += 1
+        return result
+
+    result = normalize_turn(recover_json(text))
+    if result is not None:
+        stats["recovered"] += 1
+        return result
+
+    stats["parse_failures"] += 1
+    if text and "{" not in text:
+        # Model trả lời bằng văn bản thường: vẫn dùng được làm câu trả lời
+        stats["prose"] += 1
+        return {"form": {}, "reply": text.strip()}
+
+    # Output của lời gọi đầu không dùng được
+    stats["wasted_calls"] += 1
+    try:
+        result = await repair(text, schema, llm)
+    except Exception as e:
+        print(f"Error: không sửa được output của model: {e}")
+        result = None
+    if result is not None:
+        stats["repaired"] += 1
+        return result
+
+    stats["wasted_calls"] += 1
+    stats["failed"] += 1
+    raise ValueError(f"Output của model không phải JSON hợp lệ: {text[:200]!r}")
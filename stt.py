@@ -1,31 +1,139 @@
-import openai
+import asyncio
+import io
 import os
+import time
+from collections import deque
 import dotenv
-import assemblyai as aai
+from llm import gateway
+from providers import providers
+from metrics import metrics
 # Load environment variables from .env file
 dotenv.load_dotenv()
 
 
-aai.settings.api_key = os.getenv("ASSEMBLY_API_KEY")
-transcribe = aai.Transcriber()
-def transcribe_audio_assemblyai(audio_path):
-    try:
-        transcript = transcribe.transcribe(audio_path)
-        return transcript.text # Lấy nội dung văn bản
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
-
-def transcribe_audio(audio_path):
-    try:
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        with open(audio_path, "rb") as audio_file:
-            response = openai.audio.transcriptions.create(model="whisper-1", file=audio_file, response_format="text")
-        
-        return response # Lấy nội dung văn bản
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
-
-print(transcribe_audio_assemblyai("/home/nguyen-hoang/vitalink/vitalink/static/speech.mp3"))
-# print(transcribe_audio("/home/nguyen-hoang/vitalink/vitalink/static/speech.mp3"))
+# Router STT: gọi backend chính, quá ngưỡng độ trễ thì gửi thêm (hedge) sang backend phụ
+STT_PRIMARY = os.getenv("STT_PRIMARY", "whisper")
+STT_TIMEOUT = float(os.getenv("STT_TIMEOUT", "20"))
+# Hedge khi backend chính chậm hơn percentile này của chính nó: chỉ ~5% lượt tốn thêm một lời gọi
+STT_HEDGE_PERCENTILE = float(os.getenv("STT_HEDGE_PERCENTILE", "95"))
+STT_HEDGE_DELAY = float(os.getenv("STT_HEDGE_DELAY", "3"))  # Dùng khi chưa đủ mẫu
+STT_HEDGE_MIN = float(os.getenv("STT_HEDGE_MIN", "0.5"))
+STT_HEDGE_MAX = float(os.getenv("STT_HEDGE_MAX", "8"))
+STT_LATENCY_WINDOW = int(os.getenv("STT_LATENCY_WINDOW", "200"))
+STT_MIN_SAMPLES = int(os.getenv("STT_MIN_SAMPLES", "20"))
+
+
+async def whisper_backend(audio: bytes, filename: str) -> str:
+    response = await gateway.client.audio.transcriptions.create(
+        model="whisper-1", file=(filename, audio), response_format="text"
+    )
+    return response.strip() if isinstance(response, str) else response.text
+
+
+async def assemblyai_backend(audio: bytes, filename: str) -> str:
+    # SDK AssemblyAI là đồng bộ (upload + poll) nên chạy trong thread;
+    # khi thua cuộc đua, thread vẫn chạy nốt nhưng kết quả bị bỏ
+    transcript = await asyncio.to_thread(providers.get("assemblyai").transcribe, io.BytesIO(audio))
+    if transcript.error:
+        raise RuntimeError(transcript.error)
+    return transcript.text
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class STTRouter():
+    """Chuyển giọng nói thành văn bản với hedged request giữa hai backend.
+
+    Backend chính được gọi trước; nếu chưa xong sau khoảng hedge (percentile độ
+    trễ gần đây của chính nó) hoặc lỗi sớm, backend phụ được gọi song song. Kết
+    quả về trước được dùng, lời gọi còn lại bị hủy. Cả lượt có một deadline chung.
+    """
+
+    def __init__(self, backends: dict, primary=STT_PRIMARY, timeout=STT_TIMEOUT,
+                 hedge_percentile=STT_HEDGE_PERCENTILE, window=STT_LATENCY_WINDOW):
+        self.backends = backends
+        self.primary = primary
+        self.secondary = next((name for name in backends if name != primary), None)
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.latencies = {name: deque(maxlen=window) for name in backends}
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "timeouts": 0, "failures": 0, "errors": 0}
+
+    def hedge_delay(self) -> float:
+        samples = self.latencies[self.primary]
+        if len(samples) < STT_MIN_SAMPLES:
+            return STT_HEDGE_DELAY
+        return min(STT_HEDGE_MAX, max(STT_HEDGE_MIN, percentile(samples, self.hedge_percentile)))
+
+    async def _call(self, name: str, audio: bytes, filename: str):
+        started = time.perf_counter()
+        try:
+            with metrics.span("stt", backend=name):
+                text = await self.backends[name](audio, filename)
+        except asyncio.CancelledError:
+            # Backend chính bị hủy vì chậm hơn backend phụ: thời gian đã chạy là cận dưới của độ trễ
+            # thật, vẫn phải ghi lại, nếu không p95 chỉ còn các lời gọi nhanh và ngưỡng hedge cứ tụt dần
+            if name == self.primary:
+                self.latencies[name].append(time.perf_counter() - started)
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Error: STT {name}: {e}")
+            return None
+        self.latencies[name].append(time.perf_counter() - started)
+        return text or None
+
+    async def transcribe(self, audio: bytes, filename: str = "audio.webm", timeout: float = None):
+        self.stats["requests"] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self.timeout if timeout is None else timeout)
+        hedge_at = loop.time() + self.hedge_delay()
+        names = {}
+        primary = asyncio.ensure_future(self._call(self.primary, audio, filename))
+        names[primary] = self.primary
+        pending = {primary}
+        try:
+            while True:
+                hedge_pending = self.secondary is not None and len(names) == 1
+                if not pending and not hedge_pending:
+                    self.stats["failures"] += 1
+                    return None
+                now = loop.time()
+                if now >= deadline:
+                    self.stats["timeouts"] += 1
+                    print(f"Error: STT quá hạn {self.timeout if timeout is None else timeout} giây")
+                    return None
+                # Backend chính quá ngưỡng hoặc đã lỗi: gọi thêm backend phụ
+                if hedge_pending and (now >= hedge_at or not pending):
+                    self.stats["hedged"] += 1
+                    secondary = asyncio.ensure_future(self._call(self.secondary, audio, filename))
+                    names[secondary] = self.secondary
+                    pending.add(secondary)
+                    continue
+                wake = deadline if not hedge_pending else min(deadline, hedge_at)
+                done, pending = await asyncio.wait(pending, timeout=wake - now, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    text = task.result()
+                    if text:
+                        if names[task] != self.primary:
+                            self.stats["hedge_wins"] += 1
+                        return text
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def snapshot(self) -> dict:
+        latency = {
+            name: {f"p{q}": round(percentile(samples, q) * 1000) for q in (50, 95, 99)}
+            for name, samples in self.latencies.items()
+        }
+        return {**self.stats, "hedge_delay_ms": round(self.hedge_delay() * 1000), "latency_ms": latency}
+
+
+stt_router = STTRouter({"whisper": whisper_backend, "assemblyai": assemblyai_backend})
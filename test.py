@@ -1,33 +1,49 @@
-from google import genai
-import pandas as pd
-import json
-import numpy as np
-from pymongo import MongoClient
-from sklearn.metrics.pairwise import cosine_similarity as cosine
-import time
-from google.api_core import exceptions
-import openai
-from google.genai import types
 import os
+import time
+import asyncio
+from llm import gateway
+import vector_index
+from embedding_cache import embedding_cache
+from search_cache import search_cache, normalize_symptoms
+from providers import providers
+from metrics import metrics
 import dotenv
 dotenv.load_dotenv()
 
-db_client = MongoClient(os.getenv("MONGODB_URI"))
-client = genai.Client(api_key= os.getenv("GOOGLE_API_KEY"))
-openai.api_key = os.getenv("OPENAI_API_KEY")
-db = db_client['Vitalink']
-collection = db['test']
+# Client Mongo và Gemini được tạo ở lần dùng đầu (xem providers.py), import module này không gọi mạng
+collection = providers.collection("test")
+catalog_meta = providers.collection("catalog_meta")
+
+# "atlas" dùng $vectorSearch của MongoDB Atlas, "local" dùng index NumPy trong bộ nhớ
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "atlas")
+SCORE_THRESHOLD = 0.84
+
+
+EMBEDDING_MODEL = "gemini-embedding-exp-03-07"
+EMBEDDING_TASK_TYPE = "SEMANTIC_SIMILARITY"
 
 
 def get_embedding(text, retries=5):
+    # Câu đã embed trước đó được lấy từ cache, không tốn lời gọi Gemini hay quota
+    cached = embedding_cache.get(EMBEDDING_MODEL, EMBEDDING_TASK_TYPE, text)
+    if cached is not None:
+        return cached
+    from google.api_core import exceptions
+    from google.genai import types
+
+    client = providers.get("gemini")
     for attempt in range(retries):
         try:
-            result = client.models.embed_content(
-                model="gemini-embedding-exp-03-07",
-                contents=text,
-                config=types.EmbedContentConfig(task_type="SEMANTIC_SIMILARITY"))
-            return result.embeddings[0].values
+            with metrics.span("embedding"):
+                result = client.models.embed_content(
+                    model=EMBEDDING_MODEL,
+                    contents=text,
+                    config=types.EmbedContentConfig(task_type=EMBEDDING_TASK_TYPE))
+            embedding = result.embeddings[0].values
+            embedding_cache.put(EMBEDDING_MODEL, EMBEDDING_TASK_TYPE, text, embedding)
+            return embedding
         except exceptions.ResourceExhausted as e:
+            metrics.inc("embedding_retries")
             if attempt < retries - 1:
                 print(f"Quota vượt quá, thử lại sau {2 ** attempt} giây...")
                 time.sleep(2 ** attempt)  # Đợi 1s, 2s, 4s,...
@@ -35,8 +51,21 @@ def get_embedding(text, retries=5):
                 raise e
             
             
-def vector_search(query, collection):
-    query_embedding = get_embedding(query)
+def catalog_version():
+    # Ingest ghi lại phiên bản mỗi khi danh mục thay đổi; index cục bộ dùng phiên bản snapshot đang trỏ tới
+    if VECTOR_BACKEND == "local":
+        return vector_index.current_version()
+    doc = catalog_meta.find_one({"_id": "test"})
+    return doc.get("version") if doc else None
+
+
+def vector_search(query, collection, query_embedding=None):
+    if query_embedding is None:
+        query_embedding = get_embedding(query)
+
+    if VECTOR_BACKEND == "local":
+        with metrics.span("vector_search", backend="local"):
+            return vector_index.get_index(collection).search(query_embedding, limit=10, min_score=SCORE_THRESHOLD)
 
     vector_search_stage = {
         "$vectorSearch": {
@@ -58,10 +87,10 @@ def vector_search(query, collection):
     }
 
     pipeline = [vector_search_stage, project_stage]
-    results = collection.aggregate(pipeline)
-    return list(results)
+    with metrics.span("vector_search", backend="atlas"):
+        return list(collection.aggregate(pipeline))
 
-def evaluate_tests(query, test_list):
+async def evaluate_tests(query, test_list):
     test_list_str = "\n".join(
         [f"- {result['Test_Name']} (Symptoms: {result['Symptoms']}; Contraindications: {result['Contraindications']})" 
          for result in test_list]
@@ -81,20 +110,41 @@ def evaluate_tests(query, test_list):
     - Tên xét nghiệm 2
     ... """
     
-    response = openai.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "Bạn là một chatbot trợ giúp điền form đăng ký khám bệnh tại bệnh viện."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-    return response.choices[0].message.content
-
-def get_search_results(query):
-    get_information = vector_search(query, collection)
+    with metrics.span("evaluate_tests"):
+        return await gateway.complete(
+                "gpt-4",
+                [
+                    {"role": "system", "content": "Bạn là một chatbot trợ giúp điền form đăng ký khám bệnh tại bệnh viện."},
+                    {"role": "user", "content": prompt}
+                ]
+            )
+
+async def get_search_results(query):
+    if search_cache.version_due():
+        try:
+            version = await asyncio.to_thread(catalog_version)
+            if search_cache.check_version(version) and VECTOR_BACKEND == "local":
+                vector_index.set_index(None)
+        except Exception as e:
+            print(f"Error: không kiểm tra được phiên bản danh mục: {e}")
+
+    # Triệu chứng trùng (sau chuẩn hóa) hoặc gần nghĩa với một câu đã hỏi thì dùng lại kết quả, không gọi GPT-4
+    key = normalize_symptoms(query)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # Embedding Gemini và $vectorSearch là lời gọi đồng bộ, chạy trong thread để không chặn event loop
+    query_embedding = await asyncio.to_thread(get_embedding, query)
+    cached = search_cache.get_similar(key, query_embedding)
+    if cached is not None:
+        return cached
+
+    get_information = await asyncio.to_thread(vector_search, query, collection, query_embedding)
     
-    filtered_information = [result for result in get_information if result["score"] > 0.84]  # Ngưỡng score
-    filtered_tests = evaluate_tests(query, filtered_information)
+    filtered_information = [result for result in get_information if result["score"] > SCORE_THRESHOLD]  # Ngưỡng score
+    filtered_tests = await evaluate_tests(query, filtered_information)
+    search_cache.put(key, query_embedding, filtered_tests)
     return filtered_tests
 
 
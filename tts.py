@@ -1,24 +1,46 @@
-import openai
-import  os
+import asyncio
+import hashlib
+import os
 import dotenv
+from llm import gateway
+from blob_store import BlobStore
+from metrics import metrics
 dotenv.load_dotenv()
 
-def generate_text_to_speech(text):
+TTS_MODEL = os.getenv("TTS_MODEL", "tts-1")
+TTS_VOICE = os.getenv("TTS_VOICE", "alloy")  # Giọng đọc, có thể đổi thành "echo", "fable", "onyx", "nova", "shimmer"
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "30"))
+# Cache âm thanh theo (model, giọng, câu): giới hạn theo tổng dung lượng, xóa câu ít dùng nhất trước
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join("data", "tts_cache"))
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+TTS_CACHE_MAX_AGE = float(os.getenv("TTS_CACHE_MAX_AGE", str(90 * 86400)))
+
+tts_cache = BlobStore(TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES, max_age=TTS_CACHE_MAX_AGE)
+stats = {"hits": 0, "misses": 0}
+
+
+def speech_key(text: str, voice: str = TTS_VOICE, model: str = TTS_MODEL) -> str:
+    return hashlib.sha256(f"{model}\0{voice}\0{text.strip()}".encode("utf-8")).hexdigest()
+
+
+async def generate_text_to_speech(text, voice=TTS_VOICE, model=TTS_MODEL):
+    # Trả về nội dung mp3 trong bộ nhớ; việc lưu file do bên gọi quyết định (mỗi câu trả lời một file riêng)
+    key = speech_key(text, voice, model)
+    cached = await asyncio.to_thread(tts_cache.get, key)
+    if cached is not None:
+        stats["hits"] += 1
+        return cached
+    stats["misses"] += 1
     try:
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        
-        response = openai.audio.speech.create(
-            model="tts-1",
-            voice="alloy",  # Giọng đọc, có thể đổi thành "echo", "fable", "onyx", "nova", "shimmer"
-            input=text
-        )
-        output_path = os.path.join("static", "speech.mp3")
-        # Ghi file âm thanh
-        with open(output_path, "wb") as audio_file:
-            audio_file.write(response.content)
-        
-        print(f"🔊 File âm thanh đã lưu tại: {output_path}")
-        return output_path
+        with metrics.span("tts", model=model):
+            response = await asyncio.wait_for(
+                gateway.client.audio.speech.create(model=model, voice=voice, input=text),
+                TTS_TIMEOUT
+            )
+        audio = response.content
+        await asyncio.to_thread(tts_cache.put, audio, key)
+        print(f"🔊 Đã tạo {len(audio)} byte âm thanh")
+        return audio
     except Exception as e:
         print(f"❌ Error: {e}")
-        return None
\ No newline at end of file
+        return None
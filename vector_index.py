@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+import numpy as np
+
+# Thư mục snapshot: mỗi lần ghi là một thư mục phiên bản gồm ma trận embedding đã chuẩn hóa
+# (matrix.npy) và metadata từng dòng (records.json); file CURRENT trỏ tới phiên bản đang dùng
+INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", os.path.join("data", "test_index"))
+CURRENT_FILE = "CURRENT"
+RECORD_FIELDS = ("Test_Name", "Symptoms", "Contraindications")
+
+
+class VectorIndex():
+    """Index vector trong bộ nhớ cho danh mục xét nghiệm.
+
+    Embedding được chuẩn hóa một lần vào một ma trận float32 liên tục, nên
+    một truy vấn top-k chỉ là một phép nhân ma trận-vector. Điểm trả về theo
+    cùng thang với `vectorSearchScore` cosine của Atlas, (1 + cos) / 2, để
+    ngưỡng hiện tại vẫn dùng được.
+    """
+
+    def __init__(self, matrix: np.ndarray, records: list):
+        if len(matrix) != len(records):
+            raise ValueError("Số embedding và số bản ghi không khớp")
+        self.matrix = matrix
+        self.records = records
+
+    @staticmethod
+    def normalize(vectors) -> np.ndarray:
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    @classmethod
+    def from_documents(cls, documents):
+        records = []
+        vectors = []
+        for doc in documents:
+            if not doc.get("embeddings"):
+                continue
+            records.append({"_id": str(doc.get("_id")), **{field: doc.get(field) for field in RECORD_FIELDS}})
+            vectors.append(doc["embeddings"])
+        matrix = cls.normalize(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+        return cls(matrix, records)
+
+    @classmethod
+    def from_collection(cls, collection):
+        projection = {"embeddings": 1, **{field: 1 for field in RECORD_FIELDS}}
+        return cls.from_documents(collection.find({"embeddings": {"$exists": True}}, projection))
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH):
+        while True:
+            version = current_version(path)
+            if version is None:
+                raise FileNotFoundError(f"Không tìm thấy snapshot index tại {path}")
+            directory = os.path.join(path, version)
+            try:
+                # Memory-map ma trận để nhiều worker dùng chung page cache thay vì mỗi worker một bản
+                matrix = np.load(os.path.join(directory, "matrix.npy"), mmap_mode="r")
+                with open(os.path.join(directory, "records.json"), encoding="utf-8") as f:
+                    records = json.load(f)
+                return cls(matrix, records)
+            except FileNotFoundError:
+                # Phiên bản vừa đọc đã bị một lần ghi mới hơn dọn đi: đọc lại CURRENT
+                if current_version(path) == version:
+                    raise
+
+    def save(self, path: str = INDEX_PATH) -> str:
+        # Cả hai file nằm trong một thư mục phiên bản mới; chỉ khi ghi xong mới đổi CURRENT bằng
+        # một os.replace, nên worker khác luôn đọc được một cặp ma trận/metadata khớp nhau
+        previous = current_version(path)
+        version = uuid.uuid4().hex
+        directory = os.path.join(path, version)
+        os.makedirs(directory)
+        np.save(os.path.join(directory, "matrix.npy"), np.ascontiguousarray(self.matrix, dtype=np.float32))
+        with open(os.path.join(directory, "records.json"), "w", encoding="utf-8") as f:
+            json.dump(self.records, f, ensure_ascii=False)
+        pointer = os.path.join(path, f"{CURRENT_FILE}.{version}.tmp")
+        with open(pointer, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(path, CURRENT_FILE))
+        # Giữ lại phiên bản trước cho worker có thể đang đọc dở, xóa các bản cũ hơn
+        for name in os.listdir(path):
+            if name not in (version, previous) and os.path.isdir(os.path.join(path, name)):
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+        return version
+
+    def search(self, query_vector, limit: int = 10, min_score: float = None) -> list:
+        if not self.records:
+            return []
+        query = self.normalize(query_vector)
+        scores = (self.matrix @ query + 1) / 2
+        candidates = np.flatnonzero(scores > min_score) if min_score is not None else np.arange(len(scores))
+        if len(candidates) > limit:
+            top = np.argpartition(scores[candidates], -limit)[-limit:]
+            candidates = candidates[top]
+        ordered = candidates[np.argsort(scores[candidates])[::-1]]
+        return [{**self.records[i], "score": float(scores[i])} for i in ordered]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def current_version(path: str = INDEX_PATH):
+    # Phiên bản snapshot đang dùng, None nếu chưa có snapshot
+    try:
+        with open(os.path.join(path, CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def get_index(collection=None, path: str = INDEX_PATH) -> VectorIndex:
+    # Ưu tiên snapshot trên đĩa; nếu chưa có thì dựng từ collection Mongo và lưu lại
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                if current_version(path) is not None:
+                    _index = VectorIndex.load(path)
+                elif collection is not None:
+                    _index = VectorIndex.from_collection(collection)
+                    _index.save(path)
+                else:
+                    raise FileNotFoundError(f"Không tìm thấy snapshot index tại {path}")
+    return _index
+
+
+def set_index(index: VectorIndex):
+    global _index
+    _index = index
@@ -0,0 +1,102 @@
+import asyncio
+import contextlib
+import os
+import re
+import time
+from json_stream import ReplyStreamParser
+from tts import generate_text_to_speech
+
+# Số câu được tổng hợp giọng nói song song trong một lượt voice
+VOICE_TTS_CONCURRENCY = int(os.getenv("VOICE_TTS_CONCURRENCY", "3"))
+# Câu quá ngắn ("Vâng.") được gộp với câu sau để không tốn một lời gọi TTS riêng
+MIN_SENTENCE_CHARS = int(os.getenv("VOICE_MIN_SENTENCE_CHARS", "24"))
+
+SENTENCE_END = re.compile(r"[.!?…]+[\"'”)\]]*\s+|\n+")
+
+
+class SentenceSplitter():
+    """Cắt văn bản đang được sinh ra thành từng câu hoàn chỉnh."""
+
+    def __init__(self, min_chars=MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> list:
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self._buffer):
+            if match.end() - start < self.min_chars:
+                continue
+            sentence = self._buffer[start:match.end()].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self) -> str:
+        rest, self._buffer = self._buffer.strip(), ""
+        return rest
+
+
+async def reply_sentences(chunks, parser: ReplyStreamParser, splitter: SentenceSplitter = None):
+    # Từ luồng JSON của model: lấy phần reply và trả ra từng câu ngay khi câu đó kết thúc
+    splitter = splitter or SentenceSplitter()
+    async for chunk in chunks:
+        for kind, value in parser.feed(chunk):
+            if kind == "reply":
+                for sentence in splitter.feed(value):
+                    yield sentence
+    rest = splitter.flush()
+    if rest:
+        yield rest
+
+
+async def speak(sentences, synthesize=generate_text_to_speech, concurrency=VOICE_TTS_CONCURRENCY, stats=None):
+    """Tổng hợp giọng nói cho từng câu song song (tối đa `concurrency` câu) và trả audio theo đúng thứ tự.
+
+    Câu đầu tiên được gửi đi TTS ngay khi model sinh xong nó, nên thời gian tới
+    đoạn âm thanh đầu tiên chỉ còn khoảng một câu thay vì cả lượt.
+    """
+    slots = asyncio.Semaphore(concurrency)
+    pending = asyncio.Queue(maxsize=concurrency * 2)
+    started = time.perf_counter()
+
+    async def synthesize_one(text):
+        async with slots:
+            return await synthesize(text)
+
+    async def produce():
+        try:
+            async for sentence in sentences:
+                await pending.put(asyncio.ensure_future(synthesize_one(sentence)))
+            await pending.put(None)
+        finally:
+            # Lỗi hoặc bị hủy: không được chờ chỗ trống trong hàng đợi (bên đọc có thể đã dừng);
+            # nếu hàng đợi đầy thì bên đọc nhận ra producer đã xong khi đọc hết
+            with contextlib.suppress(asyncio.QueueFull):
+                pending.put_nowait(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            if pending.empty() and producer.done():
+                break
+            task = await pending.get()
+            if task is None:
+                break
+            audio = await task
+            if not audio:
+                continue
+            if stats is not None and "first_audio_ms" not in stats:
+                stats["first_audio_ms"] = (time.perf_counter() - started) * 1000
+            yield audio
+        # Báo lỗi của luồng model (nếu có) cho bên gọi
+        await producer
+    finally:
+        producer.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not None:
+                task.cancel()